@@ -14,9 +14,10 @@ def read(fname):
 additional_requires = []
 
 # PyCURL is a Python 2-only module for the moment, so don't make it a 
-# dependency for Python 3.
+# dependency for Python 3. Python 2 also needs the backport of
+# concurrent.futures.
 if sys.version_info[0] < 3:
-    additional_requires += ['pycurl']
+    additional_requires += ['pycurl', 'futures']
 
 setup(
     name = "throw",
@@ -0,0 +1,1080 @@
+"""An asyncio engine for throwing files, for services which embed throw and
+want to run many throws on one event loop. It behaves as Thrower.throw does
+but nothing blocks the event loop: directories are walked and files read and
+encoded on threads, uploads to min.us are made over asyncio connections, as
+many at once as a transferlimit.AdaptiveLimit allows, and email is sent over
+an asyncio connection to the SMTP server. Attachment emails are sent while the uploads are in
+progress.
+
+    import asyncthrow
+
+    async def share(paths):
+        return await asyncthrow.throw_async(['someone@example.com'], paths)
+
+This module needs Python 3.5 onwards. Nothing is written to the terminal and
+the recipients must be given, so the terminal interface, which needs the
+formatter module removed in Python 3.10, is never imported. The exception is
+an upload backend other than min.us, whose create_email() is run on a thread
+as Thrower.throw runs it.
+
+"""
+
+import asyncio
+import base64
+import email.utils
+import logging
+import os
+import smtplib
+import socket
+import ssl
+import time
+
+from urllib.parse import urlencode, urlsplit
+
+import attachment_renderer
+import httpsession
+import identity
+import minus.minus as minus
+import minus_renderer
+import profiling
+import ratelimit
+import thrower
+import transferlimit
+import uploadcache
+import walker
+from config import Config
+
+_log = logging.getLogger(__name__)
+
+# asyncio.get_running_loop() is new in Python 3.7. Before then, called from a
+# coroutine, get_event_loop() gives the running loop.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+async def throw_async(to, paths, name=None, identity_=None, resume=False,
+                      pack=False, concurrency=None, http_session=None,
+                      backend=None):
+    """Send the files in paths, and in any directories in paths, to the
+    recipients in to as Thrower.throw() does. Return a dictionary with the
+    number of files thrown and their total size in bytes.
+
+    Email is sent as identity_, an identity.Identity, or as the default
+    identity if it is None. Files which are not attached are uploaded with the
+    named backend, one of thrower.UPLOAD_BACKENDS, or the one set by the
+    'upload.backend' configuration option if it is None. Up to concurrency
+    files are uploaded to min.us at once; if it is None, the
+    'upload.concurrency' configuration option is used. Uploads to min.us are
+    made through http_session, an AsyncSession, if it is not None so that
+    several throws may share its connections.
+
+    """
+    if to is None or len(to) == 0:
+        raise ValueError('There must be at least one recipient.')
+
+    config = Config()
+    if backend is None:
+        backend = config.get('upload', 'backend')
+    if backend not in thrower.UPLOAD_BACKENDS:
+        raise ValueError('Unknown upload backend: %s' % (backend,))
+    if identity_ is None:
+        identity_ = identity.load_identity(config)
+
+    # Get a list of all the individual files to add and their total size.
+    file_walker = walker.Walker(workers=config.get('walk', 'workers'))
+    with profiling.span('walk'):
+        entries = await _in_thread(lambda: list(file_walker.walk(paths)))
+    total_size = sum([x.size for x in entries])
+    profiling.count('walk.files', len(entries))
+    profiling.count('walk.bytes', total_size)
+
+    from_addr = identity_.get_rfc2822_address()
+    subject = thrower.throw_subject(name)
+
+    close_session = http_session is None
+    if close_session:
+        http_session = AsyncSession()
+
+    try:
+        async with smtp_session(identity_) as smtp:
+            limit = thrower.email_size_limit(config,
+                    await smtp.max_message_size())
+
+            # Planning looks at the files, and packing at their contents, so
+            # do it on a thread.
+            def plan():
+                (groups, uploads) = thrower.plan_throw(entries, name, limit,
+                        from_addr, to, subject, pack=pack, config=config)
+                messages = [attachment_renderer.create_email(x, name,
+                        workers=config.get('encode', 'workers'))
+                        for x in groups]
+                return (messages, uploads)
+            (messages, uploads) = await _in_thread(plan)
+
+            count = len(messages)
+            if len(uploads) > 0:
+                count += 1
+
+            # Start the uploads and send the attachment emails meanwhile.
+            job_journal = None
+            upload_task = None
+            if len(uploads) > 0:
+                if not pack:
+                    job_journal = await _in_thread(_open_journal, uploads,
+                            name, backend, resume)
+                if backend == 'minus':
+                    upload_task = asyncio.ensure_future(upload_files(uploads,
+                        name, http_session, concurrency=concurrency,
+                        journal=job_journal))
+                else:
+                    upload_task = asyncio.ensure_future(_in_thread(
+                        _create_email, backend, uploads, name, job_journal))
+
+            try:
+                for (index, message) in enumerate(messages):
+                    thrower.address_message(message, from_addr, to, subject,
+                            index, count)
+                    await smtp.sendmail(to, message)
+
+                if upload_task is not None:
+                    with profiling.span(backend):
+                        message = await upload_task
+                    thrower.address_message(message, from_addr, to, subject,
+                            count - 1, count)
+                    await smtp.sendmail(to, message)
+            except:
+                if upload_task is not None and not upload_task.done():
+                    upload_task.cancel()
+                raise
+    finally:
+        if close_session:
+            await http_session.close()
+
+    # The throw is complete and so there is nothing to resume.
+    if job_journal is not None:
+        await _in_thread(job_journal.discard)
+
+    return { 'files': len(entries), 'bytes': total_size }
+
+async def upload_files(filepaths, collection_name, session, concurrency=None,
+                       cache=None, journal=None):
+    """Upload filepaths to a new min.us gallery through session, an
+    AsyncSession, and return the email linking to them as
+    minus_renderer.create_email() does. The number of files uploaded at once
+    starts at concurrency and adapts to the throughput as it does for
+    minus_renderer. The cache and journal are used as by minus_renderer.
+
+    """
+    config = Config()
+
+    if concurrency is None:
+        concurrency = config.get('upload', 'concurrency')
+    concurrency = max(1, int(concurrency))
+
+    limit = AsyncLimit(transferlimit.AdaptiveLimit(concurrency,
+            maximum=max(concurrency, int(config.get('upload',
+                'max_concurrency'))),
+            errors=lambda: session.stats()['retries']))
+
+    verify = config.get('cache', 'verify')
+    close_cache = False
+    if cache is None:
+        cache = await _in_thread(minus_renderer._open_cache, config)
+        close_cache = cache is not None
+
+    try:
+        if journal is not None and journal.gallery is not None:
+            gallery = minus.Gallery(journal.gallery['reader_id'],
+                    editor_id=journal.gallery['editor_id'])
+        else:
+            with profiling.span('http.create_gallery'):
+                gallery = await create_gallery(session)
+            if journal is not None:
+                await _in_thread(journal.record_gallery, gallery)
+
+            if collection_name is not None:
+                with profiling.span('http.save_gallery'):
+                    await save_gallery(session, gallery, collection_name)
+
+        items = await asyncio.gather(*[_upload_file(x, gallery, session,
+            limit, cache, verify, journal) for x in filepaths])
+    finally:
+        if close_cache:
+            cache.close()
+
+    item_map = [ ]
+    for ((item, extension), path) in zip(items, filepaths):
+        item_map.append((item, extension, minus_renderer._name(path)))
+
+    return minus_renderer.links_email(gallery.reader_id, item_map)
+
+async def _upload_file(path, gallery, session, limit, cache, verify,
+                       journal):
+    """Upload path, unless it is in the journal or cache, in a slot of limit,
+    an AsyncLimit, and return its item id and the extension it was uploaded
+    with.
+
+    """
+    if hasattr(path, 'open'):
+        fp = await _in_thread(path.open)
+        try:
+            # The size of a stream is not known so it counts towards the
+            # uploads in the window but not their throughput.
+            async with limit.slot():
+                with profiling.span('http.upload'):
+                    item_id = await upload_item(session, fp, gallery,
+                            path.name)
+        finally:
+            fp.close()
+        return (item_id, os.path.splitext(path.name)[1])
+
+    st = await _in_thread(os.stat, path)
+    extension = os.path.splitext(path)[1]
+
+    if journal is not None:
+        completed = journal.completed(path, st.st_size, st.st_mtime)
+        if completed is not None:
+            _log.info('Already uploaded %s.' % (path,))
+            return (completed['id'], completed['extension'])
+
+    if cache is not None:
+        with profiling.span('cache.hash'):
+            digest = await _in_thread(uploadcache.hash_file, path)
+        cached = await _in_thread(cache.lookup, digest, st.st_size)
+        if cached is not None and (not verify or
+                await _in_thread(cache.verify, cached)):
+            _log.info('Re-using item %s for %s.' % (cached.item_id, path))
+            return (cached.item_id, cached.extension)
+
+    fp = await _in_thread(open, path, 'rb')
+    try:
+        async with limit.slot() as done:
+            with profiling.span('http.upload'):
+                item_id = await upload_item(session, fp, gallery,
+                        os.path.basename(path), payload_size=st.st_size)
+            done(st.st_size)
+    finally:
+        fp.close()
+    profiling.count('http.upload_bytes', st.st_size)
+
+    if cache is not None:
+        await _in_thread(cache.store, digest, st.st_size, item_id,
+                gallery.reader_id, extension)
+    if journal is not None:
+        await _in_thread(journal.record_item, path, st.st_size, st.st_mtime,
+                item_id, extension)
+
+    return (item_id, extension)
+
+class AsyncLimit(object):
+    """A transferlimit.AdaptiveLimit, limit, for coroutines. Its slot() is an
+    asynchronous context manager which waits without blocking the event loop
+    and otherwise behaves as AdaptiveLimit.slot() does.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._condition = asyncio.Condition()
+
+    def slot(self):
+        return _AsyncSlot(self)
+
+class _AsyncSlot(object):
+    def __init__(self, owner):
+        self._owner = owner
+        self._transferred = 0
+
+    async def __aenter__(self):
+        condition = self._owner._condition
+        async with condition:
+            await condition.wait_for(self._owner.limit.try_start)
+        return self._done
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._owner.limit.finish(self._transferred, exc_type is not None)
+        condition = self._owner._condition
+        async with condition:
+            condition.notify_all()
+        return False
+
+    def _done(self, size):
+        self._transferred = size
+
+async def create_gallery(session):
+    """Create a gallery on min.us and return it as a minus.Gallery."""
+    response = await session.post(minus.API_URL + 'CreateGallery')
+    return minus.Gallery(response['reader_id'],
+            editor_id=response['editor_id'])
+
+async def get_items(session, gallery):
+    """Return the name of gallery and the ids of the items in it."""
+    response = await session.get(minus.API_URL + 'GetItems/m' +
+            gallery.reader_id)
+    gallery.name = response['GALLERY_TITLE']
+    gallery.items = [x[16:].split('.')[0] for x in response['ITEMS_GALLERY']]
+    return (gallery.name, gallery.items)
+
+async def save_gallery(session, gallery, name):
+    """Set the name of gallery. Failing to do so is logged but is not an
+    error since the gallery is still usable.
+
+    """
+    try:
+        if gallery.items is None:
+            await get_items(session, gallery)
+        await session.post(minus.API_URL + 'SaveGallery?', { 'name': name,
+                'id': gallery.editor_id, 'items': gallery.items },
+                idempotent=True)
+    except (IOError, ValueError, KeyError) as e:
+        _log.warning('Could not name the gallery: %s' % (e,))
+    else:
+        gallery.name = name
+
+async def upload_item(session, fp, gallery, name, payload_size=None):
+    """Upload the contents of the file-like object fp to gallery as name and
+    return the id of the new item.
+
+    """
+    response = await session.post(minus.API_URL + 'UploadItem?',
+            { 'editor_id': gallery.editor_id, 'filename': name },
+            payload=fp, payload_size=payload_size)
+    return response['id']
+
+class AsyncSession(object):
+    """The asyncio counterpart of httpsession.Session: a pool of persistent
+    HTTP connections to the min.us API which may be shared by many
+    concurrent requests on one event loop.
+
+    Requests have the same connect_timeout and read_timeout deadlines, in
+    seconds, and are retried under the same rules as those of a
+    httpsession.Session.
+
+    """
+
+    def __init__(self, max_idle=8,
+                 connect_timeout=httpsession.CONNECT_TIMEOUT,
+                 read_timeout=httpsession.READ_TIMEOUT,
+                 retries=httpsession.RETRIES):
+        self._max_idle = max_idle
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._retries = retries
+
+        # Idle (reader, writer) pairs keyed by (scheme, host, port).
+        self._idle = { }
+
+        self._requests = 0
+        self._connections_opened = 0
+        self._connections_reused = 0
+        self._retries_made = 0
+
+    def stats(self):
+        """Return a dictionary with the number of requests made, the number
+        of connections opened and re-used and the number of retries made by
+        this session.
+
+        """
+        return {
+            'requests': self._requests,
+            'connections_opened': self._connections_opened,
+            'connections_reused': self._connections_reused,
+            'retries': self._retries_made,
+        }
+
+    async def close(self):
+        """Close the idle connections."""
+        for connections in self._idle.values():
+            for (reader, writer) in connections:
+                writer.close()
+        self._idle = { }
+
+    async def get(self, url):
+        """Do a HTTP get and return the parsed JSON response."""
+        return await self._request('GET', url, None, None, True)
+
+    async def post(self, url, params=None, payload=None, payload_size=None,
+                   idempotent=False):
+        """Do a HTTP post and return the parsed JSON response. The payload
+        may be a string or a file-like object which is read, on a thread,
+        httpsession.UPLOAD_CHUNK_SIZE bytes at a time. If payload_size is None
+        for a file-like object, it is sent with chunked transfer-encoding. If
+        idempotent is True, the request is retried however it failed.
+
+        """
+        if params:
+            url += urlencode(params)
+
+        if payload is None:
+            payload = b''
+        if not hasattr(payload, 'read'):
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            payload_size = len(payload)
+
+        return await self._request('POST', url, payload, payload_size,
+                idempotent)
+
+    async def _request(self, method, url, payload, payload_size, idempotent):
+        self._requests += 1
+
+        # Remember where the payload started so that it can be re-sent.
+        start = None
+        if hasattr(payload, 'read'):
+            try:
+                start = payload.tell()
+            except (AttributeError, IOError):
+                pass
+        rewindable = not hasattr(payload, 'read') or start is not None
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._attempt(method, url, payload,
+                        payload_size, idempotent, start)
+                return response.json()
+            except httpsession.TransferError as e:
+                failure = e
+            if attempt >= self._retries or \
+                    not httpsession.may_retry(failure, idempotent, rewindable):
+                raise failure.error
+
+            delay = httpsession.retry_delay(failure, attempt)
+            _log.info('Retrying %s in %.1f s after: %s' % \
+                    (url.split('?')[0], delay, failure.error))
+            await asyncio.sleep(delay)
+
+            attempt += 1
+            self._retries_made += 1
+            if start is not None:
+                payload.seek(start)
+
+    async def _attempt(self, method, url, payload, payload_size, idempotent,
+                       start):
+        """Make one attempt at a request, re-trying at once only if a
+        kept-alive connection had been closed by the server, and return its
+        httpsession.Response. A httpsession.TransferError is raised if it
+        fails in a way which may be retried.
+
+        """
+        parts = urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            try:
+                (key, reader, writer, reused) = await self._acquire(parts)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise httpsession.TransferError(_timeout_error(e),
+                        unsent=True, processed=False)
+
+            # Whether the whole request has been sent, in which case the
+            # server may have acted on it.
+            complete = [ False ]
+            try:
+                (status, reason, headers, body) = await self._exchange(reader,
+                        writer, method, parts.netloc, path, payload,
+                        payload_size, complete)
+                break
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as e:
+                writer.close()
+
+                # As for httpsession.Session, a kept-alive connection may
+                # have been closed by the server so try again at once on a
+                # new one, unless the request timed out or must not be sent
+                # twice.
+                timed_out = isinstance(e, asyncio.TimeoutError)
+                if reused and not timed_out and \
+                        (idempotent or not complete[0]) and \
+                        (not hasattr(payload, 'read') or start is not None):
+                    if start is not None:
+                        payload.seek(start)
+                    continue
+                raise httpsession.TransferError(_timeout_error(e),
+                        unsent=False, processed=complete[0])
+
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self._release(key, reader, writer)
+
+        return httpsession.check_response(url,
+                httpsession.Response(status, reason, headers, body))
+
+    async def _acquire(self, parts):
+        scheme = parts.scheme
+        host = parts.hostname
+        port = parts.port
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        key = (scheme, host, port)
+
+        idle = self._idle.get(key, [ ])
+        while len(idle) > 0:
+            (reader, writer) = idle.pop()
+            if not reader.at_eof():
+                self._connections_reused += 1
+                return (key, reader, writer, True)
+            writer.close()
+
+        self._connections_opened += 1
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=(scheme == 'https') or None), self._connect_timeout)
+        return (key, reader, writer, False)
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [ ])
+        if len(idle) < self._max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _exchange(self, reader, writer, method, host, path, payload,
+                        payload_size, complete):
+        """Send a request and return the status, reason, headers, as a
+        dictionary with lower case keys, and body of the response. Once the
+        whole request has been sent, complete[0] is set to True. Waiting to
+        send or receive anything for longer than the read timeout raises
+        asyncio.TimeoutError.
+
+        """
+        timeout = self._read_timeout
+
+        def read(coroutine):
+            return asyncio.wait_for(coroutine, timeout)
+
+        request = [ '%s %s HTTP/1.1' % (method, path), 'Host: %s' % (host,) ]
+        if payload is not None:
+            request.append('Content-Type: application/x-www-form-urlencoded')
+            if payload_size is not None:
+                request.append('Content-Length: %d' % (payload_size,))
+            else:
+                request.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+
+        if isinstance(payload, bytes):
+            writer.write(payload)
+        elif payload is not None:
+            while True:
+                data = await _in_thread(payload.read,
+                        httpsession.UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                if payload_size is None:
+                    writer.write(('%x\r\n' % (len(data),)).encode('ascii'))
+                    await _write_throttled(writer, data, timeout)
+                    writer.write(b'\r\n')
+                else:
+                    await _write_throttled(writer, data, timeout)
+            if payload_size is None:
+                writer.write(b'0\r\n\r\n')
+        await asyncio.wait_for(writer.drain(), timeout)
+        complete[0] = True
+
+        status_line = await read(reader.readline())
+        if not status_line:
+            raise ConnectionError('The server closed the connection.')
+        (version, status, reason) = (status_line.decode('latin-1').rstrip()
+                .split(' ', 2) + [ '' ])[:3]
+
+        headers = { }
+        while True:
+            line = (await read(reader.readline())).decode('latin-1').rstrip()
+            if not line:
+                break
+            (header, value) = line.split(':', 1)
+            headers[header.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = [ ]
+            while True:
+                size = int((await read(reader.readline())).split(b';')[0],
+                        16)
+                if size == 0:
+                    await read(reader.readline())
+                    break
+                chunks.append(await read(reader.readexactly(size)))
+                await read(reader.readline())
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await read(reader.readexactly(
+                int(headers['content-length'])))
+        else:
+            body = await read(reader.read())
+            headers['connection'] = 'close'
+
+        if version == 'HTTP/1.0' and \
+                headers.get('connection', '').lower() != 'keep-alive':
+            headers['connection'] = 'close'
+
+        return (int(status), reason, headers, body)
+
+def smtp_session(identity_):
+    """Return an asynchronous context manager giving a session with the SMTP
+    server of identity_ which has the methods max_message_size() and
+    sendmail() as coroutines. STARTTLS over asyncio needs Python 3.11 so,
+    before that, a server needing it is spoken to from a thread.
+
+    """
+    if identity_.smtp_settings()['use_tls'] and \
+            not hasattr(asyncio.StreamWriter, 'start_tls'):
+        return ThreadedSMTPSession(identity_)
+    return AsyncSMTPSession(identity_)
+
+class AsyncSMTPSession(object):
+    """A connection to the SMTP server of an identity.Identity over asyncio,
+    kept open across messages as identity.SMTPSession is. Messages are sent
+    one at a time and streaming messages are read and encoded on a thread.
+
+    """
+
+    __log = logging.getLogger(__name__ + '.AsyncSMTPSession')
+
+    CHECK_INTERVAL = identity.SMTPSession.CHECK_INTERVAL
+
+    def __init__(self, identity_):
+        self._identity = identity_
+        self._reader = None
+        self._writer = None
+        self._features = None
+        self._last_used = None
+        self._lock = asyncio.Lock()
+
+        # Whether the server has accepted MAIL FROM for the message being
+        # sent.
+        self._accepted = False
+
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def capabilities(self):
+        """Return the ESMTP extensions advertised by the server as a
+        dictionary mapping lower case keywords to their parameters.
+
+        """
+        async with self._lock:
+            await self._connection()
+            return dict(self._features)
+
+    async def max_message_size(self):
+        """Return the largest message the server will accept, as advertised
+        with the ESMTP SIZE extension, or None if it does not advertise a
+        limit.
+
+        """
+        try:
+            size = int((await self.capabilities()).get('size', 0))
+        except ValueError:
+            size = 0
+        if size <= 0:
+            return None
+        return size
+
+    async def sendmail(self, to, message):
+        """Send message to the recipients in to and return a dictionary of
+        the recipients which were refused, as identity.Identity.sendmail()
+        does.
+
+        """
+        if isinstance(to, str):
+            to = [ to, ]
+
+        async with self._lock:
+            while True:
+                reused = await self._connection()
+                self._accepted = False
+                try:
+                    with profiling.span('smtp.send'):
+                        senderrs = await self._send(to, message)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError,
+                        smtplib.SMTPServerDisconnected):
+                    # A re-used connection may have been dropped by the server
+                    # since it was last used, try once more with a new one. If
+                    # MAIL FROM was accepted, the message may have been
+                    # delivered.
+                    self._discard()
+                    if not reused or self._accepted:
+                        raise
+                    AsyncSMTPSession.__log.info(
+                            'Server disconnected, reconnecting.')
+
+            self._last_used = time.time()
+            self.messages_sent += 1
+            profiling.count('smtp.messages')
+            return senderrs
+
+    async def close(self):
+        """Close the connection to the server, if there is one."""
+        async with self._lock:
+            if self._writer is None:
+                return
+            try:
+                await self._command('QUIT')
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    smtplib.SMTPException):
+                pass
+            self._discard()
+
+    async def _connection(self):
+        """Make sure there is a connection to the server and return whether
+        it is a re-used one.
+
+        """
+        if self._writer is not None and \
+                time.time() - self._last_used > AsyncSMTPSession.CHECK_INTERVAL:
+            try:
+                (code, resp) = await self._command('NOOP')
+                if code != 250:
+                    self._discard()
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    smtplib.SMTPException):
+                AsyncSMTPSession.__log.info('Connection has gone stale.')
+                self._discard()
+
+        if self._writer is not None:
+            return True
+
+        await self._connect()
+        self._last_used = time.time()
+        self.connections_opened += 1
+        return False
+
+    async def _connect(self):
+        settings = await _in_thread(self._identity.smtp_settings)
+        host = settings['host'] or 'localhost'
+        port = settings['port']
+        if port is None:
+            port = smtplib.SMTP_SSL_PORT if settings['use_ssl'] \
+                    else smtplib.SMTP_PORT
+
+        with profiling.span('smtp.connect'):
+            if settings['use_ssl']:
+                context = ssl.create_default_context()
+            else:
+                context = None
+            (self._reader, self._writer) = await asyncio.open_connection(
+                    host, int(port), ssl=context)
+            (code, resp) = await self._reply()
+            if code != 220:
+                self._discard()
+                raise smtplib.SMTPConnectError(code, resp)
+            await self._ehlo()
+        profiling.count('smtp.connections')
+
+        if settings['use_tls']:
+            with profiling.span('smtp.starttls'):
+                (code, resp) = await self._command('STARTTLS')
+                if code != 220:
+                    raise smtplib.SMTPResponseException(code, resp)
+                await self._writer.start_tls(ssl.create_default_context(),
+                        server_hostname=host)
+                await self._ehlo()
+
+        if settings['username'] is not None:
+            with profiling.span('smtp.auth'):
+                await self._login(settings['username'], settings['password'])
+
+    async def _ehlo(self):
+        (code, resp) = await self._command('EHLO ' + _local_hostname())
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, resp)
+
+        # The first line is the server's name and each of the rest is an
+        # extension keyword followed by its parameters.
+        self._features = { }
+        for line in resp.decode('latin-1').split('\n')[1:]:
+            parts = line.strip().split(' ', 1)
+            self._features[parts[0].lower()] = (parts + [ '' ])[1]
+
+    async def _login(self, username, password):
+        methods = self._features.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            token = ('\0%s\0%s' % (username, password)).encode('utf-8')
+            (code, resp) = await self._command('AUTH PLAIN ' +
+                    base64.b64encode(token).decode('ascii'))
+        elif 'LOGIN' in methods:
+            (code, resp) = await self._command('AUTH LOGIN')
+            for value in (username, password):
+                if code != 334:
+                    break
+                (code, resp) = await self._command(base64.b64encode(
+                    value.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPException(
+                    'No suitable authentication method found.')
+
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def _send(self, to, message):
+        from_addr = email.utils.parseaddr(
+                self._identity.get_rfc2822_address())[1]
+
+        # As for identity.SMTPSession, BDAT is used if the server supports
+        # PIPELINING or to send attachments unencoded.
+        chunking = 'chunking' in self._features
+        pipelined = 'pipelining' in self._features
+        chunked = chunking and pipelined
+
+        mail_options = ''
+        if hasattr(message, 'encoded_size'):
+            message.allow_8bit = '8bitmime' in self._features
+            message.allow_binary = chunking and \
+                    'binarymime' in self._features
+            size = await _in_thread(message.encoded_size)
+            if size is not None and 'size' in self._features:
+                mail_options += ' SIZE=%d' % (size,)
+            if message.uses_binary():
+                mail_options += ' BODY=BINARYMIME'
+                chunked = True
+            elif message.uses_8bit():
+                mail_options += ' BODY=8BITMIME'
+
+        commands = [ 'MAIL FROM:<%s>%s' % (from_addr, mail_options) ]
+        commands.extend(['RCPT TO:<%s>' % (email.utils.parseaddr(x)[1],)
+            for x in to])
+        if not chunked:
+            commands.append('DATA')
+
+        if pipelined:
+            self._writer.write(b''.join(
+                [x.encode('utf-8') + b'\r\n' for x in commands]))
+            await self._writer.drain()
+            profiling.count('smtp.pipelined', len(commands))
+            replies = [ ]
+            for command in commands:
+                replies.append(await self._reply())
+        else:
+            replies = None
+
+        async def reply(index):
+            if replies is not None:
+                return replies[index]
+            return await self._command(commands[index])
+
+        (code, resp) = await reply(0)
+        if code != 250:
+            await self._abort(replies)
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        self._accepted = True
+
+        senderrs = { }
+        for (index, addr) in enumerate(to):
+            (code, resp) = await reply(index + 1)
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+        if len(senderrs) == len(to):
+            await self._abort(replies)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+
+        if hasattr(message, 'iter_bytes'):
+            if chunked and hasattr(message, 'iter_wire'):
+                chunks = message.iter_wire()
+            else:
+                chunks = message.iter_bytes()
+        else:
+            flattened = message.as_string()
+            if not isinstance(flattened, bytes):
+                flattened = flattened.encode('utf-8')
+            chunks = iter([ flattened ])
+
+        if chunked:
+            if not hasattr(message, 'iter_wire'):
+                chunks = identity.crlf_stream(chunks)
+            await self._send_chunks(identity.bdat_chunks(chunks), pipelined)
+            return senderrs
+
+        (code, resp) = await reply(len(commands) - 1)
+        if code != 354:
+            await self._command('RSET')
+            raise smtplib.SMTPDataError(code, resp)
+
+        # Reading and encoding the attachments happens as the chunks are
+        # generated so generate them on a thread.
+        quoted = identity.quote_data_stream(chunks)
+        sent = 0
+        while True:
+            data = await _in_thread(next, quoted, None)
+            if data is None:
+                break
+            await _write_throttled(self._writer, data)
+            sent += len(data)
+        self._writer.write(b'.\r\n')
+        profiling.count('smtp.bytes', sent)
+
+        (code, resp) = await self._reply()
+        if code != 250:
+            await self._command('RSET')
+            raise smtplib.SMTPDataError(code, resp)
+
+        return senderrs
+
+    async def _send_chunks(self, chunks, pipelined):
+        """Send chunks, (data, last) pairs as yielded by
+        identity.bdat_chunks(), with BDAT commands. If pipelined is True, up
+        to identity.MAX_UNACKED_CHUNKS chunks are sent before waiting for the
+        reply to the first of them.
+
+        """
+        unacked = 0
+        sent = 0
+        while True:
+            item = await _in_thread(next, chunks, None)
+            if item is None:
+                break
+            (data, last) = item
+            if last:
+                command = 'BDAT %d LAST\r\n' % (len(data),)
+            else:
+                command = 'BDAT %d\r\n' % (len(data),)
+            await _write_throttled(self._writer,
+                    command.encode('ascii') + data)
+            profiling.count('smtp.chunks')
+            sent += len(data)
+            unacked += 1
+
+            while unacked > 0 and (last or not pipelined or
+                    unacked > identity.MAX_UNACKED_CHUNKS):
+                (code, resp) = await self._reply()
+                unacked -= 1
+                if code != 250:
+                    for _ in range(unacked):
+                        await self._reply()
+                    await self._command('RSET')
+                    raise smtplib.SMTPDataError(code, resp)
+        profiling.count('smtp.bytes', sent)
+
+    async def _abort(self, replies):
+        """Reset the transaction after the envelope was refused. If the
+        commands were pipelined, their replies are in replies and a DATA
+        command the server started despite refusing every recipient is ended
+        first.
+
+        """
+        if replies is not None and replies[-1][0] == 354:
+            self._writer.write(b'.\r\n')
+            await self._reply()
+        await self._command('RSET')
+
+    async def _command(self, command):
+        self._writer.write(command.encode('utf-8') + b'\r\n')
+        await self._writer.drain()
+        return await self._reply()
+
+    async def _reply(self):
+        """Read a possibly multi-line reply and return its code and text, as
+        smtplib.SMTP.getreply() does.
+
+        """
+        lines = [ ]
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                self._discard()
+                raise smtplib.SMTPServerDisconnected(
+                        'Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        return (int(line[:3]), b'\n'.join(lines))
+
+    def _discard(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+class ThreadedSMTPSession(object):
+    """An identity.SMTPSession used from a thread, with the same interface as
+    AsyncSMTPSession.
+
+    """
+
+    def __init__(self, identity_):
+        self._identity = identity_
+        self._session = identity_.session()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def capabilities(self):
+        return await _in_thread(self._session.capabilities)
+
+    async def max_message_size(self):
+        try:
+            size = int((await self.capabilities()).get('size', 0))
+        except ValueError:
+            size = 0
+        if size <= 0:
+            return None
+        return size
+
+    async def sendmail(self, to, message):
+        return await _in_thread(self._session.sendmail, to, message)
+
+    async def close(self):
+        await _in_thread(self._session.close)
+
+def _open_journal(uploads, name, backend, resume):
+    from journal import Journal
+
+    job_journal = Journal.for_job(uploads, name, backend)
+    if not (resume and job_journal.load()):
+        job_journal.discard()
+    return job_journal
+
+def _create_email(backend, uploads, name, journal):
+    """Upload uploads with the named backend, other than min.us, and return
+    the email linking to them.
+
+    """
+    renderer = __import__(thrower.UPLOAD_BACKENDS[backend])
+    return renderer.create_email(uploads, name, journal=journal)
+
+def _local_hostname():
+    return socket.getfqdn()
+
+def _in_thread(function, *args):
+    """Return a future for the result of calling function with args on the
+    default executor of the running event loop.
+
+    """
+    return _running_loop().run_in_executor(None, function, *args)
+
+async def _write_throttled(writer, data, timeout=None):
+    """Write data to writer, waiting between pieces of it as the rate limit
+    shared with all other transfers requires. If timeout is not None and
+    the connection takes longer than timeout seconds to accept a piece,
+    asyncio.TimeoutError is raised.
+
+    """
+    for piece in ratelimit.pieces(data):
+        delay = ratelimit.reserve(len(piece))
+        if delay > 0:
+            with profiling.span('throttle.wait'):
+                await asyncio.sleep(delay)
+        writer.write(piece)
+        await asyncio.wait_for(writer.drain(), timeout)
+
+def _timeout_error(error):
+    """Return error, or a socket.timeout in place of an asyncio.TimeoutError,
+    so that timeouts are raised as the IOError that httpsession.Session
+    raises.
+
+    """
+    if isinstance(error, asyncio.TimeoutError) and \
+            not isinstance(error, IOError):
+        return socket.timeout('timed out')
+    return error
@@ -1,74 +1,596 @@
 import os
+import base64
+import binascii
 import mimetypes
+import re
+import uuid
 
-from email import encoders
+from collections import deque
+from contextlib import closing
 from email.message import Message
-from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-def create_email(filepaths, collection_name):
+import profiling
+
+# Attachments are read from disk and encoded this many bytes at a time. This is
+# a multiple of 57 bytes so that each chunk encodes to a whole number of
+# 76-character base64 lines and the encoded chunks can simply be concatenated.
+CHUNK_SIZE = 57 * 1024
+
+# When attachments are encoded by a pool of processes they are cut into blocks
+# of this size, again a multiple of 57 bytes, so that each block is worth the
+# cost of sending it to and from another process.
+PARALLEL_BLOCK_SIZE = 57 * 16 * 1024
+
+# Messages whose attachments total less than this many bytes are encoded
+# serially since starting a pool of processes would take longer.
+MIN_PARALLEL_SIZE = 4 * 1024 * 1024
+
+# Files of at most this many bytes are read into memory when their message is
+# sized or sent, so that the cheapest Content-Transfer-Encoding can be chosen
+# without reading them twice. Larger files are base64 encoded unless the binary
+# encoding is allowed.
+SNIFF_LIMIT = 1024 * 1024
+
+# The longest line, excluding its CRLF, which may be sent with the 7bit or 8bit
+# encodings.
+MAX_LINE_LENGTH = 998
+
+# The encodings in order of preference when they give the same size. The binary
+# encoding sends the contents as they are and needs an SMTP server supporting
+# BINARYMIME, to which the message is sent with BDAT rather than DATA.
+ENCODINGS = ('7bit', '8bit', 'binary', 'quoted-printable', 'base64')
+
+# The bytes which are 7 bit ASCII and the bytes which quoted-printable may
+# leave as they are, including the CR and LF of line breaks.
+_ASCII = bytes(bytearray(range(128)))
+_QP_LITERAL = bytes(bytearray([9, 10, 13, 32] +
+        [x for x in range(33, 127) if x != ord('=')]))
+
+# Matches any of the line endings which need to be converted to CRLF.
+_EOL_RE = re.compile(b'(?:\r\n|\n|\r(?!\n))')
+
+# This magic is to support the base64 function re-naming that happened with the
+# Python 2->3 transition.
+try:
+    _encodebytes = base64.encodebytes
+except AttributeError:
+    _encodebytes = base64.encodestring
+
+def create_email(filepaths, collection_name, workers=1):
     """Create an email message object which implements the
     email.message.Message interface and which has the files to be shared
     attached to it.
 
+    The files are not read when the message is created. Instead the returned
+    StreamingMessage reads and encodes each file a chunk at a time when it is
+    written out via its iter_bytes() method. The files are encoded by up to
+    workers processes at once; if workers is None, one per CPU core is used.
+
+    As well as paths, filepaths may contain objects, such as a
+    packer.Archive, with a name attribute and an open() method returning a
+    file-like object. These are attached in the same way as files.
+
+    """
+    outer = _empty_email()
+    outer.workers = workers
+
+    for path in filepaths:
+        if not hasattr(path, 'open') and not os.path.isfile(path):
+            continue
+        outer.attach(FileAttachment(path))
+
+    return outer
+
+def message_size(headers):
+    """Return the size in bytes, as sent over SMTP, of an email created by
+    create_email() with no files attached once the headers in the dictionary
+    headers have been set on it.
+
+    """
+    outer = _empty_email()
+    for name in headers:
+        outer[name] = headers[name]
+    return outer.encoded_size()
+
+def part_size(path, size):
+    """Return the number of bytes, as sent over SMTP, which attaching the
+    file at path, which is size bytes long, adds to an email created by
+    create_email() if it is base64 encoded. Nothing is read from the file.
+    Since any other encoding is only chosen if it is cheaper, this is an upper
+    bound.
+
     """
-    outer = MIMEMultipart()
+    part = FileAttachment(path)
+
+    # Each part is preceded by a CRLF and a boundary line.
+    return 2 + len('--') + BOUNDARY_LENGTH + 2 + \
+            _wire_size(part.header_bytes()) + _base64_wire_size(size)
+
+def _empty_email():
+    outer = StreamingMessage()
     outer.preamble = 'Here are some files for you'
 
-    def add_file_to_outer(path):
-        if not os.path.isfile(path):
-            return
+    outer.attach(MIMEText("Here are some files I've thrown at you."))
+
+    return outer
+
+class FileAttachment(MIMEBase):
+    """A MIME part whose payload is the encoded contents of a file on disk or
+    of an object with a name attribute and an open() method. The payload is a
+    placeholder token until the enclosing StreamingMessage is written out.
+
+    The contents are base64 encoded unless choose_encoding() finds a cheaper
+    encoding for them. Whichever encoding is used, the recipient gets back
+    exactly the bytes of the file.
+
+    """
+
+    def __init__(self, path):
+        if hasattr(path, 'open'):
+            filename = path.name
+        else:
+            filename = os.path.basename(path)
 
         # Guess the content type based on the file's extension.  Encoding
         # will be ignored, although we should check for simple things like
         # gzip'd or compressed files.
-        ctype, encoding = mimetypes.guess_type(path)
+        ctype, encoding = mimetypes.guess_type(filename)
         if ctype is None or encoding is not None:
             # No guess could be made, or the file is encoded (compressed), so
             # use a generic bag-of-bits type.
             ctype = 'application/octet-stream'
         maintype, subtype = ctype.split('/', 1)
 
-        if maintype == 'image':
-            fp = open(path, 'rb')
-            msg = MIMEImage(fp.read(), _subtype=subtype)
-            fp.close()
-        elif maintype == 'audio':
-            fp = open(path, 'rb')
-            msg = MIMEAudio(fp.read(), _subtype=subtype)
-            fp.close()
-        elif maintype == 'text':
-            # We do this to catch cases where text files have
-            # an encoding we can't guess correctly.
-            try:
-                fp = open(path, 'r')
-                msg = MIMEText(fp.read(), _subtype=subtype)
-                fp.close()
-            except UnicodeDecodeError:
-                fp = open(path, 'rb')
-                msg = MIMEBase(maintype, subtype)
-                msg.set_payload(fp.read())
-                encoders.encode_base64(msg)
-                fp.close()
-        else:
-            fp = open(path, 'rb')
-            msg = MIMEBase(maintype, subtype)
-            msg.set_payload(fp.read())
-            fp.close()
-            # Encode the payload using Base64
-            encoders.encode_base64(msg)
+        MIMEBase.__init__(self, maintype, subtype)
+
+        self.path = path
+        self.placeholder = 'throw-attachment-%s' % (uuid.uuid4().hex,)
+        self.set_payload(self.placeholder)
+
+        self.encoding = 'base64'
+        self['Content-Transfer-Encoding'] = self.encoding
 
         # Set the filename parameter
-        msg.add_header('Content-Disposition', 'attachment',
-                filename=os.path.basename(path))
-        outer.attach(msg)
+        self.add_header('Content-Disposition', 'attachment',
+                filename=filename)
 
-    outer.attach(MIMEText("Here are some files I've thrown at you."))
-    
-    for path in filepaths:
-        add_file_to_outer(path)
+        # The contents of a small file once read, the encoded contents if the
+        # encoding is not base64 and whether 8bit and binary were allowed
+        # when the encoding was chosen or None if it has not been.
+        self._data = None
+        self._encoded = None
+        self._chosen_for = None
 
-    return outer
+    def choose_encoding(self, allow_8bit=False, allow_binary=False):
+        """Choose the Content-Transfer-Encoding which sends the fewest bytes
+        over SMTP, considering 8bit only if allow_8bit is True and binary only
+        if allow_binary is True, and return it. Files of at most SNIFF_LIMIT
+        bytes are read into memory to choose and are then sent from memory by
+        iter_body(); others are sent as they are if binary is allowed and are
+        base64 encoded if not.
+
+        """
+        if self._chosen_for == (allow_8bit, allow_binary):
+            return self.encoding
+
+        if self._data is None and not hasattr(self.path, 'open') and \
+                os.path.getsize(self.path) <= SNIFF_LIMIT:
+            with profiling.span('attachment.read'):
+                with self._open() as fp:
+                    self._data = fp.read()
+            profiling.count('attachment.bytes', len(self._data))
+
+        if self._data is not None:
+            with profiling.span('attachment.sniff'):
+                (self.encoding, self._encoded) = _cheapest_encoding(
+                        self._data, allow_8bit, allow_binary)
+        elif allow_binary:
+            (self.encoding, self._encoded) = ('binary', None)
+        else:
+            (self.encoding, self._encoded) = ('base64', None)
+
+        self.replace_header('Content-Transfer-Encoding', self.encoding)
+        self._chosen_for = (allow_8bit, allow_binary)
+        return self.encoding
+
+    def iter_body(self):
+        """Yield the encoded contents of the file as a sequence of byte
+        strings. Unless the file was read into memory by choose_encoding(),
+        at most CHUNK_SIZE bytes of the file are held in memory at any one
+        time.
+
+        """
+        if self._encoded is not None:
+            return self._iter_encoded()
+        if self.encoding == 'binary':
+            return self.iter_blocks()
+
+        def encode_blocks():
+            for block in self.iter_blocks():
+                with profiling.span('attachment.encode'):
+                    encoded = _encodebytes(block)
+                yield encoded
+
+        return _strip_final_newline(encode_blocks())
+
+    def _iter_encoded(self):
+        encoded = self._encoded
+        self._release()
+        yield encoded
+
+    def iter_blocks(self, block_size=CHUNK_SIZE):
+        """Yield the contents of the file as a sequence of byte strings of
+        block_size bytes, which must be a multiple of 57, except for the last
+        which may be shorter. Since each but the last is a whole number of
+        base64 lines, the blocks may be encoded independently and the results
+        concatenated.
+
+        """
+        if self._data is not None:
+            data = self._data
+            self._release()
+            for offset in range(0, len(data), block_size):
+                yield data[offset:offset + block_size]
+            return
+
+        pending = b''
+        with self._open() as fp:
+            while True:
+                with profiling.span('attachment.read'):
+                    data = fp.read(block_size - len(pending))
+                if not data:
+                    break
+                profiling.count('attachment.bytes', len(data))
+
+                # A file-like object may return less than was asked for so
+                # only pass on whole blocks until we reach the end of the
+                # file.
+                pending += data
+                if len(pending) == block_size:
+                    yield pending
+                    pending = b''
+
+        if len(pending) > 0:
+            yield pending
+
+    def header_bytes(self):
+        """Return the headers of this part, and the blank line which ends
+        them, as flattened within a StreamingMessage.
+
+        """
+        flattened = _to_bytes(Message.as_string(self))
+        return flattened[:-len(self.placeholder)]
+
+    def body_size(self):
+        """Return the size in bytes, as sent over SMTP, of the encoded
+        contents of the file or None if it is not known in advance.
+
+        """
+        if self.encoding == 'binary':
+            if self._encoded is not None:
+                return len(self._encoded)
+            if hasattr(self.path, 'open'):
+                return None
+            return os.path.getsize(self.path)
+
+        if self._encoded is not None:
+            return _wire_size(self._encoded)
+        if self._data is not None:
+            return _base64_wire_size(len(self._data))
+        if hasattr(self.path, 'open'):
+            return None
+        return _base64_wire_size(os.path.getsize(self.path))
+
+    def _release(self):
+        # Once the contents have been sent they are not kept in memory. If
+        # the message is sent again they are read again.
+        self._data = None
+        self._encoded = None
+        self._chosen_for = None
+
+    def _open(self):
+        if hasattr(self.path, 'open'):
+            return closing(self.path.open())
+        return open(self.path, 'rb')
+
+class StreamingMessage(MIMEMultipart):
+    """A multipart message which may have FileAttachment parts. Headers may be
+    set as for any other email.message.Message but the message should be
+    written out with iter_bytes() so that the attachments are never held in
+    memory in their entirety.
+
+    """
+
+    # The number of processes which encode the attachments at once or None for
+    # one per CPU core.
+    workers = 1
+
+    # Whether attachments may be sent with the 8bit encoding, which needs an
+    # SMTP server supporting 8BITMIME.
+    allow_8bit = False
+
+    # Whether attachments may be sent with the binary encoding, which needs an
+    # SMTP server supporting BINARYMIME and CHUNKING. A message using it must
+    # be written out with iter_wire().
+    allow_binary = False
+
+    def __init__(self, *args, **kwargs):
+        # Fix the boundary now so that the size of the message is known before
+        # it is flattened.
+        if kwargs.get('boundary') is None:
+            kwargs['boundary'] = _make_boundary()
+        MIMEMultipart.__init__(self, *args, **kwargs)
+
+    def encoded_size(self):
+        """Return the exact size in bytes of the message as sent over SMTP,
+        with CRLF line endings, or None if it has attachments of unknown size.
+        Only files small enough to choose their encoding are read, and they
+        are not read again when the message is sent.
+
+        """
+        self._choose_encodings()
+        template = _to_bytes(MIMEMultipart.as_string(self))
+        size = _wire_size(template)
+
+        for part in self.get_payload():
+            if not isinstance(part, FileAttachment):
+                continue
+
+            body_size = part.body_size()
+            if body_size is None:
+                return None
+            size += body_size - len(_to_bytes(part.placeholder))
+
+        return size
+
+    def iter_bytes(self):
+        """Yield the flattened message as a sequence of byte strings."""
+        for (data, part) in self._iter_sections():
+            yield data
+
+    def iter_wire(self):
+        """Yield the message as a sequence of byte strings in the form sent
+        with the SMTP BDAT command: with CRLF line endings, except within
+        attachments sent with the binary encoding, which are sent exactly as
+        they are.
+
+        """
+        for (data, part) in self._iter_sections():
+            if part is None or part.encoding != 'binary':
+                data = _EOL_RE.sub(b'\r\n', data)
+            yield data
+
+    def _iter_sections(self):
+        """Yield the flattened message as a sequence of (data, part) pairs
+        where part is the FileAttachment whose contents data is part of or
+        None for the rest of the message.
+
+        """
+        # Flatten the message with the placeholder payloads and then
+        # substitute the encoded contents of each file as we reach it.
+        self._choose_encodings()
+        template = MIMEMultipart.as_string(self)
+        parts = [x for x in self.get_payload() if isinstance(x, FileAttachment)]
+
+        workers = self.workers
+        if workers is None:
+            workers = _cpu_count()
+        if workers > 1 and self._attachment_size() >= MIN_PARALLEL_SIZE:
+            # Only base64 encoding is done by the pool. The other encodings
+            # were done when they were chosen.
+            encoded = _encode_in_parallel(
+                    [x for x in parts if x.encoding == 'base64'], workers)
+            bodies = [ ]
+            for part in parts:
+                if part.encoding == 'base64':
+                    bodies.append(_strip_final_newline(_until_none(encoded)))
+                else:
+                    bodies.append(part.iter_body())
+        else:
+            bodies = [x.iter_body() for x in parts]
+
+        for (part, body) in zip(parts, bodies):
+            before, template = template.split(part.placeholder, 1)
+            yield (_to_bytes(before), None)
+            for chunk in body:
+                yield (chunk, part)
+
+        yield (_to_bytes(template), None)
+
+    def uses_8bit(self):
+        """Return whether any attachment is sent with the 8bit encoding, in
+        which case the message must be sent with the SMTP BODY=8BITMIME
+        parameter.
+
+        """
+        return '8bit' in self._choose_encodings()
+
+    def uses_binary(self):
+        """Return whether any attachment is sent with the binary encoding, in
+        which case the message must be sent with BDAT and the SMTP
+        BODY=BINARYMIME parameter.
+
+        """
+        return 'binary' in self._choose_encodings()
+
+    def _choose_encodings(self):
+        return [x.choose_encoding(self.allow_8bit, self.allow_binary)
+                for x in self.get_payload() if isinstance(x, FileAttachment)]
+
+    def _attachment_size(self):
+        """Return the total size of the base64 encoded attachments or, if any
+        are of unknown size, MIN_PARALLEL_SIZE.
+
+        """
+        size = 0
+        for part in self.get_payload():
+            if not isinstance(part, FileAttachment) or \
+                    part.encoding != 'base64':
+                continue
+            body_size = part.body_size()
+            if body_size is None:
+                return MIN_PARALLEL_SIZE
+            size += body_size
+        return size
+
+    def as_string(self, *args, **kwargs):
+        """Return the entire flattened message as a string. This defeats the
+        point of streaming the attachments and so should be avoided for large
+        messages.
+
+        """
+        flattened = b''.join(self.iter_bytes())
+        if isinstance(flattened, str):
+            return flattened
+        return flattened.decode('utf-8')
+
+def _cheapest_encoding(data, allow_8bit, allow_binary=False):
+    """Return the Content-Transfer-Encoding which sends data in the fewest
+    bytes over SMTP, allowing for the length of its name in the header, and
+    the encoded data or, for base64, None. The encoding must give back data
+    exactly so 7bit and 8bit are only used if every line break in data is a
+    CRLF.
+
+    """
+    candidates = [ ('base64', None, _base64_wire_size(len(data))) ]
+
+    if _has_smtp_lines(data):
+        if len(data.translate(None, _ASCII)) == 0:
+            candidates.append(('7bit', data, len(data)))
+        elif allow_8bit:
+            candidates.append(('8bit', data, len(data)))
+    if allow_binary:
+        candidates.append(('binary', data, len(data)))
+
+    # Each byte which quoted-printable must escape takes three so only try it
+    # if that alone would be cheaper than base64. It is never cheaper than
+    # binary.
+    escaped = len(data.translate(None, _QP_LITERAL))
+    if not allow_binary and len(data) + 2 * escaped < candidates[0][2]:
+        encoded = _quoted_printable(data)
+        candidates.append(('quoted-printable', encoded, _wire_size(encoded)))
+
+    (encoding, encoded, size) = min(candidates, key=lambda x:
+            (x[2] + len(x[0]), ENCODINGS.index(x[0])))
+    profiling.count('attachment.' + encoding)
+    return (encoding, encoded)
+
+def _has_smtp_lines(data):
+    """Return whether data may be sent over SMTP as it is: no NULs, only CRLF
+    line breaks and no line longer than MAX_LINE_LENGTH.
+
+    """
+    if b'\0' in data:
+        return False
+    crlfs = data.count(b'\r\n')
+    if data.count(b'\r') != crlfs or data.count(b'\n') != crlfs:
+        return False
+    return max([len(x) for x in data.split(b'\r\n')]) <= MAX_LINE_LENGTH
+
+def _quoted_printable(data):
+    """Return data quoted-printable encoded, with each CRLF as a line break
+    and any other CR or LF escaped. Lines are separated by newlines which
+    become CRLFs when sent.
+
+    """
+    return b'\n'.join([binascii.b2a_qp(x, False, False, False)
+        for x in data.split(b'\r\n')])
+
+def _encode_in_parallel(parts, workers):
+    """Yield the base64 encoded contents of each of parts, a list of
+    FileAttachment objects, in order, with None after the contents of each.
+    The contents are cut into blocks which are encoded by a pool of workers
+    processes. Since the blocks are a whole number of base64 lines, this is
+    identical to encoding each file in one go.
+
+    """
+    # Under Python 2 this is provided by the 'futures' backport. It is only
+    # imported when needed since it is slow to import.
+    from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        # Keep every worker busy with a block queued behind it while the
+        # encoded blocks are collected in order.
+        for part in parts:
+            for block in part.iter_blocks(PARALLEL_BLOCK_SIZE):
+                pending.append(executor.submit(_encodebytes, block))
+                while len(pending) >= 2 * workers:
+                    yield _result(pending.popleft())
+            pending.append(None)
+
+        while len(pending) > 0:
+            yield _result(pending.popleft())
+    finally:
+        for future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=True)
+
+def _result(future):
+    if future is None:
+        return None
+    with profiling.span('attachment.encode'):
+        return future.result()
+
+def _until_none(iterable):
+    """Yield the items of iterable up to, but not including, the next
+    None.
+
+    """
+    for item in iterable:
+        if item is None:
+            return
+        yield item
+
+def _strip_final_newline(chunks):
+    """Yield chunks, base64 encoded lines, without the final newline since
+    the newline before the next boundary belongs to the boundary, not to the
+    payload.
+
+    """
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            yield previous
+        previous = chunk
+    if previous is not None:
+        yield previous[:-1]
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _make_boundary():
+    return '===============%s==' % (uuid.uuid4().hex,)
+
+BOUNDARY_LENGTH = len(_make_boundary())
+
+def _base64_wire_size(size):
+    """Return the size in bytes of size bytes once base64 encoded into lines
+    of 76 characters separated by CRLF. There is no CRLF after the last line
+    since it belongs to the following boundary.
+
+    """
+    encoded = 4 * ((size + 2) // 3)
+    lines = (encoded + 75) // 76
+    return encoded + 2 * max(lines - 1, 0)
+
+def _wire_size(flattened):
+    """Return the size in bytes of the flattened message fragment once its
+    line endings have been converted to CRLF.
+
+    """
+    return len(flattened) + flattened.count(b'\n') - flattened.count(b'\r\n')
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
@@ -0,0 +1,120 @@
+"""Run many throws from a manifest in a single process."""
+
+import csv
+import json
+import logging
+import threading
+import time
+
+# Under Python 2 this is provided by the 'futures' backport.
+from concurrent.futures import ThreadPoolExecutor
+
+_log = logging.getLogger(__name__)
+
+class Job(object):
+    """A single throw: a list of recipients, a list of paths and an optional
+    collection name.
+
+    """
+    def __init__(self, to, paths, name=None):
+        self.to = to
+        self.paths = paths
+        self.name = name
+
+def read_manifest(path):
+    """Read a list of Jobs from the manifest at path.
+
+    If path ends in '.csv' the manifest is a CSV file with a header row naming
+    the columns 'to', 'paths' and, optionally, 'name'. Multiple recipients or
+    paths within one cell are separated by ';'.
+
+    Otherwise the manifest has one JSON object per line with the keys 'to',
+    'paths' and, optionally, 'name'. The values of 'to' and 'paths' may be a
+    list or a single string. Blank lines are ignored.
+
+    A ValueError is raised if any job has no recipients or no paths since
+    there is nobody to ask for them interactively.
+
+    """
+    jobs = [ ]
+    with open(path, 'r') as fp:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(fp):
+                jobs.append(Job(_split_cell(row.get('to')),
+                                _split_cell(row.get('paths')),
+                                row.get('name') or None))
+        else:
+            for line in fp:
+                if line.strip() == '':
+                    continue
+                record = json.loads(line)
+                jobs.append(Job(_as_list(record.get('to')),
+                                _as_list(record.get('paths')),
+                                record.get('name')))
+
+    for index, job in enumerate(jobs):
+        if len(job.to) == 0:
+            raise ValueError('Job %s in %s has no recipients.' % (index, path))
+        if len(job.paths) == 0:
+            raise ValueError('Job %s in %s has no paths.' % (index, path))
+
+    return jobs
+
+def run_batch(thrower, jobs, workers=1, report=None):
+    """Run each of jobs through thrower, a thrower.Thrower, with up to
+    workers jobs running at once. All jobs share one SMTP session and the
+    default min.us HTTP session.
+
+    A failing job does not stop the batch. One result dictionary is returned
+    per job, in the order of jobs, with the keys 'job', 'name', 'to', 'paths',
+    'status' ('ok' or 'error'), 'error', 'files', 'bytes', 'seconds' and
+    'throttled_seconds', the time during the job for which sending was held
+    back by the shared rate limit. If report is not None, it should be a
+    file-like object to which each result is written as a line of JSON as
+    soon as its job finishes.
+
+    """
+    report_lock = threading.Lock()
+
+    def run(index):
+        job = jobs[index]
+        result = {
+            'job': index, 'name': job.name, 'to': job.to, 'paths': job.paths,
+            'status': 'ok', 'error': None, 'files': None, 'bytes': None,
+            'throttled_seconds': None,
+        }
+
+        start = time.time()
+        try:
+            result.update(thrower.throw(job.to, job.paths, name=job.name))
+        except Exception as e:
+            _log.exception('Job %s failed.' % (index,))
+            result['status'] = 'error'
+            result['error'] = str(e)
+        result['seconds'] = time.time() - start
+
+        if report is not None:
+            with report_lock:
+                report.write(json.dumps(result) + '\n')
+                report.flush()
+
+        return result
+
+    with thrower.session():
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            return list(executor.map(run, range(len(jobs))))
+        finally:
+            executor.shutdown(wait=True)
+
+def _as_list(value):
+    if value is None:
+        return [ ]
+    if isinstance(value, list):
+        return value
+    return [ value, ]
+
+def _split_cell(value):
+    if value is None:
+        return [ ]
+    return [x.strip() for x in value.split(';') if x.strip() != '']
@@ -5,9 +5,9 @@ import logging
 import sys
 import os
 
-import terminalinterface
-import identity
-import thrower
+# Only the modules needed to parse the command line are imported here. The
+# rest are imported by the command which uses them so that, for example,
+# '--help' does not load the SMTP and email machinery.
 
 def run():
     cli = CommandLine()
@@ -15,7 +15,7 @@ def run():
 
 class CommandLine(object):
     def __init__(self):
-        self._interface = terminalinterface.TerminalInterface()
+        self._terminal_interface = None
 
         self._parser = argparse.ArgumentParser(description='Simply share a file.')
         self._parser.add_argument('paths', metavar='PATH', type=str, nargs='*',
@@ -34,14 +34,83 @@ class CommandLine(object):
             choices=('identity',))
         self._parser.add_argument('--test-email', dest='send_test_email',
             action='store_true', help='attempt to send a test email.')
+        self._parser.add_argument('--resume', dest='resume',
+            action='store_true',
+            help='resume an interrupted upload of the same files and name.')
+        self._parser.add_argument('-z', '--pack', dest='pack',
+            action='store_true',
+            help='send the files as a single compressed archive.')
+        self._parser.add_argument('--sync', dest='sync',
+            action='store_true',
+            help='upload only the files which are new or have changed since '
+                 'the collection given by --name was last synced.')
+        self._parser.add_argument('--backend', dest='backend',
+            choices=('minus', 's3'),
+            help='where to upload files too large to attach (default: the '
+                 'upload.backend option).')
+        self._parser.add_argument('--limit-rate', dest='limit_rate',
+            metavar='RATE',
+            help='send no more than RATE bytes per second in total, such as '
+                 '500k or 20M (default: the transfer.limit_rate option).')
+        self._parser.add_argument('--batch', dest='batch', metavar='MANIFEST',
+            help='throw each job listed in MANIFEST, a JSON lines or CSV file.')
+        self._parser.add_argument('--jobs', dest='jobs', metavar='N',
+            type=int, default=1,
+            help='the number of batch jobs to run at once (default: 1).')
+        self._parser.add_argument('--report', dest='report', metavar='FILE',
+            default='-',
+            help='write the batch job results as JSON lines to FILE '
+                 '(default: standard output).')
+        self._parser.add_argument('--profile', dest='profile',
+            action='store_true',
+            help='print how long each phase of the throw took.')
+        self._parser.add_argument('--profile-json', dest='profile_json',
+            metavar='FILE',
+            help='as --profile and also write the timings as JSON to FILE.')
+        self._parser.add_argument('--profile-cprofile', dest='profile_cprofile',
+            metavar='FILE',
+            help='as --profile and also write cProfile statistics for the '
+                 'main thread to FILE.')
+
+    @property
+    def _interface(self):
+        # Set up the terminal only once there is something to tell the user.
+        if self._terminal_interface is None:
+            import terminalinterface
+            self._terminal_interface = terminalinterface.TerminalInterface()
+        return self._terminal_interface
 
     def main(self, argv):
         args = self._parser.parse_args(argv)
 
+        if args.sync and args.name is None:
+            self._parser.error('--sync needs a collection --name')
+        if args.sync and args.pack:
+            self._parser.error('--sync and --pack cannot be used together')
+        if args.sync and args.backend not in (None, 'minus'):
+            self._parser.error('--sync can only be used with min.us')
+
+        if args.limit_rate is not None:
+            import ratelimit
+            from config import Config
+            try:
+                ratelimit.install(ratelimit.from_config(Config(),
+                    rate=args.limit_rate))
+            except ValueError as e:
+                self._parser.error(str(e))
+
         if args.verbose:
             logging.basicConfig(level=logging.INFO)
 
+        if args.profile or args.profile_json is not None or \
+                args.profile_cprofile is not None:
+            self.run_profiled(args)
+        else:
+            self.run_command(args)
+
+    def run_command(self, args):
         if args.send_test_email:
+            import identity
             try:
                 config_id = identity.load_identity()
                 config_id.send_test_email()
@@ -55,9 +124,67 @@ class CommandLine(object):
         elif args.set is not None:
             if args.set == 'identity':
                 self.set_identity()
+        elif args.batch is not None:
+            self.run_batch(args.batch, args.jobs, args.report)
         else:
-            thrower.throw(args.to, args.paths, args.name)
+            import thrower
+            thrower.throw(args.to, args.paths, args.name, resume=args.resume,
+                    pack=args.pack, sync=args.sync, backend=args.backend)
+
+    def run_profiled(self, args):
+        """Run the command given by args, recording the time spent in each
+        phase and printing a breakdown to standard error when it finishes.
+
+        """
+        import profiling
+
+        profile = profiling.enable()
+        try:
+            if args.profile_cprofile is not None:
+                import cProfile
+                cprofile = cProfile.Profile()
+                try:
+                    cprofile.runcall(self.run_command, args)
+                finally:
+                    cprofile.dump_stats(args.profile_cprofile)
+            else:
+                self.run_command(args)
+        finally:
+            profile.stop()
+            profiling.disable()
+
+            sys.stderr.write(profile.format())
+            if args.profile_json is not None:
+                profile.dump_json(args.profile_json)
+
+    def run_batch(self, manifest, jobs, report_path):
+        import batch
+        import thrower
+
+        try:
+            batch_jobs = batch.read_manifest(manifest)
+        except (IOError, ValueError) as e:
+            self._interface.error('Could not read the batch manifest: %s' % (e,))
+            return
+
+        if report_path == '-':
+            report = sys.stdout
+        else:
+            report = open(report_path, 'w')
+
+        try:
+            results = batch.run_batch(thrower.Thrower(), batch_jobs,
+                    workers=jobs, report=report)
+        finally:
+            if report is not sys.stdout:
+                report.close()
+
+        failed = len([x for x in results if x['status'] != 'ok'])
+        if failed > 0:
+            self._interface.error('%s of %s batch job(s) failed.' % \
+                    (failed, len(results)))
 
     def set_identity(self):
+        import identity
         new_identity = identity.input_identity()
         new_identity.save_to_config()
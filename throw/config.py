@@ -1,11 +1,45 @@
 """Access the persistent configuration information."""
 
+import copy
+import errno
 import json
 import os
 import logging
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+# Python 2 has no os.replace() but os.rename() replaces an existing file
+# atomically on POSIX systems.
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+# Advisory file locks are only available on POSIX systems. Elsewhere only
+# the threads of one process are kept apart.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class Config(object):
+    """The configuration, loaded from disk once per process and re-loaded only
+    if the file has changed since. Changes are written to a temporary file
+    which is renamed over the configuration file so that it is never seen
+    half-written.
+
+    Several changes may be made at once by making them within a transaction:
+
+        with config.transaction():
+            config.set('user', 'name', name)
+            config.set('user', 'email', email)
+
+    """
+
     __instance = None
+    __lock = threading.RLock()
     __config_path = os.path.expanduser('~/.config/throw/throw.json')
     __log = logging.getLogger(__name__ + '.Config')
 
@@ -35,30 +69,251 @@ class Config(object):
                 'help': 'Authenticate to the SMTP server with this username',
                 'default': None },
         },
+        'email': {
+            'max_size': {
+                'help': 'The largest email, in bytes, to send files as '
+                        'attachments in; larger files are uploaded. By '
+                        'default the limit advertised by the SMTP server is '
+                        'used',
+                'default': None },
+        },
+        'upload': {
+            'backend': {
+                'help': 'Where to upload files too large to attach: "minus" '
+                        'for a min.us gallery or "s3" for the object store '
+                        'set by the s3 options',
+                'default': 'minus' },
+            'concurrency': {
+                'help': 'The number of files to upload at once to begin with',
+                'default': 4 },
+            'max_concurrency': {
+                'help': 'The most files to upload at once as the number is '
+                        'adjusted to the throughput achieved',
+                'default': 16 },
+        },
+        'transfer': {
+            'limit_rate': {
+                'help': 'The most bytes per second to send, shared by all '
+                        'uploads and emails, with an optional k, M or G '
+                        'suffix (default: no limit)',
+                'default': None },
+            'rate_schedule': {
+                'help': 'Other limits for times of day, such as '
+                        '"09:00-18:00=2M,18:00-09:00=20M"',
+                'default': None },
+        },
+        's3': {
+            'endpoint': {
+                'help': 'The URL of the S3-compatible service, such as '
+                        'https://s3.amazonaws.com, or of a HTTP server which '
+                        'accepts PUT, to upload to',
+                'default': None },
+            'bucket': {
+                'help': 'The bucket to upload to, if any',
+                'default': None },
+            'region': {
+                'help': 'The region of the bucket, used to sign requests',
+                'default': 'us-east-1' },
+            'access_key': {
+                'help': 'The access key id to sign requests with (default: '
+                        'do not sign requests)',
+                'default': None },
+            'secret_key': {
+                'help': 'The secret access key to sign requests with',
+                'default': None },
+            'prefix': {
+                'help': 'The prefix of the keys of uploaded files',
+                'default': 'throw' },
+            'public_url': {
+                'help': 'The URL under which uploaded files are linked to '
+                        '(default: the URL they were uploaded to)',
+                'default': None },
+            'multipart_threshold': {
+                'help': 'Files larger than this many bytes are uploaded in '
+                        'parts in parallel; 0 uploads every file whole, for '
+                        'servers without the S3 multipart API',
+                'default': 64 * 1024 * 1024 },
+            'part_size': {
+                'help': 'The size in bytes of the parts of a multipart '
+                        'upload, at least 5 MiB for S3',
+                'default': 16 * 1024 * 1024 },
+        },
+        'cache': {
+            'enabled': {
+                'help': 'Re-use previously uploaded files with identical '
+                        'contents instead of uploading them again',
+                'default': True },
+            'ttl_days': {
+                'help': 'Forget uploaded files after this many days',
+                'default': 30 },
+            'max_entries': {
+                'help': 'The maximum number of uploaded files to remember',
+                'default': 10000 },
+            'verify': {
+                'help': 'Check that a previously uploaded file still exists '
+                        'before re-using it',
+                'default': False },
+        },
+        'pack': {
+            'level': {
+                'help': 'The compression level, 1-9, used when packing files '
+                        'into an archive',
+                'default': 6 },
+            'workers': {
+                'help': 'The number of CPU cores to use when packing files '
+                        'into an archive (default: all of them)',
+                'default': None },
+        },
+        'encode': {
+            'workers': {
+                'help': 'The number of CPU cores to use when encoding large '
+                        'attachments (default: all of them)',
+                'default': None },
+        },
+        'walk': {
+            'workers': {
+                'help': 'The number of directories to list at once when '
+                        'finding files, useful for network file systems',
+                'default': 1 },
+        },
     }
 
     # Implement the singleton pattern
     def __new__(cls, *args, **kwargs):
-        if not cls.__instance:
-            cls._instance = super(Config, cls).\
-                __new__(cls, *args, **kwargs)
+        with cls.__lock:
+            if not cls.__instance:
+                cls.__instance = super(Config, cls).\
+                    __new__(cls, *args, **kwargs)
+                cls.__instance._config_dict = None
 
-        return cls._instance
+        return cls.__instance
 
     def __init__(self):
-        # Attempt to load the config file
+        # __init__ is run each time the singleton is asked for. Only read the
+        # config file if this is the first time or it has changed since.
+        with Config.__lock:
+            if self._config_dict is None:
+                self._transaction_depth = 0
+                self._load()
+            elif self._transaction_depth == 0:
+                self._reload_if_changed()
+
+    def _file_signature(self):
+        """Return the inode, modification time and size of the config file or
+        None if it does not exist. Each save makes a new inode.
+
+        """
+        try:
+            st = os.stat(Config.__config_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load(self):
+        self._signature = self._file_signature()
         try:
-            self._config_dict = json.load(open(Config.__config_path, 'r'))
+            with open(Config.__config_path, 'r') as fp:
+                self._config_dict = json.load(fp)
             Config.__log.info('Loaded configuration from %s' % (Config.__config_path,))
         except IOError:
             self._config_dict = { }
             Config.__log.info('Loaded blank configuration')
 
+    def _reload_if_changed(self):
+        if self._file_signature() != self._signature:
+            self._load()
+
     def _sync(self):
-        if not os.path.exists(os.path.dirname(Config.__config_path)):
-            os.makedirs(os.path.dirname(Config.__config_path))
-        fp = open(Config.__config_path, 'w')
-        json.dump(self._config_dict, fp, indent=4)
+        config_dir = os.path.dirname(Config.__config_path)
+        make_directory(config_dir)
+
+        # The temporary file must be in the same directory, and so on the same
+        # file system, for the rename to be atomic. It is only readable by the
+        # user since the configuration may include a password.
+        (fd, temp_path) = tempfile.mkstemp(prefix='.throw-', suffix='.json',
+                dir=config_dir)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(self._config_dict, fp, indent=4)
+                fp.flush()
+                os.fsync(fp.fileno())
+            _replace(temp_path, Config.__config_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        self._signature = self._file_signature()
+        Config.__log.info('Saved configuration to %s' % (Config.__config_path,))
+
+    @contextmanager
+    def transaction(self):
+        """Return a context manager within which calls to set() are only
+        written to disk, all at once, when the outermost transaction ends. If
+        the transaction ends with an exception, its changes are discarded.
+
+        Changes made by other processes since the configuration was loaded
+        are picked up at the start of the transaction. Other threads, and
+        other processes where advisory file locks are supported, wait for the
+        transaction to end before starting their own so that no change is
+        lost.
+
+        """
+        with Config.__lock:
+            if self._transaction_depth == 0:
+                # Once other processes are locked out the file is always read
+                # again since a file they replaced may have the same inode,
+                # modification time and size as the one loaded.
+                self._lock_file = self._acquire_file_lock()
+                if self._lock_file is not None:
+                    self._load()
+                else:
+                    self._reload_if_changed()
+                self._saved_dict = copy.deepcopy(self._config_dict)
+                self._dirty = False
+
+            self._transaction_depth += 1
+            try:
+                yield self
+            except:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    self._config_dict = self._saved_dict
+                    self._release_file_lock()
+                raise
+            else:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0:
+                    try:
+                        if self._dirty:
+                            self._sync()
+                    finally:
+                        self._release_file_lock()
+
+    def _acquire_file_lock(self):
+        """Take an exclusive advisory lock on a lock file beside the config
+        file, so that other processes cannot re-load, change and save the
+        configuration at the same time, and return the open lock file or
+        None if locking is not supported.
+
+        """
+        if fcntl is None:
+            return None
+
+        config_dir = os.path.dirname(Config.__config_path)
+        make_directory(config_dir)
+        lock_file = open(Config.__config_path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        except:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def _release_file_lock(self):
+        if self._lock_file is not None:
+            # Closing the file releases the lock.
+            self._lock_file.close()
+            self._lock_file = None
 
     def exists(self, section, option):
         if section not in self._config_dict:
@@ -96,8 +351,20 @@ class Config(object):
         raise KeyError('No fallback found for configuration option "%s.%s"' % (section, option))
     
     def set(self, section, option, value):
-        if section not in self._config_dict:
-            self._config_dict[section] = { }
+        with self.transaction():
+            if section not in self._config_dict:
+                self._config_dict[section] = { }
+
+            self._config_dict[section][option] = value
+            self._dirty = True
+
+def make_directory(path):
+    """Create the directory at path, and its parents, unless another process
+    has already done so. Python 2 has no exist_ok argument to os.makedirs().
 
-        self._config_dict[section][option] = value
-        self._sync()
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,227 @@
+"""Keep a min.us gallery in step with a collection of files which is thrown
+again and again under the same name, such as a nightly build directory.
+
+The first sync of a named collection uploads every file to a new gallery.
+Each later sync uploads only the files which are new or have changed, or
+whose items have gone from the gallery, and then saves the gallery once to
+put its items in the order of the files. A manifest records the gallery of
+each collection and the size, modification time, content hash and item of
+each file in it.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import httpsession
+import minus.minus as minus
+import profiling
+import uploadcache
+from config import make_directory
+
+DEFAULT_DIRECTORY = os.path.expanduser('~/.config/throw/collections')
+
+_log = logging.getLogger(__name__)
+
+# Python 2 has no os.replace() but os.rename() replaces an existing file
+# atomically on POSIX systems.
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+class Collection(object):
+    """The manifest of a named collection: the ids of its gallery and a
+    dictionary mapping the absolute path of each file synced to it to a
+    dictionary with the keys 'size', 'mtime', 'hash', 'id' and 'extension'.
+
+    """
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+        self.gallery = None
+        self.files = { }
+
+    @classmethod
+    def for_name(cls, name, directory=DEFAULT_DIRECTORY):
+        """Return the Collection for the given collection name."""
+        key = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return cls(os.path.join(directory, key + '.json'), name)
+
+    def load(self):
+        """Read the manifest, if it exists, and return True if it records a
+        gallery.
+
+        """
+        self.gallery = None
+        self.files = { }
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'r') as fp:
+                manifest = json.load(fp)
+        except ValueError as e:
+            _log.warning('Ignoring unreadable manifest %s: %s' % \
+                    (self.path, e))
+            return False
+
+        self.gallery = manifest.get('gallery')
+        self.files = manifest.get('files', { })
+        return self.gallery is not None
+
+    def save(self):
+        """Write the manifest to disk. It is written to a temporary file which
+        is renamed over the manifest so that it is never seen half-written.
+
+        """
+        directory = os.path.dirname(self.path)
+        make_directory(directory)
+
+        manifest = { 'name': self.name, 'gallery': self.gallery,
+                     'files': self.files }
+        (fd, temp_path) = tempfile.mkstemp(prefix='.throw-', suffix='.json',
+                dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(manifest, fp, indent=1, sort_keys=True)
+                fp.flush()
+                os.fsync(fp.fileno())
+            _replace(temp_path, self.path)
+        except:
+            os.remove(temp_path)
+            raise
+
+def plan_sync(entries, files, remote_items):
+    """Decide which of entries, a list of walker.FileEntry records, need to
+    be uploaded given files, the manifest records of the last sync, and
+    remote_items, the set of item ids in the gallery. Return a pair of lists
+    (records, uploads). records has, for each entry, the manifest record to
+    keep if it is unchanged or None if it must be uploaded, and uploads is
+    the list of entries to upload.
+
+    A file is unchanged if its item is still in the gallery and either its
+    size and modification time are the same as last time or its size and
+    content hash are. Only files whose modification time alone has changed
+    are hashed.
+
+    """
+    records = [ ]
+    uploads = [ ]
+    for entry in entries:
+        record = files.get(os.path.abspath(entry.path))
+        if record is not None and (record['id'] not in remote_items or
+                record['size'] != entry.size):
+            record = None
+
+        if record is not None and record['mtime'] != entry.mtime:
+            with profiling.span('cache.hash'):
+                digest = uploadcache.hash_file(entry.path)
+            if digest == record['hash']:
+                record = dict(record, mtime=entry.mtime)
+            else:
+                record = None
+
+        records.append(record)
+        if record is None:
+            uploads.append(entry)
+
+    return (records, uploads)
+
+def sync(entries, collection_name, concurrency=None, session=None,
+         cache=None, collection=None):
+    """Sync entries, a list of walker.FileEntry records, to the gallery of
+    the named collection and return a dictionary with the email linking to
+    every file, as minus_renderer.create_email() does, under 'message' and
+    the number and total size of the files uploaded under 'uploaded' and
+    'uploaded_bytes'.
+
+    The manifest is read from, and written to, collection or, if it is None,
+    the Collection for collection_name. If the server says the gallery it
+    records does not exist, a new one is created. Any other failure to fetch
+    the gallery is raised and the manifest is left as it was. The other
+    arguments are as for minus_renderer.create_email().
+
+    """
+    import minus_renderer
+    from terminalinterface import TerminalInterface
+
+    if session is None:
+        session = httpsession.default_session()
+    if collection is None:
+        collection = Collection.for_name(collection_name)
+
+    gallery = None
+    remote_items = set()
+    if collection.load():
+        gallery = minus.Gallery(collection.gallery['reader_id'],
+                editor_id=collection.gallery['editor_id'], session=session)
+        try:
+            with profiling.span('http.get_items'):
+                remote_items = set(gallery.GetItems()[1])
+        except httpsession.HTTPError as e:
+            # Only start again if the gallery has gone, not if the server
+            # could not be reached, since every file would be uploaded again.
+            if e.code != 404:
+                raise
+            _log.warning('Gallery %s has gone, creating a new one: %s' % \
+                    (gallery.reader_id, e))
+            gallery = None
+
+    if gallery is None:
+        with profiling.span('http.create_gallery'):
+            gallery = minus.CreateGallery(session=session)
+        collection.gallery = { 'reader_id': gallery.reader_id,
+                               'editor_id': gallery.editor_id }
+        collection.files = { }
+
+    (records, uploads) = plan_sync(entries, collection.files, remote_items)
+
+    interface = TerminalInterface()
+    interface.new_section()
+    interface.message(\
+        'Syncing %s file(s) to http://min.us/m%s: %s new or changed.' % \
+            (len(entries), gallery.reader_id, len(uploads)))
+
+    # Only items still in this gallery may be re-used from the cache since
+    # the gallery must end up containing every file. These are the uploads
+    # of an interrupted sync.
+    def reuse(cached):
+        return cached.reader_id == gallery.reader_id and \
+                cached.item_id in remote_items
+
+    uploaded = minus_renderer.upload_files([x.path for x in uploads],
+            gallery, concurrency=concurrency, session=session, cache=cache,
+            reuse=reuse)
+
+    uploaded = iter(zip(uploads, uploaded))
+    files = { }
+    item_map = [ ]
+    for (entry, record) in zip(entries, records):
+        if record is None:
+            (entry, (item_id, extension, digest)) = next(uploaded)
+            if digest is None:
+                with profiling.span('cache.hash'):
+                    digest = uploadcache.hash_file(entry.path)
+            record = { 'size': entry.size, 'mtime': entry.mtime,
+                       'hash': digest, 'id': item_id,
+                       'extension': extension }
+        files[os.path.abspath(entry.path)] = record
+        item_map.append((record['id'], record['extension'],
+            os.path.basename(entry.path)))
+
+    # Name the gallery and put its items in the order of the files in one go.
+    # Items of files which have changed or gone are left out.
+    with profiling.span('http.save_gallery'):
+        gallery.SaveGallery(collection_name, [x[0] for x in item_map])
+
+    collection.files = files
+    collection.save()
+
+    return { 'message': minus_renderer.links_email(gallery.reader_id, item_map),
+             'uploaded': len(uploads),
+             'uploaded_bytes': sum([x.size for x in uploads]) }
@@ -0,0 +1,580 @@
+"""Persistent HTTP connections for the upload backends.
+
+A Session keeps connections alive between requests and re-uses them so that a
+throw of many files pays for only a handful of TCP handshakes. Each request is
+subject to connect and read deadlines and one which fails is retried with
+exponential backoff if it may safely be sent again. The min.us API module and
+the S3 backend make all of their requests through a Session, and the asyncio
+engine applies the same retry rules through may_retry() and retry_delay().
+
+Where it is available, the pycurl module is used to make requests.
+
+"""
+
+import io
+import json
+import logging
+import random
+import select
+import socket
+import threading
+import time
+
+import ratelimit
+
+# Try to import PyCURL if we have it but silently swallow the exception if it
+# isn't available (such as with Python3...).
+try:
+    import pycurl
+except ImportError:
+    pass
+
+# This magic is to support the module re-naming that happened with the Python
+# 2->3 transition.
+try:
+    from urllib import urlencode
+    from urllib2 import HTTPError
+    from urlparse import urlsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.parse import urlencode, urlsplit
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+# Payloads are read from file objects and sent this many bytes at a time.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# A request fails if connecting takes longer than CONNECT_TIMEOUT seconds or if
+# nothing is sent or received for READ_TIMEOUT seconds, so that a stalled
+# transfer cannot hang a throw.
+CONNECT_TIMEOUT = 15
+READ_TIMEOUT = 60
+
+# A failed request which may safely be sent again is retried up to RETRIES
+# times. Before the n-th retry there is a random delay of up to
+# RETRY_DELAY * 2 ** n seconds, but no more than RETRY_MAX_DELAY, so that
+# clients which failed together do not retry together.
+RETRIES = 4
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+# Responses with these statuses mean that the server did not act on the
+# request and so it may be sent again whatever it was.
+_REFUSED_STATUSES = frozenset([429, 503])
+
+# Responses with these statuses mean that the request failed, perhaps part
+# way through, and so only idempotent requests are sent again.
+_FAILED_STATUSES = frozenset([500, 502, 504])
+
+_log = logging.getLogger(__name__)
+
+class Session(object):
+    """A pool of persistent HTTP connections. A Session may be shared between
+    threads: each concurrent request takes its own connection from the pool.
+
+    Counts of the requests made, of the connections opened and re-used and of
+    the retries made are available from stats().
+
+    Each request is subject to the connect_timeout and read_timeout
+    deadlines, in seconds. A request which fails is retried, up to retries
+    times with exponential backoff, if it may safely be sent again: if it
+    failed before the server could act on it or if it is idempotent.
+
+    Before each piece of a payload is sent, throttle is called with its size
+    and may wait to limit the rate of sending. By default uploads draw on the
+    limit shared with SMTP delivery through ratelimit.wait(). If throttle is
+    None, uploads are not limited.
+
+    """
+
+    def __init__(self, max_idle=8, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 throttle=ratelimit.wait):
+        """Initialise the session. At most max_idle idle connections to each
+        host are kept open for re-use.
+
+        """
+        self._max_idle = max_idle
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._retries = retries
+        self._throttle = throttle
+        self._lock = threading.Lock()
+
+        # Idle httplib connections keyed by (scheme, host[:port]) and idle
+        # pycurl handles, each of which has its own connection cache.
+        self._idle_connections = { }
+        self._idle_curls = [ ]
+
+        self._requests = 0
+        self._connections_opened = 0
+        self._connections_reused = 0
+        self._retries_made = 0
+
+    def stats(self):
+        """Return a dictionary with the number of requests made, the number
+        of connections opened and re-used and the number of retries made by
+        this session.
+
+        """
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'connections_opened': self._connections_opened,
+                'connections_reused': self._connections_reused,
+                'retries': self._retries_made,
+            }
+
+    def close(self):
+        """Close all idle connections held by this session."""
+        with self._lock:
+            connections = [c for l in self._idle_connections.values() for c in l]
+            curls = self._idle_curls
+            self._idle_connections = { }
+            self._idle_curls = [ ]
+
+        for conn in connections:
+            conn.close()
+        for c in curls:
+            c.close()
+
+    def get(self, url):
+        """Do a HTTP get and return the parsed JSON response."""
+        return self.request('GET', url, idempotent=True).json()
+
+    def post(self, url, params=None, payload=None, progress_cb=None,
+             payload_size=None, idempotent=False):
+        """Do a HTTP post to upload some data and return the parsed JSON
+        response. The params, a dictionary, are appended to url. The payload
+        and the other arguments are as for request().
+
+        """
+        if params:
+            encoded = urlencode(params)
+        else:
+            encoded = ''
+
+        url = str(url + encoded)
+
+        if payload is None:
+            payload = b''
+
+        return self.request('POST', url, payload,
+            headers={ 'Content-Type': 'application/x-www-form-urlencoded' },
+            progress_cb=progress_cb, payload_size=payload_size,
+            idempotent=idempotent).json()
+
+    def request(self, method, url, payload=None, headers=None,
+                progress_cb=None, payload_size=None, idempotent=False):
+        """Make a HTTP request with the given method and headers, a
+        dictionary, and return its Response. A HTTPError is raised unless
+        the response has a 2xx status.
+
+        If progress_cb is not None, it should be a callable which takes two
+        arguments: the number of bytes which have been uploaded and the total
+        number of bytes to upload. The callable is called periodically to
+        show the progress of the upload.
+
+        The payload may be None, a string or a file-like object. File-like
+        objects are read UPLOAD_CHUNK_SIZE bytes at a time and streamed to
+        the server so that the payload is never held in memory in its
+        entirety. If payload_size is None for a file-like object, the
+        payload is sent with chunked transfer-encoding. A file-like object
+        which cannot seek is only retried if the request failed before any
+        of it was read.
+
+        If idempotent is True, making the request twice has the same effect
+        as making it once and so it is retried however it failed.
+
+        """
+        if payload is not None and not hasattr(payload, 'read'):
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            payload_size = len(payload)
+            payload = io.BytesIO(payload)
+
+        return self._request(method, url, payload, payload_size,
+                headers or { }, progress_cb, idempotent)
+
+    def _request(self, method, url, payload, payload_size, headers,
+                 progress_cb, idempotent):
+        with self._lock:
+            self._requests += 1
+
+        # Remember where the payload started so that it can be re-sent.
+        try:
+            start = payload.tell()
+        except (AttributeError, IOError):
+            start = None
+
+        attempt = 0
+        while True:
+            try:
+                # Try to make use of PyCURL if we have it
+                try:
+                    pycurl
+                except NameError:
+                    return self._httplib_request(method, url, payload,
+                            payload_size, headers, progress_cb, start,
+                            idempotent)
+                return self._curl_request(method, url, payload, payload_size,
+                        headers, progress_cb)
+            except TransferError as e:
+                failure = e
+            if attempt >= self._retries or not may_retry(failure,
+                    idempotent, payload is None or start is not None):
+                raise failure.error
+
+            delay = retry_delay(failure, attempt)
+            _log.info('Retrying %s in %.1f s after: %s' % \
+                    (url.split('?')[0], delay, failure.error))
+            time.sleep(delay)
+
+            attempt += 1
+            with self._lock:
+                self._retries_made += 1
+            if payload is not None and start is not None:
+                payload.seek(start)
+
+    def _curl_request(self, method, url, payload, payload_size, headers,
+                      progress_cb):
+        with self._lock:
+            if len(self._idle_curls) > 0:
+                c = self._idle_curls.pop()
+            else:
+                c = pycurl.Curl()
+
+        response = [ ]
+        response_headers = { }
+        def append_header(line):
+            line = line.decode('latin-1')
+            if ':' in line:
+                (name, value) = line.split(':', 1)
+                response_headers[name.strip().lower()] = value.strip()
+
+        def progress(download_t, download_d, upload_t, upload_d):
+            if progress_cb is not None:
+                progress_cb(upload_d, upload_t)
+
+        header_lines = ['%s: %s' % x for x in headers.items()]
+        try:
+            c.setopt(pycurl.URL, url)
+            c.setopt(pycurl.CONNECTTIMEOUT, int(self._connect_timeout))
+            c.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+            c.setopt(pycurl.LOW_SPEED_TIME, int(self._read_timeout))
+            if payload is None:
+                c.setopt(pycurl.HTTPGET, 1)
+            else:
+                if method == 'PUT':
+                    c.setopt(pycurl.UPLOAD, 1)
+                    if payload_size is not None:
+                        c.setopt(pycurl.INFILESIZE_LARGE, payload_size)
+                else:
+                    c.setopt(pycurl.POST, 1)
+                    if payload_size is not None:
+                        c.setopt(pycurl.POSTFIELDSIZE_LARGE, payload_size)
+                c.setopt(pycurl.READFUNCTION,
+                        _throttled_read(payload, self._throttle))
+                if payload_size is None:
+                    header_lines.append('Transfer-Encoding: chunked')
+            if method not in ('GET', 'POST', 'PUT'):
+                c.setopt(pycurl.CUSTOMREQUEST, method)
+            c.setopt(pycurl.HTTPHEADER, header_lines)
+            c.setopt(pycurl.WRITEFUNCTION, response.append)
+            c.setopt(pycurl.HEADERFUNCTION, append_header)
+            c.setopt(pycurl.NOPROGRESS, 0)
+            c.setopt(pycurl.PROGRESSFUNCTION, progress)
+            c.perform()
+        except pycurl.error as e:
+            c.close()
+            # Only a failure to connect is sure to have sent nothing.
+            unsent = e.args[0] in (pycurl.E_COULDNT_RESOLVE_HOST,
+                    pycurl.E_COULDNT_CONNECT)
+            raise TransferError(IOError(*e.args), unsent=unsent,
+                    processed=not unsent)
+        except:
+            c.close()
+            raise
+
+        # The handle's connection cache survives reset() and so the handle can
+        # be re-used for the next request to the same host.
+        new_connections = c.getinfo(pycurl.NUM_CONNECTS)
+        status = c.getinfo(pycurl.RESPONSE_CODE)
+        c.reset()
+        with self._lock:
+            self._connections_opened += new_connections
+            if new_connections == 0:
+                self._connections_reused += 1
+            if len(self._idle_curls) < self._max_idle:
+                self._idle_curls.append(c)
+                c = None
+        if c is not None:
+            c.close()
+
+        return check_response(url, Response(status, 'HTTP error',
+            response_headers, b''.join(response)))
+
+    def _httplib_request(self, method, url, payload, payload_size, headers,
+                         progress_cb, start, idempotent):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            try:
+                conn, reused = self._acquire_connection(key)
+            except (HTTPException, IOError) as e:
+                raise TransferError(e, unsent=True, processed=False)
+
+            # Whether the whole request has been sent, in which case the
+            # server may have acted on it.
+            complete = [ False ]
+            try:
+                response, body = _send_request(conn, method, path, headers,
+                        payload, payload_size, progress_cb, self._throttle,
+                        complete)
+                break
+            except (HTTPException, IOError) as e:
+                conn.close()
+
+                # A kept-alive connection may have been closed by the server
+                # and so try again at once on a new connection. One which
+                # timed out was open but stalled. Once the whole request has
+                # been sent the server may have acted on it, so only an
+                # idempotent request is sent again here; the others are left
+                # to the retry policy of _request().
+                if reused and not isinstance(e, socket.timeout) and \
+                        (idempotent or not complete[0]) and \
+                        (payload is None or start is not None):
+                    if payload is not None:
+                        payload.seek(start)
+                    continue
+                raise TransferError(e, unsent=False, processed=complete[0])
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release_connection(key, conn)
+
+        return check_response(url, Response(response.status, response.reason,
+            dict([(k.lower(), v) for (k, v) in response.getheaders()]), body))
+
+    def _acquire_connection(self, key):
+        """Return a connection to the host identified by key and whether it
+        is a re-used connection.
+
+        """
+        while True:
+            with self._lock:
+                idle = self._idle_connections.get(key, [ ])
+                conn = None
+                if len(idle) > 0:
+                    conn = idle.pop()
+                else:
+                    self._connections_opened += 1
+            if conn is None:
+                break
+
+            # Skip connections the server has closed while they were idle so
+            # that requests which must not be sent twice rarely find out by
+            # failing.
+            if _is_dropped(conn):
+                conn.close()
+                continue
+            with self._lock:
+                self._connections_reused += 1
+            return (conn, True)
+
+        (scheme, netloc) = key
+        if scheme == 'https':
+            conn = HTTPSConnection(netloc, timeout=self._connect_timeout)
+        else:
+            conn = HTTPConnection(netloc, timeout=self._connect_timeout)
+
+        # The headers and the payload of a request are sent separately. Send
+        # each at once rather than holding back the payload until the server
+        # acknowledges the headers, which otherwise costs a delayed ACK per
+        # request.
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sock.settimeout(self._read_timeout)
+        return (conn, False)
+
+    def _release_connection(self, key, conn):
+        with self._lock:
+            idle = self._idle_connections.setdefault(key, [ ])
+            if len(idle) < self._max_idle:
+                idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+class Response(object):
+    """The status, reason, headers, a dictionary with lower case keys, and
+    body, a byte string, of a HTTP response.
+
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        """Return the body parsed as JSON."""
+        return json.loads(self.body.decode())
+
+class TransferError(Exception):
+    """A failed request which is raised by check_response() and within a
+    Session to decide whether to retry it. error is the exception to raise if
+    it is not retried. unsent is True if nothing was sent and processed is
+    True if the server may have acted on the request. If the server said how
+    long to wait before trying again, retry_after is the number of seconds.
+
+    """
+
+    def __init__(self, error, unsent, processed, retry_after=None):
+        Exception.__init__(self, error)
+        self.error = error
+        self.unsent = unsent
+        self.processed = processed
+        self.retry_after = retry_after
+
+def may_retry(failure, idempotent, rewindable):
+    """Return whether a request which failed with failure, a TransferError,
+    may be sent again: whether the server cannot have acted on it, or it is
+    idempotent, and whether its payload can be sent again, either because it
+    can be rewound or because none of it was sent.
+
+    """
+    return (idempotent or not failure.processed) and \
+            (failure.unsent or rewindable)
+
+def retry_delay(failure, attempt):
+    """Return the number of seconds to wait before sending a request again
+    after its attempt, counting from 0, failed with failure: a random time up
+    to a limit which grows exponentially with attempt or as long as the
+    server asked, if longer.
+
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt))
+    if failure.retry_after is not None:
+        delay = max(delay, min(RETRY_MAX_DELAY, failure.retry_after))
+    return delay
+
+def check_response(url, response):
+    """Return response, a Response to a request for url, if it succeeded or
+    raise a HTTPError, as a TransferError if the request may be retried.
+
+    """
+    if 200 <= response.status < 300:
+        return response
+
+    error = HTTPError(url, response.status, response.reason,
+            response.headers, io.BytesIO(response.body))
+    try:
+        retry_after = float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        retry_after = None
+
+    if error.code in _REFUSED_STATUSES:
+        raise TransferError(error, unsent=False, processed=False,
+                retry_after=retry_after)
+    if error.code in _FAILED_STATUSES:
+        raise TransferError(error, unsent=False, processed=True,
+                retry_after=retry_after)
+    raise error
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+def default_session():
+    """Return the Session used when none is passed explicitly."""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = Session()
+        return _default_session
+
+def _is_dropped(conn):
+    """Return whether the idle connection conn has been closed by the server.
+    An idle connection has nothing to read unless the server has closed it.
+
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return len(select.select([conn.sock], [ ], [ ], 0)[0]) > 0
+    except (select.error, ValueError):
+        return True
+
+def _throttled_read(payload, throttle):
+    """Return the read method of payload wrapped to call throttle, if it is
+    not None, with the size of each piece read.
+
+    """
+    if throttle is None:
+        return payload.read
+
+    def read(size):
+        data = payload.read(size)
+        throttle(len(data))
+        return data
+    return read
+
+def _send_request(conn, method, path, headers, payload, payload_size,
+                  progress_cb, throttle, complete):
+    """Send a request with the given method and headers and, if it is not
+    None, the contents of the file-like object payload over the httplib
+    connection conn, calling throttle, if it is not None, before each chunk
+    is sent and reporting progress after it. Return the response and its
+    body. The first element of the list complete is set to True once the
+    whole request has been sent.
+
+    """
+    if payload is None:
+        conn.request(method, path, headers=headers)
+        complete[0] = True
+        response = conn.getresponse()
+        return (response, response.read())
+
+    conn.putrequest(method, path)
+    for (name, value) in headers.items():
+        conn.putheader(name, value)
+    if payload_size is not None:
+        conn.putheader('Content-Length', str(payload_size))
+    else:
+        conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+
+    sent = 0
+    if progress_cb is not None:
+        progress_cb(0, payload_size or 0)
+
+    while True:
+        data = payload.read(UPLOAD_CHUNK_SIZE)
+        if not data:
+            break
+
+        if throttle is not None:
+            throttle(len(data))
+        if payload_size is None:
+            conn.send(('%x\r\n' % (len(data),)).encode('ascii'))
+            conn.send(data)
+            conn.send(b'\r\n')
+        else:
+            conn.send(data)
+
+        sent += len(data)
+        if progress_cb is not None:
+            progress_cb(sent, payload_size or sent)
+
+    if payload_size is None:
+        conn.send(b'0\r\n\r\n')
+    complete[0] = True
+
+    response = conn.getresponse()
+    return (response, response.read())
@@ -3,17 +3,28 @@
 import logging
 import sys
 import os
+import re
 import smtplib
+import socket
+import threading
+import time
 
+from collections import deque
 from copy import copy
 
 from email.utils import formataddr
-from email.mime.text import MIMEText
 
-from terminalinterface import TerminalInterface
 from config import Config
+import profiling
+import ratelimit
+
+# The terminal interface is only imported when the user is asked for
+# something, so that identities can be used by asyncthrow on Pythons which
+# lack the modules it needs.
 
 def get_default_identity():
+    from terminalinterface import TerminalInterface
+
     try:
         return load_identity()
     except KeyError:
@@ -26,17 +37,23 @@ def get_default_identity():
 
     return identity
 
-def load_identity(config = Config()):
+def load_identity(config = None):
     """Load the default identity from the configuration. If there is no default
     identity, a KeyError is raised.
     
     """
+    if config is None:
+        config = Config()
+
     return Identity(name = config.get('user', 'name'),
                     email_ = config.get('user', 'email'),
                     **config.get_section('smtp'))
 
-def input_identity(interface = TerminalInterface()):
+def input_identity(interface = None):
     """Get the full name, email address and SMTP information from the user."""
+    if interface is None:
+        from terminalinterface import TerminalInterface
+        interface = TerminalInterface()
 
     while True:
         identity = interface.input_fields("""
@@ -106,6 +123,11 @@ class Identity(object):
 
     __log = logging.getLogger(__name__ + '.Identity')
 
+    # The ESMTP extensions advertised by each SMTP server, keyed by host and
+    # port. See capabilities().
+    __capabilities = { }
+    __capabilities_lock = threading.Lock()
+
     def __init__(self, name, email_,
                  use_ssl = False, use_tls = False,
                  username = None, password = None, **kwargs):
@@ -124,10 +146,12 @@ class Identity(object):
             
         """
 
-        self._interface = TerminalInterface()
         self._name = name
         self._email = email_
 
+        # The SMTPSession used by sendmail(), if one is open.
+        self._session = None
+
         # Defaults
         self._smtp_vars = { 'host': None, 'port': None }
         self._use_ssl = use_ssl
@@ -154,6 +178,11 @@ class Identity(object):
             Identity.__log.info('Security credentials: username: %s, password: %s' % (
                 self._credentials[0], self._credentials[1] is not None))
     
+    @property
+    def _interface(self):
+        from terminalinterface import TerminalInterface
+        return TerminalInterface()
+
     def get_email(self):
         """Return the email address."""
         return self._email
@@ -172,32 +201,106 @@ class Identity(object):
     def sendmail(self, to, message):
         """Send mail to one or more recipients. The required arguments are a
         list of RFC 822 to-address strings (a bare string will be treated as a
-        list with 1 address), and a message string.
+        list with 1 address), and a message.
+
+        The message may be a string, an email.message.Message or an object
+        with an iter_bytes() method, such as
+        attachment_renderer.StreamingMessage. In the latter case the message
+        is written to the SMTP server a chunk at a time as it is generated.
+
+        The envelope is sent in one go if the server supports PIPELINING and
+        the message is sent in chunks with BDAT if it supports CHUNKING. If it
+        also supports BINARYMIME, attachments are sent without encoding them.
+
+        If a session opened with session() is active, the message is sent
+        through it. Otherwise a connection is made just for this message.
 
         """
+        session = self._session
+        if session is not None:
+            return session.sendmail(to, message)
 
-        # If we were passed a bare string as the To: address, convert it to
-        # a single element list.
-        if isinstance(to, str):
-            to = [ to, ]
+        # The session is not made the identity's own since other threads may
+        # be sending at the same time.
+        session = SMTPSession(self)
+        try:
+            return session.sendmail(to, message)
+        finally:
+            session.close()
 
-        # Send one email with the appropriate recipient list.
-        server = self._smtp_server()
-        server.sendmail(self.get_rfc2822_address(), to, message)
-        server.quit()
+    def capabilities(self):
+        """Return a dictionary of the ESMTP extensions advertised by the SMTP
+        server, in the form of smtplib's esmtp_features: lower-case extension
+        names mapping to their parameters. The result is cached for each host
+        and port for the life of the process.
 
-    def save_to_config(self, config = Config()):
-        config.set('user', 'name', self._name)
-        config.set('user', 'email', self._email)
+        If a session is open its connection is used, otherwise a connection
+        is made just to find the capabilities.
 
-        config.set('smtp', 'host', self._smtp_vars['host'])
-        config.set('smtp', 'port', self._smtp_vars['port'])
-        config.set('smtp', 'use_ssl', self._use_ssl)
-        config.set('smtp', 'use_tls', self._use_tls)
+        """
+        key = (self._smtp_vars['host'], self._smtp_vars['port'])
+        with Identity.__capabilities_lock:
+            if key in Identity.__capabilities:
+                return Identity.__capabilities[key]
+
+        session = self._session
+        if session is not None:
+            features = session.capabilities()
+        else:
+            session = SMTPSession(self)
+            try:
+                features = session.capabilities()
+            finally:
+                session.close()
+
+        Identity.__log.info('SMTP server capabilities: %s' % (features,))
+        with Identity.__capabilities_lock:
+            Identity.__capabilities[key] = features
+        return features
+
+    def max_message_size(self):
+        """Return the size in bytes of the largest message the SMTP server
+        will accept, as advertised with the ESMTP SIZE extension, or None if
+        the server does not advertise a limit.
 
-        if self._credentials is not None:
-            config.set('smtp', 'username', self._credentials[0])
-            config.set('smtp', 'password', self._credentials[1])
+        """
+        try:
+            size = int(self.capabilities().get('size', 0))
+        except ValueError:
+            size = 0
+
+        if size <= 0:
+            return None
+        return size
+
+    def session(self):
+        """Return a new SMTPSession for this identity. While the session is
+        open, as a context manager, sendmail() re-uses its connection::
+
+            with identity.session():
+                for message in messages:
+                    identity.sendmail(to, message)
+
+        """
+        return SMTPSession(self)
+
+    def save_to_config(self, config = None):
+        if config is None:
+            config = Config()
+
+        # Write all of the options to disk at once.
+        with config.transaction():
+            config.set('user', 'name', self._name)
+            config.set('user', 'email', self._email)
+
+            config.set('smtp', 'host', self._smtp_vars['host'])
+            config.set('smtp', 'port', self._smtp_vars['port'])
+            config.set('smtp', 'use_ssl', self._use_ssl)
+            config.set('smtp', 'use_tls', self._use_tls)
+
+            if self._credentials is not None:
+                config.set('smtp', 'username', self._credentials[0])
+                config.set('smtp', 'password', self._credentials[1])
 
         self._interface.new_section()
         self._interface.message("""
@@ -209,13 +312,13 @@ class Identity(object):
             %s --set identity""" % os.path.basename(sys.argv[0]))
 
     def send_test_email(self):
+        from email.mime.text import MIMEText
+
         message = MIMEText('This is an example email from throw.')
         message['Subject'] = 'A test email from throw'
         message['To'] = self.get_rfc2822_address()
         message['From'] = self.get_rfc2822_address()
 
-        import socket # for socket.error
-
         try:
             self.sendmail(
                 self.get_rfc2822_address(),
@@ -231,27 +334,451 @@ class Identity(object):
 
         return False
 
+    def smtp_settings(self):
+        """Return a dictionary describing how to connect to the SMTP server
+        with the keys 'host', 'port', 'use_ssl', 'use_tls', 'username' and
+        'password'. If a username is set but no password, the password is
+        asked for. The username and password are None if the server does not
+        need authentication.
+
+        """
+        settings = { 'host': self._smtp_vars['host'],
+                     'port': self._smtp_vars['port'],
+                     'use_ssl': self._use_ssl, 'use_tls': self._use_tls,
+                     'username': None, 'password': None }
+
+        if self._credentials is not None:
+            passwd = self._password()
+            self._credentials = (self._credentials[0], passwd)
+            settings['username'] = self._credentials[0]
+            settings['password'] = passwd
+
+        return settings
+
+    def _password(self):
+        passwd = self._credentials[1]
+        if passwd is None:
+            passwd = self._interface.input( \
+                'Password for %s' % (self._credentials[0],), no_echo=True)
+        return passwd
+
     def _smtp_server(self):
         """Return a smtplib SMTP object correctly initialised and connected to
         a SMTP server suitable for sending email on behalf of the user."""
 
-        if self._use_ssl:
-            server = smtplib.SMTP_SSL(**self._smtp_vars)
-        else:
-            server = smtplib.SMTP(**self._smtp_vars)
+        with profiling.span('smtp.connect'):
+            if self._use_ssl:
+                server = smtplib.SMTP_SSL(**self._smtp_vars)
+            else:
+                server = smtplib.SMTP(**self._smtp_vars)
+        profiling.count('smtp.connections')
 
         if self._use_tls:
-            server.starttls()
+            with profiling.span('smtp.starttls'):
+                server.starttls()
 
         if self._credentials is not None:
-            passwd = self._credentials[1]
-            if passwd is None:
-                passwd = self._interface.input( \
-                    'Password for %s' % (self._credentials[0],), no_echo=True)
-            server.login(*self._credentials)
+            passwd = self._password()
+            with profiling.span('smtp.auth'):
+                server.login(self._credentials[0], passwd)
 
             # if we succeeded, cache the password
             self._credentials = (self._credentials[0], passwd)
 
         return server
 
+
+class SMTPSession(object):
+    """A connection to the SMTP server of an Identity which is kept open and
+    authenticated across many messages. Before a connection which has been
+    idle for CHECK_INTERVAL seconds is re-used it is checked with NOOP and, if
+    the server has gone away, a new connection is made transparently. A
+    re-used connection which fails before the server accepts MAIL FROM is
+    also replaced; once it has been accepted the message may have been
+    delivered and so it is never sent again.
+
+    A session is a context manager which closes the connection on exit. It
+    may be shared between threads; messages are sent one at a time.
+
+    """
+
+    __log = logging.getLogger(__name__ + '.SMTPSession')
+
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, identity):
+        self._identity = identity
+        self._server = None
+        self._last_used = None
+        self._lock = threading.RLock()
+
+        # Whether the server has accepted MAIL FROM for the message being
+        # sent.
+        self._accepted = False
+
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    def __enter__(self):
+        # Make this the session used by the identity unless one is already
+        # open.
+        if self._identity._session is None:
+            self._identity._session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._identity._session is self:
+            self._identity._session = None
+        self.close()
+        return False
+
+    def sendmail(self, to, message):
+        """Send message to the recipients in to. The arguments are as for
+        Identity.sendmail().
+
+        """
+
+        # If we were passed a bare string as the To: address, convert it to
+        # a single element list.
+        if isinstance(to, str):
+            to = [ to, ]
+
+        with self._lock:
+            while True:
+                (server, reused) = self._connection()
+                self._accepted = False
+                try:
+                    with profiling.span('smtp.send'):
+                        senderrs = self._send(server, to, message)
+                    break
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    # A re-used connection may have been dropped by the server
+                    # since the last check, try once more with a new one. If
+                    # MAIL FROM was accepted, it was not stale.
+                    self._discard()
+                    if not reused or self._accepted:
+                        raise
+                    SMTPSession.__log.info('Server disconnected, reconnecting.')
+
+            self._last_used = time.time()
+            self.messages_sent += 1
+            profiling.count('smtp.messages')
+            return senderrs
+
+    def capabilities(self):
+        """Return the ESMTP extensions advertised by the server. See
+        Identity.capabilities().
+
+        """
+        with self._lock:
+            (server, reused) = self._connection()
+            server.ehlo_or_helo_if_needed()
+            return dict(server.esmtp_features)
+
+    def close(self):
+        """Close the connection to the server, if there is one."""
+        with self._lock:
+            if self._server is None:
+                return
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, socket.error):
+                self._server.close()
+            self._server = None
+
+    def _send(self, server, to, message):
+        from_addr = self._identity.get_rfc2822_address()
+        server.ehlo_or_helo_if_needed()
+
+        # Without PIPELINING each BDAT chunk would cost a round trip, which
+        # is only worth it to send attachments unencoded.
+        chunking = server.has_extn('chunking')
+        chunked = chunking and server.has_extn('pipelining')
+
+        mail_options = [ ]
+        if hasattr(message, 'encoded_size'):
+            # Attachments may be sent without encoding them if the server
+            # accepts 8 bit data or, with BDAT, binary data.
+            message.allow_8bit = server.has_extn('8bitmime')
+            message.allow_binary = chunking and server.has_extn('binarymime')
+
+            # Declare the size of the message, if we know it, so that the
+            # server can refuse it before we send it.
+            size = message.encoded_size()
+            if size is not None and server.has_extn('size'):
+                mail_options.append('SIZE=%d' % (size,))
+            if message.uses_binary():
+                mail_options.append('BODY=BINARYMIME')
+                chunked = True
+            elif message.uses_8bit():
+                mail_options.append('BODY=8BITMIME')
+
+        if hasattr(message, 'iter_bytes'):
+            if chunked and hasattr(message, 'iter_wire'):
+                chunks = message.iter_wire()
+            elif chunked:
+                chunks = crlf_stream(message.iter_bytes())
+            else:
+                chunks = message.iter_bytes()
+            return _sendmail_stream(server, from_addr, to, chunks,
+                    mail_options, chunked, self._mail_accepted)
+
+        if not isinstance(message, str):
+            message = message.as_string()
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        message = b''.join(crlf_stream([ message ]))
+        if server.has_extn('size'):
+            mail_options.append('SIZE=%d' % (len(message),))
+        return _sendmail_stream(server, from_addr, to, [ message ],
+                mail_options, chunked, self._mail_accepted)
+
+    def _mail_accepted(self):
+        self._accepted = True
+
+    def _connection(self):
+        """Return a connected server and whether it is a re-used connection."""
+        if self._server is not None and \
+                time.time() - self._last_used > SMTPSession.CHECK_INTERVAL:
+            if not self._is_alive():
+                SMTPSession.__log.info('Connection has gone stale.')
+                self._discard()
+
+        if self._server is not None:
+            return (self._server, True)
+
+        self._server = self._identity._smtp_server()
+        self._last_used = time.time()
+        self.connections_opened += 1
+        return (self._server, False)
+
+    def _is_alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _discard(self):
+        if self._server is not None:
+            self._server.close()
+        self._server = None
+
+# Matches any of the line endings which need to be converted to CRLF.
+_EOL_RE = re.compile(b'(?:\r\n|\n|\r(?!\n))')
+
+# Messages sent with BDAT are cut into chunks of this many bytes.
+BDAT_CHUNK_SIZE = 1024 * 1024
+
+# When the server supports PIPELINING, at most this many BDAT chunks are sent
+# ahead of the replies to them so that a refusal is noticed promptly.
+MAX_UNACKED_CHUNKS = 4
+
+def crlf_stream(chunks):
+    """Yield the byte strings in chunks with line endings converted to CRLF.
+    This copes with line endings which straddle two chunks.
+
+    """
+    carry = b''
+
+    for chunk in chunks:
+        data = carry + chunk
+
+        # A trailing CR may be the first half of a CRLF.
+        if data.endswith(b'\r'):
+            carry = b'\r'
+            data = data[:-1]
+        else:
+            carry = b''
+
+        if len(data) > 0:
+            yield _EOL_RE.sub(b'\r\n', data)
+
+    if len(carry) > 0:
+        yield b'\r\n'
+
+def quote_data_stream(chunks):
+    """Yield the byte strings in chunks with line endings converted to CRLF and
+    lines beginning with a '.' escaped as required for the SMTP DATA command.
+    This is the streaming equivalent of smtplib.quotedata() and must cope with
+    line endings which straddle two chunks.
+
+    """
+    at_line_start = True
+
+    for data in crlf_stream(chunks):
+        data = data.replace(b'\n.', b'\n..')
+        if at_line_start and data.startswith(b'.'):
+            data = b'.' + data
+
+        at_line_start = data.endswith(b'\n')
+        yield data
+
+    # The end-of-data marker must start on a line of its own.
+    if not at_line_start:
+        yield b'\r\n'
+
+def bdat_chunks(chunks, size=BDAT_CHUNK_SIZE):
+    """Yield the byte strings in chunks regrouped into (data, last) pairs
+    where data is size bytes long, except in the last pair, for which last is
+    True. The last data is only empty if the whole message is.
+
+    """
+    pending = [ ]
+    pending_size = 0
+
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size <= size:
+            continue
+
+        data = b''.join(pending)
+        offset = 0
+        while len(data) - offset > size:
+            yield (data[offset:offset + size], False)
+            offset += size
+        pending = [ data[offset:] ]
+        pending_size = len(pending[0])
+
+    yield (b''.join(pending), True)
+
+class _Pipeline(object):
+    """The commands of a SMTP transaction, which are sent to the server all
+    at once if pipelined is True and one at a time, as each reply is asked
+    for, if not.
+
+    """
+
+    def __init__(self, server, commands, pipelined):
+        self._server = server
+        self._commands = deque(commands)
+        self._pipelined = pipelined
+
+        if pipelined:
+            server.send(''.join([x + '\r\n' for x in commands]))
+            profiling.count('smtp.pipelined', len(commands))
+
+    def reply(self):
+        """Return the reply to the next command."""
+        command = self._commands.popleft()
+        if not self._pipelined:
+            self._server.putcmd(command)
+        return self._server.getreply()
+
+    def abort(self):
+        """Read the replies to any commands already sent and reset the
+        transaction.
+
+        """
+        while self._pipelined and len(self._commands) > 0:
+            self._commands.popleft()
+            (code, resp) = self._server.getreply()
+
+            # A server may start a DATA command despite refusing every
+            # recipient. End it at once.
+            if code == 354:
+                self._server.send(b'.\r\n')
+                self._server.getreply()
+        self._commands.clear()
+        self._server.rset()
+
+def _sendmail_stream(server, from_addr, to_addrs, chunks, mail_options=(),
+                     chunked=False, accepted_cb=None):
+    """Send a message, given as an iterable of byte strings, to the connected
+    smtplib.SMTP server. This mirrors smtplib.SMTP.sendmail() except that the
+    message is never held in memory in its entirety.
+
+    If the server supports PIPELINING, the MAIL and RCPT commands, and DATA
+    unless chunked is True, are sent together. If chunked is True, the
+    message is sent with BDAT, which the server must support, and the chunks
+    must already have CRLF line endings.
+
+    If accepted_cb is not None, it is called with no arguments once the
+    server has accepted MAIL FROM.
+
+    """
+    server.ehlo_or_helo_if_needed()
+
+    commands = [ 'mail FROM:%s%s' % (smtplib.quoteaddr(from_addr),
+        ''.join([' ' + x for x in mail_options])) ]
+    commands.extend(['rcpt TO:%s' % (smtplib.quoteaddr(x),) for x in to_addrs])
+    if not chunked:
+        commands.append('data')
+
+    pipelined = server.has_extn('pipelining')
+    pipeline = _Pipeline(server, commands, pipelined)
+
+    (code, resp) = pipeline.reply()
+    if code != 250:
+        pipeline.abort()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    if accepted_cb is not None:
+        accepted_cb()
+
+    senderrs = { }
+    for addr in to_addrs:
+        (code, resp) = pipeline.reply()
+        if code not in (250, 251):
+            senderrs[addr] = (code, resp)
+    if len(senderrs) == len(to_addrs):
+        pipeline.abort()
+        raise smtplib.SMTPRecipientsRefused(senderrs)
+
+    if chunked:
+        _send_chunks(server, chunks, pipelined)
+        return senderrs
+
+    (code, resp) = pipeline.reply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    sent = 0
+    for data in quote_data_stream(chunks):
+        for piece in ratelimit.pieces(data):
+            ratelimit.wait(len(piece))
+            server.send(piece)
+        sent += len(data)
+    server.send(b'.\r\n')
+    profiling.count('smtp.bytes', sent)
+
+    (code, resp) = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    return senderrs
+
+def _send_chunks(server, chunks, pipelined):
+    """Send a message, given as an iterable of byte strings with CRLF line
+    endings, with BDAT commands. If pipelined is True, up to
+    MAX_UNACKED_CHUNKS chunks are sent before waiting for the reply to the
+    first of them.
+
+    """
+    unacked = 0
+    sent = 0
+    for (data, last) in bdat_chunks(chunks):
+        if last:
+            command = 'BDAT %d LAST\r\n' % (len(data),)
+        else:
+            command = 'BDAT %d\r\n' % (len(data),)
+
+        # The command goes in the same packet as the start of its data.
+        for piece in ratelimit.pieces(command.encode('ascii') + data):
+            ratelimit.wait(len(piece))
+            server.send(piece)
+        profiling.count('smtp.chunks')
+        sent += len(data)
+        unacked += 1
+
+        while unacked > 0 and (last or not pipelined or
+                unacked > MAX_UNACKED_CHUNKS):
+            (code, resp) = server.getreply()
+            unacked -= 1
+            if code != 250:
+                for _ in range(unacked):
+                    server.getreply()
+                server.rset()
+                raise smtplib.SMTPDataError(code, resp)
+    profiling.count('smtp.bytes', sent)
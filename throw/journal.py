@@ -0,0 +1,134 @@
+"""A crash-safe record of the progress of a throw via min.us so that an
+interrupted throw can be resumed without uploading everything again.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+DEFAULT_DIRECTORY = os.path.expanduser('~/.config/throw/journals')
+
+_log = logging.getLogger(__name__)
+
+class Journal(object):
+    """An append-only journal of the min.us gallery created for a throw and
+    of each file uploaded to it. Each record is flushed and synced to disk as
+    soon as it is written so that the journal survives the process being
+    killed at any point.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+
+    @classmethod
+    def for_job(cls, filepaths, collection_name, backend='minus',
+                directory=DEFAULT_DIRECTORY):
+        """Return the Journal for throwing filepaths with the given collection
+        name to the named upload backend. The same set of files, name and
+        backend always maps to the same journal, and a throw to one backend
+        never resumes from the journal of a throw to another.
+
+        """
+        key = hashlib.sha1()
+        key.update(repr(collection_name).encode('utf-8'))
+        key.update(b'\0')
+        key.update(backend.encode('utf-8'))
+        for path in sorted([os.path.abspath(x) for x in filepaths]):
+            key.update(b'\0')
+            key.update(path.encode('utf-8'))
+        return cls(os.path.join(directory, key.hexdigest() + '.journal'))
+
+    def load(self):
+        """Read the records in the journal, if it exists, and return True if
+        there is a gallery to resume.
+
+        """
+        self._reset()
+        if not os.path.exists(self.path):
+            return False
+
+        # The length of the journal up to the end of the last complete record.
+        complete_length = 0
+
+        with open(self.path, 'r') as fp:
+            for line in fp:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('No end of line')
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may have been cut short by a crash.
+                    _log.info('Ignoring incomplete journal record.')
+                    break
+
+                complete_length += len(line)
+                if 'gallery' in record:
+                    self.gallery = record['gallery']
+                elif 'item' in record:
+                    self.items[record['item']['path']] = record['item']
+
+        # Remove any incomplete record so that new records are not appended
+        # to it.
+        with open(self.path, 'a') as fp:
+            fp.truncate(complete_length)
+
+        _log.info('Loaded journal %s with %s completed item(s).' % \
+                (self.path, len(self.items)))
+        return self.gallery is not None
+
+    def discard(self):
+        """Delete the journal from disk and forget its records."""
+        self._reset()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record_gallery(self, gallery):
+        """Record the ids of gallery, a minus.Gallery or another destination
+        with reader_id and editor_id attributes such as an
+        s3_renderer.Folder.
+
+        """
+        self.gallery = { 'reader_id': gallery.reader_id,
+                         'editor_id': gallery.editor_id }
+        self._append({ 'gallery': self.gallery })
+
+    def record_item(self, path, size, mtime, item_id, extension):
+        """Record that the file at path, with the given size and mtime, has
+        been uploaded as item_id.
+
+        """
+        item = { 'path': os.path.abspath(path), 'size': size, 'mtime': mtime,
+                 'id': item_id, 'extension': extension }
+        self._append({ 'item': item })
+        with self._lock:
+            self.items[item['path']] = item
+
+    def completed(self, path, size, mtime):
+        """Return the recorded item for the file at path or None if it has
+        not been uploaded or has changed since it was.
+
+        """
+        with self._lock:
+            item = self.items.get(os.path.abspath(path))
+        if item is None or item['size'] != size or item['mtime'] != mtime:
+            return None
+        return item
+
+    def _reset(self):
+        self.gallery = None
+        self.items = { }
+
+    def _append(self, record):
+        with self._lock:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
@@ -1,8 +1,8 @@
 """min.us support module.
 
 This code is based on the code from http://code.google.com/p/python-minus/ but
-has been modified to be Python3 friendly and, where it is available, to make
-use of the pycurl module.
+has been modified to be Python3 friendly and to make its requests through the
+persistent connections of an httpsession.Session.
 
 We don't make use of the user login feature of min.us and so that code has been
 stripped out to make maintainance easier.
@@ -10,32 +10,31 @@ stripped out to make maintainance easier.
 """
 
 import mimetypes
-import json
-
-# Try to import PyCURL if we have it but silently swallow the exception if it
-# isn't available (such as with Python3...).
-try:
-    import pycurl
-except ImportError:
-    pass
-
-# This magic is to support the module re-naming that happened with the Python
-# 2->3 transition.
-try:
-    from urllib import urlencode
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
-    from urllib.parse import urlencode
+import logging
+import os
+
+import httpsession
+
+# The base URL of the min.us API. This may be changed to point at another
+# server implementing the same API, such as a stand-in used for testing.
+API_URL = 'http://min.us/api/'
+
+_log = logging.getLogger(__name__)
 
 class Gallery(object):
     """Represents a min.us Gallery"""
     def __init__(self, reader_id, editor_id=None, name=None, last_visit=None, \
-                 item_count=None, clicks=None):
+                 item_count=None, clicks=None, session=None):
         self.editor_id = editor_id
         self.reader_id = reader_id
         self.name = name
 
+        # The HTTP session used for all requests made on behalf of this
+        # gallery and its items.
+        if session is None:
+            session = httpsession.default_session()
+        self.session = session
+
         # attributes to be used by the User.MyGalleries() method
         self.last_visit = last_visit
         self.item_count = item_count
@@ -47,8 +46,8 @@ class Gallery(object):
 
     def GetItems(self):
         """Updates self.name and self.items and returns (self.name, self.items)"""
-        url = 'http://min.us/api/GetItems/' + 'm' + self.reader_id
-        response = _doget(url)
+        url = API_URL + 'GetItems/' + 'm' + self.reader_id
+        response = self.session.get(url)
 
         self.name = response["GALLERY_TITLE"]
 
@@ -63,7 +62,7 @@ class Gallery(object):
         """Use this to update the gallery name or change sort order.
         Specify which attribute (name or items or both) you want to change."""
 
-        url = 'http://min.us/api/SaveGallery'
+        url = API_URL + 'SaveGallery?'
 
         if not name:
             if not self.name:
@@ -79,10 +78,12 @@ class Gallery(object):
 
         params = {"name": name, "id":self.editor_id, "items":items}
 
+        # Failing to save the gallery is not fatal since its items are still
+        # there to be linked to.
         try:
-            response = _dopost(url, params)
-        except:
-            pass
+            response = self.session.post(url, params, idempotent=True)
+        except (httpsession.HTTPException, IOError, ValueError) as e:
+            _log.warning('Could not save gallery %s: %s' % (self.reader_id, e))
         else:
             self.name = name
             self.items = items
@@ -99,23 +100,31 @@ class Item(object):
         self.filesize = filesize
 
 
-def CreateGallery():
+def CreateGallery(session=None):
     """Creates a Gallery on the server. Returns a Gallery object with the
-    editor_id and reader_id.
+    editor_id and reader_id. The gallery makes all of its requests through
+    session, a httpsession.Session, or, if it is None, through the default
+    Session.
 
     """
-    url = 'http://min.us/api/CreateGallery'
+    url = API_URL + 'CreateGallery'
+
+    if session is None:
+        session = httpsession.default_session()
 
-    response = _dopost(url)
+    response = session.post(url)
 
     _editor_id = response["editor_id"]
     _reader_id = response["reader_id"]
 
-    return Gallery(_reader_id, editor_id=_editor_id)
+    return Gallery(_reader_id, editor_id=_editor_id, session=session)
 
 
-def UploadItem(filename, gallery, desiredName=None, progress_cb=None):
-    """filename is the full file location and name of the file
+def UploadItem(filename, gallery, desiredName=None, progress_cb=None,
+               session=None):
+    """filename is the full file location and name of the file or a file-like
+    object from which to read the item. In the latter case the size of the
+    item need not be known in advance.
     WARNING: If your desiredName doesn't have a proper file extension (SHOULD
     be the same as the filename) it'll still upload, but you won't be able to
     download it or view it online. You can edit the name later to add the
@@ -123,14 +132,17 @@ def UploadItem(filename, gallery, desiredName=None, progress_cb=None):
     extension after that.
 
     If progress_cb is not None, it should be a callable which takes two
-    arguments: the total number of bytes to upload and the number of bytes
-    which have been uploaded. The callable is called periodically to show the
+    arguments: the number of bytes which have been uploaded and the total
+    number of bytes to upload. The callable is called periodically to show the
     progress of the upload.
 
+    The upload is made through session or, if it is None, through the session
+    of gallery.
+
     """
 
     # Must have the ? because urlencode doesn't add that on itself
-    url = 'http://min.us/api/UploadItem?'
+    url = API_URL + 'UploadItem?'
 
     if desiredName:
         name = desiredName
@@ -139,11 +151,18 @@ def UploadItem(filename, gallery, desiredName=None, progress_cb=None):
 
     params = {"editor_id":gallery.editor_id, "filename":name}
 
-    with open(filename, 'rb') as f:
-        itemData = f.read()
+    if session is None:
+        session = gallery.session
 
-    response = _dopost(url, params=params,
-            payload=itemData, progress_cb=progress_cb)
+    # Stream the file from disk rather than reading it into memory.
+    if hasattr(filename, 'read'):
+        response = session.post(url, params=params, payload=filename,
+                progress_cb=progress_cb)
+    else:
+        with open(filename, 'rb') as f:
+            response = session.post(url, params=params, payload=f,
+                    payload_size=os.fstat(f.fileno()).st_size,
+                    progress_cb=progress_cb)
 
     _id = response["id"]
     _height = response["height"]
@@ -153,63 +172,13 @@ def UploadItem(filename, gallery, desiredName=None, progress_cb=None):
     return Item(_id, height=_height, width=_width, filesize=_filesize)
 
 def _doget(url):
-    response = urlopen(url)
-    return _parseResponse(response)
-
+    return httpsession.default_session().get(url)
 
-def _dopost(url, params=None, payload=None, progress_cb=None):
-    """Do a HTTP post to upload some data. If progress_cb is not None, it
-    should be a callable which takes two arguments: the total number of bytes
-    to upload and the number of bytes which have been uploaded. The callable is
-    called periodically to show the progress of the upload.
+def _dopost(url, params=None, payload=None, progress_cb=None,
+            payload_size=None):
+    """Do a HTTP post through the default Session. See
+    httpsession.Session.post().
 
     """
-    if params:
-        encoded = urlencode(params)
-    else:
-        encoded = ''
-
-    url = str(url + encoded)
-
-    if payload is None:
-        payload = ''
-
-    # Try to make use of PyCURL if we have it
-    try:
-        c = pycurl.Curl()
-    except NameError:
-        c = None
-
-    if c is not None:
-        response = [ ]
-        def append_to_response(buf):
-            response.append(buf.decode())
-
-        def progress(download_t, download_d, upload_t, upload_d):
-            if progress_cb is not None:
-                progress_cb(upload_d, upload_t)
-
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, url)
-        c.setopt(pycurl.POST, 1)
-        c.setopt(pycurl.POSTFIELDS, payload)
-        c.setopt(pycurl.INFILESIZE, len(payload))
-        c.setopt(pycurl.WRITEFUNCTION, append_to_response)
-        c.setopt(pycurl.NOPROGRESS, 0)
-        c.setopt(pycurl.PROGRESSFUNCTION, progress)
-        c.perform()
-        c.close()
-
-        return json.loads(''.join(response))
-    else:
-        if progress_cb is not None:
-            progress_cb(0, len(payload))
-        response = [x.decode() for x in urlopen(url, payload).readlines()]
-        if progress_cb is not None:
-            progress_cb(len(payload), len(payload))
-        return json.loads(''.join(response))
-
-def _parseResponse(response):
-    # response.readlines() is a list of many parts of the json.
-    return json.loads(''.join([x.decode() for x in response.readlines()]))
-
+    return httpsession.default_session().post(url, params, payload,
+            progress_cb, payload_size)
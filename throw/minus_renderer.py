@@ -1,46 +1,273 @@
 import os
+import logging
 from email.mime.text import MIMEText
 
+# Under Python 2 this is provided by the 'futures' backport.
+from concurrent.futures import ThreadPoolExecutor
+
+import httpsession
 import minus.minus as minus
-from terminalinterface import TerminalInterface
+import transferlimit
+import uploadcache
+import profiling
+from config import Config
+
+_log = logging.getLogger(__name__)
 
-def create_email(filepaths, collection_name):
+def create_email(filepaths, collection_name, concurrency=None, session=None,
+                 cache=None, journal=None):
     """Create an email message object which implements the
     email.message.Message interface and which has the files to be shared
     uploaded to min.us and links placed in the message body.
 
+    At first concurrency files are uploaded at once. If concurrency is None,
+    the 'upload.concurrency' configuration option is used. The number is
+    then adjusted to the throughput achieved, up to the
+    'upload.max_concurrency' configuration option. The links in the message
+    body are always in the same order as filepaths.
+
+    All requests are made through the httpsession.Session session, or the
+    default session if it is None, so that connections are re-used between
+    uploads.
+
+    Files whose contents are found in cache, an uploadcache.UploadCache, are
+    not uploaded again: the link to the existing item is used instead. If
+    cache is None, one is opened if the 'cache.enabled' configuration option
+    is set.
+
+    If journal, a journal.Journal, is not None, the gallery and each
+    uploaded file are recorded in it as they are created. If the journal
+    already records a gallery, that gallery is re-used and the files which
+    were recorded as uploaded, and which have not changed since, are
+    skipped.
+
+    As well as paths, filepaths may contain objects, such as a
+    packer.Archive, with a name attribute and an open() method returning a
+    file-like object. These are streamed to min.us as they are read and are
+    never cached or journalled.
+
     """
-    gallery = minus.CreateGallery()
+    if session is None:
+        session = httpsession.default_session()
+
+    if journal is not None and journal.gallery is not None:
+        gallery = minus.Gallery(journal.gallery['reader_id'],
+                editor_id=journal.gallery['editor_id'], session=session)
+    else:
+        with profiling.span('http.create_gallery'):
+            gallery = minus.CreateGallery(session=session)
+        if journal is not None:
+            journal.record_gallery(gallery)
+
+        if collection_name is not None:
+            with profiling.span('http.save_gallery'):
+                gallery.SaveGallery(collection_name)
 
-    if collection_name is not None:
-        gallery.SaveGallery(collection_name)
+    from terminalinterface import TerminalInterface
 
     interface = TerminalInterface()
     interface.new_section()
     interface.message(\
-        'Uploading files to http://min.us/m%s...' % (gallery.reader_id,))
+        'Uploading %s file(s) to http://min.us/m%s...' % \
+            (len(filepaths), gallery.reader_id))
+
+    items = upload_files(filepaths, gallery, concurrency=concurrency,
+            session=session, cache=cache, journal=journal)
+
+    item_map = [ ]
+    for (item, extension, digest), path in zip(items, filepaths):
+        item_map.append((item, extension, _name(path)))
+
+    return links_email(gallery.reader_id, item_map)
 
-    item_map = { }
+def upload_files(filepaths, gallery, concurrency=None, session=None,
+                 cache=None, journal=None, reuse=None):
+    """Upload filepaths to gallery, a minus.Gallery, showing the progress of
+    each, and return a list with an (item id, extension, digest) tuple for
+    each file in the order of filepaths. The extension is the one the item
+    was uploaded with and the digest is the hash of the file's contents or
+    None if it was not needed.
+
+    The arguments are as for create_email(). Files found in the cache are
+    not uploaded again unless reuse is not None and returns False when
+    called with the cached uploadcache.CachedItem.
+
+    """
+    config = Config()
+
+    if concurrency is None:
+        concurrency = config.get('upload', 'concurrency')
+    concurrency = max(1, int(concurrency))
+
+    if session is None:
+        session = gallery.session
+    session_stats = session.stats()
+
+    # Retries made by the session are a sign of overload as much as uploads
+    # which fail outright.
+    limit = transferlimit.AdaptiveLimit(concurrency,
+            maximum=max(concurrency, int(config.get('upload',
+                'max_concurrency'))),
+            errors=lambda: session.stats()['retries'])
+
+    verify = config.get('cache', 'verify')
+    close_cache = False
+    if cache is None:
+        cache = _open_cache(config)
+        close_cache = cache is not None
+
+    stats = [ ]
     for path in filepaths:
-        interface.message('Uploading %s...' % (os.path.basename(path),))
-        interface.start_progress()
-        item = minus.UploadItem(path, gallery,
-                os.path.basename(path), interface.update_progress)
-        interface.end_progress()
-        item_map[item.id] = os.path.basename(path)
+        if hasattr(path, 'open'):
+            stats.append(None)
+        else:
+            stats.append(os.stat(path))
+    sizes = [_size(x) for x in stats]
+
+    def upload(index):
+        """Upload the index-th file, unless it is in the cache, and return
+        its item id, the extension it was uploaded with and its digest.
+
+        """
+        path = filepaths[index]
+        transfer = transfers[index]
+
+        if stats[index] is None:
+            fp = path.open()
+            try:
+                with limit.slot() as done:
+                    with profiling.span('http.upload'):
+                        item = minus.UploadItem(fp, gallery, path.name,
+                                transfer.update, session=session)
+                    done(transfer.done)
+            finally:
+                fp.close()
+            profiling.count('http.upload_bytes', transfer.done)
+            transfer.finish()
+            return (item.id, os.path.splitext(path.name)[1], None)
 
+        extension = os.path.splitext(path)[1]
+
+        if journal is not None:
+            completed = journal.completed(path, sizes[index],
+                    stats[index].st_mtime)
+            if completed is not None:
+                _log.info('Already uploaded %s.' % (path,))
+                transfer.update(sizes[index], sizes[index])
+                transfer.finish()
+                return (completed['id'], completed['extension'], None)
+
+        digest = None
+        if cache is not None:
+            with profiling.span('cache.hash'):
+                digest = uploadcache.hash_file(path)
+            cached = cache.lookup(digest, sizes[index])
+            if cached is not None and (reuse is None or reuse(cached)) and \
+                    (not verify or cache.verify(cached, session=session)):
+                _log.info('Re-using item %s for %s.' % (cached.item_id, path))
+                transfer.update(sizes[index], sizes[index])
+                transfer.finish()
+                return (cached.item_id, cached.extension, digest)
+
+        with limit.slot() as done:
+            with profiling.span('http.upload'):
+                item = minus.UploadItem(path, gallery,
+                        os.path.basename(path), transfer.update,
+                        session=session)
+            done(sizes[index])
+        transfer.finish()
+        profiling.count('http.upload_bytes', sizes[index])
+
+        if cache is not None:
+            cache.store(digest, sizes[index], item.id, gallery.reader_id,
+                    extension)
+        if journal is not None:
+            journal.record_item(path, sizes[index], stats[index].st_mtime,
+                    item.id, extension)
+
+        return (item.id, extension, digest)
+
+    # Show each upload in progress as well as the total.
+    from terminalinterface import TerminalInterface
+    display = TerminalInterface().start_transfers()
+    transfers = [ ]
+    for path in filepaths:
+        transfers.append(display.add(_name(path), _size(stats[len(transfers)])))
+
+    try:
+        # There are enough threads for the most uploads which may be allowed
+        # at once. The limit holds back any beyond that.
+        executor = ThreadPoolExecutor(max_workers=limit.maximum)
+        try:
+            # map() yields results in the order of filepaths regardless of the
+            # order in which the uploads complete.
+            items = list(executor.map(upload, range(len(filepaths))))
+        finally:
+            executor.shutdown(wait=True)
+    finally:
+        display.close()
+        if close_cache:
+            cache.close()
+
+    _log.info('HTTP session: %(requests)d request(s), '
+            '%(connections_opened)d connection(s) opened, '
+            '%(connections_reused)d re-used, %(retries)d retried.' % \
+                    session.stats())
+    _log.info('Finished allowing %s upload(s) at once.' % (limit.limit,))
+
+    # Count only the requests made by this call since the session may be
+    # shared.
+    for (name, value) in session.stats().items():
+        profiling.count('http.' + name, value - session_stats[name])
+
+    return items
+
+def links_email(reader_id, item_map):
+    """Return the email linking to the min.us gallery reader_id and to each
+    item in it. item_map is a list of (item id, extension, file name)
+    tuples.
+
+    """
     msg_str = ''
     msg_str += "I've shared some files with you. They are viewable as a "
     msg_str += "gallery at the following link:\n\n - http://min.us/m%s\n\n" %\
-            (gallery.reader_id,)
+            (reader_id,)
     msg_str += "The individual files can be downloaded from the following "
     msg_str += "links:\n\n"
 
-    for item, name in item_map.items():
-        msg_str += ' - http://i.min.us/j%s%s %s\n' % \
-                (item, os.path.splitext(name)[1], name)
+    for item, extension, name in item_map:
+        msg_str += ' - http://i.min.us/j%s%s %s\n' % (item, extension, name)
 
     msg = MIMEText(msg_str)
     msg.add_header('Format', 'Flowed')
-    
+
     return msg
+
+def _name(path):
+    if hasattr(path, 'open'):
+        return path.name
+    return os.path.basename(path)
+
+def _size(st):
+    if st is None:
+        return 0
+    return st.st_size
+
+def _open_cache(config):
+    """Return the UploadCache configured by config or None if the cache is
+    disabled or cannot be opened.
+
+    """
+    if not config.get('cache', 'enabled'):
+        return None
+
+    ttl = config.get('cache', 'ttl_days')
+    if ttl is not None:
+        ttl = ttl * 24 * 60 * 60
+
+    try:
+        return uploadcache.UploadCache(ttl=ttl,
+                max_entries=config.get('cache', 'max_entries'))
+    except Exception as e:
+        _log.warning('Could not open the upload cache: %s' % (e,))
+        return None
@@ -0,0 +1,320 @@
+"""Pack a set of files into a single gzip compressed tar archive which is
+compressed across several CPU cores and generated on the fly as it is read.
+
+The archive is compressed in the same way as pigz: the tar stream is cut into
+blocks which are deflated independently, each primed with the end of the
+previous block, and the results are concatenated into a single gzip member.
+The data of files which appear to be compressed already is stored rather than
+deflated.
+
+"""
+
+import logging
+import os
+import mimetypes
+import struct
+import tarfile
+import time
+import zlib
+
+from collections import deque
+
+# Under Python 2 this is provided by the 'futures' backport.
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+_log = logging.getLogger(__name__)
+
+# The tar stream is compressed in blocks of this size.
+BLOCK_SIZE = 128 * 1024
+
+# Each block is primed with this much of the end of the previous block, the
+# size of the deflate window.
+DICTIONARY_SIZE = 32 * 1024
+
+# Extensions of files which are compressed already and so are not worth
+# deflating again.
+COMPRESSED_EXTENSIONS = frozenset([
+    '.7z', '.apk', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic',
+    '.jar', '.jpeg', '.jpg', '.lz4', '.lzma', '.m4a', '.mkv', '.mov', '.mp3',
+    '.mp4', '.odt', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp',
+    '.xlsx', '.xz', '.zip', '.zst',
+])
+
+# If deflating the first block of a file at the fastest level does not shrink
+# it to less than this fraction of its size, the file is stored.
+INCOMPRESSIBLE_RATIO = 0.95
+
+# Python 3.3 onwards can prime a compressor with a dictionary.
+try:
+    zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS, 9,
+            zlib.Z_DEFAULT_STRATEGY, b'')
+    _HAVE_ZDICT = True
+except TypeError:
+    _HAVE_ZDICT = False
+
+class Archive(object):
+    """A gzip compressed tar archive of filepaths. The archive is never
+    written to disk: it is generated as it is read via iter_chunks() or the
+    file-like object returned by open(). Each call starts a fresh archive.
+
+    The archive members are named relative to the deepest directory which
+    contains all of filepaths. Up to workers blocks are compressed at once; if
+    workers is None, one per CPU core is used.
+
+    """
+
+    def __init__(self, filepaths, collection_name=None, level=6, workers=None):
+        self.filepaths = list(filepaths)
+        self.level = level
+
+        if workers is None:
+            workers = _cpu_count()
+        self.workers = max(1, workers)
+
+        if collection_name is None:
+            collection_name = 'files'
+        self.name = collection_name + '.tar.gz'
+
+        self._root = _common_root(self.filepaths)
+
+    def size_bound(self):
+        """Return an upper bound on the size in bytes of the compressed
+        archive. This is the exact size of the uncompressed tar stream plus the
+        most that storing or deflating it can add.
+
+        """
+        tar_size = tarfile.RECORDSIZE
+        for path in self.filepaths:
+            (info, st) = self._tar_info(path)
+            tar_size += len(info.tobuf(tarfile.PAX_FORMAT))
+            tar_size += -(-st.st_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+        # A stored block adds 5 bytes per 64 KiB and each block ends with a
+        # 5 byte sync marker. zlib's deflateBound() is a little more generous
+        # again for deflated blocks, so allow 1 byte in 1000 in addition.
+        blocks = tar_size // BLOCK_SIZE + len(self.filepaths) * 3 + 1
+        return 18 + tar_size + tar_size // 1000 + blocks * 16
+
+    def open(self):
+        """Return a file-like object from which the archive can be read."""
+        return _ChunkReader(self.iter_chunks())
+
+    def iter_chunks(self):
+        """Yield the compressed archive as a sequence of byte strings."""
+        mtime = int(time.time())
+        yield b'\x1f\x8b\x08\x00' + struct.pack('<I', mtime) + b'\x00\xff'
+
+        crc = zlib.crc32(b'')
+        size = 0
+        dictionary = b''
+
+        # Keep a bounded window of blocks being compressed so that at most a
+        # few blocks per worker are held in memory.
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        try:
+            for (data, compress) in self._blocks():
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+
+                if compress:
+                    level = self.level
+                else:
+                    level = 0
+                pending.append(executor.submit(_deflate_block, data, level,
+                        dictionary))
+                dictionary = data[-DICTIONARY_SIZE:]
+
+                while len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        # An empty final block ends the deflate stream.
+        yield zlib.compressobj(self.level, zlib.DEFLATED,
+                -zlib.MAX_WBITS).flush(zlib.Z_FINISH)
+        yield struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+    def _segments(self):
+        """Yield the uncompressed tar stream as a sequence of (data,
+        compress) pairs where compress is False for the contents of files
+        which appear to be compressed already.
+
+        """
+        for path in self.filepaths:
+            (info, st) = self._tar_info(path)
+            yield (info.tobuf(tarfile.PAX_FORMAT), True)
+
+            with open(path, 'rb') as fp:
+                data = fp.read(BLOCK_SIZE)
+                compress = _is_compressible(path, data)
+                if not compress:
+                    _log.info('Storing %s without compression.' % (path,))
+
+                remaining = st.st_size
+                while len(data) > 0 and remaining > 0:
+                    data = data[:remaining]
+                    remaining -= len(data)
+                    yield (data, compress)
+                    data = fp.read(BLOCK_SIZE)
+
+            # The archive must contain exactly the size recorded in the header
+            # even if the file has shrunk since.
+            if remaining > 0:
+                yield (b'\0' * remaining, True)
+
+            padding = (tarfile.BLOCKSIZE - st.st_size % tarfile.BLOCKSIZE) % \
+                    tarfile.BLOCKSIZE
+            if padding > 0:
+                yield (b'\0' * padding, True)
+
+        # The end of archive marker, padded to a whole record.
+        yield (b'\0' * tarfile.RECORDSIZE, True)
+
+    def _tar_info(self, path):
+        st = os.stat(path)
+        info = tarfile.TarInfo(os.path.relpath(path, self._root))
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = st.st_mode & 0o7777
+        return (info, st)
+
+    def _blocks(self):
+        """Yield the uncompressed tar stream as (data, compress) blocks of at
+        most BLOCK_SIZE bytes. Segments are coalesced into a block only if
+        they have the same value of compress.
+
+        """
+        buffered = [ ]
+        buffered_size = 0
+        buffered_compress = None
+
+        for (data, compress) in self._segments():
+            if buffered_size > 0 and (compress != buffered_compress or
+                    buffered_size + len(data) > BLOCK_SIZE):
+                yield (b''.join(buffered), buffered_compress)
+                buffered = [ ]
+                buffered_size = 0
+
+            while len(data) > BLOCK_SIZE:
+                yield (data[:BLOCK_SIZE], compress)
+                data = data[BLOCK_SIZE:]
+
+            buffered.append(data)
+            buffered_size += len(data)
+            buffered_compress = compress
+
+        if buffered_size > 0:
+            yield (b''.join(buffered), buffered_compress)
+
+class _ChunkReader(object):
+    """A minimal read-only file-like object wrapping an iterator of byte
+    strings. Each read joins the pieces it needs once so that reading in
+    large parts costs no more than reading in small ones.
+
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+        # The chunk being read and the offset of its first unread byte.
+        self._chunk = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        pieces = [ ]
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self._offset >= len(self._chunk):
+                try:
+                    self._chunk = next(self._chunks)
+                except StopIteration:
+                    self._chunk = b''
+                    break
+                self._offset = 0
+                continue
+
+            end = len(self._chunk)
+            if size >= 0:
+                end = min(end, self._offset + remaining)
+                remaining -= end - self._offset
+            if self._offset == 0 and end == len(self._chunk):
+                pieces.append(self._chunk)
+            else:
+                pieces.append(self._chunk[self._offset:end])
+            self._offset = end
+
+        return b''.join(pieces)
+
+    def close(self):
+        self._chunks = iter(())
+        self._chunk = b''
+        self._offset = 0
+
+def _deflate_block(data, level, dictionary):
+    """Return data as a byte-aligned sequence of raw deflate blocks which may
+    be concatenated with those of other blocks. zlib releases the GIL while
+    compressing so this may be run on several threads at once.
+
+    """
+    with profiling.span('pack.deflate'):
+        if level > 0 and _HAVE_ZDICT and len(dictionary) > 0:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                    -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                    -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+    profiling.count('pack.bytes_in', len(data))
+    profiling.count('pack.bytes_out', len(deflated))
+    return deflated
+
+def _is_compressible(path, head):
+    """Guess whether the file at path, starting with the bytes head, is worth
+    compressing.
+
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+
+    # Files with a compressed content encoding, e.g. '.tar.bz2'.
+    if mimetypes.guess_type(path)[1] is not None:
+        return False
+
+    if len(head) == 0:
+        return True
+
+    trial = zlib.compress(head, 1)
+    return len(trial) < INCOMPRESSIBLE_RATIO * len(head)
+
+def _common_root(filepaths):
+    """Return the deepest directory containing all of filepaths."""
+    if len(filepaths) == 0:
+        return os.getcwd()
+
+    dirnames = [os.path.dirname(os.path.abspath(x)).split(os.sep)
+            for x in filepaths]
+    common = dirnames[0]
+    for components in dirnames[1:]:
+        length = 0
+        while length < min(len(common), len(components)) and \
+                common[length] == components[length]:
+            length += 1
+        common = common[:length]
+
+    return os.sep.join(common) or os.sep
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
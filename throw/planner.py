@@ -0,0 +1,56 @@
+"""Plan how to share a set of files between several emails, each of which
+must be smaller than a size limit.
+
+"""
+
+import attachment_renderer
+
+def plan_emails(entries, limit, headers=None):
+    """Group entries, a sequence of walker.FileEntry records, into lists of
+    entries which may each be sent as one attachment email of at most limit
+    bytes once encoded. The sizes of the emails are computed exactly, without
+    reading the files, given that the headers in the dictionary headers will
+    be set on each of them.
+
+    Returns a pair (groups, oversized) where groups is a list of lists of
+    entries and oversized is a list of the entries which are too large to be
+    sent as an attachment at all. The groups are found by first-fit
+    decreasing bin packing. Within each group, and in oversized, entries keep
+    the order they had in entries and the groups are ordered by their first
+    entry.
+
+    """
+    if headers is None:
+        headers = { }
+    capacity = limit - attachment_renderer.message_size(headers)
+
+    indexed = [ ]
+    oversized = [ ]
+    for (index, entry) in enumerate(entries):
+        size = attachment_renderer.part_size(entry.path, entry.size)
+        if size > capacity:
+            oversized.append(entry)
+        else:
+            indexed.append((size, index, entry))
+
+    # First-fit decreasing: place each entry, largest first, in the first
+    # group with room for it.
+    indexed.sort(key=lambda x: (-x[0], x[1]))
+    groups = [ ]
+    free = [ ]
+    for (size, index, entry) in indexed:
+        for group_index in range(len(groups)):
+            if free[group_index] >= size:
+                groups[group_index].append((index, entry))
+                free[group_index] -= size
+                break
+        else:
+            groups.append([(index, entry)])
+            free.append(capacity - size)
+
+    for group in groups:
+        group.sort(key=lambda x: x[0])
+    groups.sort(key=lambda x: x[0][0])
+
+    return ([[entry for (index, entry) in group] for group in groups],
+            oversized)
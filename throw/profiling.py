@@ -0,0 +1,151 @@
+"""Lightweight instrumentation of where a throw spends its time.
+
+Code marks out phases of work with named spans and counts things, such as
+bytes sent or connections made, with named counters:
+
+    with profiling.span('smtp.connect'):
+        server = smtplib.SMTP(host)
+    profiling.count('smtp.connections')
+
+These are recorded only once enable() has been called. Until then span()
+returns a shared do-nothing context manager and count() returns at once, so
+instrumented code costs next to nothing when it is not being profiled.
+
+"""
+
+import json
+import threading
+import time
+
+# Use a clock which does not jump if we have one.
+_clock = getattr(time, 'monotonic', time.time)
+
+# The Profile recording spans and counters or None if profiling is disabled.
+_profile = None
+
+def enable():
+    """Start recording spans and counters in a new Profile and return it."""
+    global _profile
+    _profile = Profile()
+    return _profile
+
+def disable():
+    """Stop recording spans and counters."""
+    global _profile
+    _profile = None
+
+def span(name):
+    """Return a context manager timing the phase of work called name."""
+    if _profile is None:
+        return _NULL_SPAN
+    return _Span(_profile, name)
+
+def count(name, amount=1):
+    """Add amount to the counter called name."""
+    if _profile is None:
+        return
+    _profile.count(name, amount)
+
+class Profile(object):
+    """The spans and counters recorded since profiling was enabled. Spans
+    and counters may be recorded from several threads at once so the total
+    time of the spans may exceed the wall time.
+
+    """
+
+    def __init__(self):
+        self.started = _clock()
+        self.stopped = None
+
+        # Map span names to [calls, total seconds, longest seconds].
+        self._spans = { }
+        self._counters = { }
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """Record the end of the wall time covered by the profile."""
+        self.stopped = _clock()
+
+    def wall_time(self):
+        if self.stopped is None:
+            return _clock() - self.started
+        return self.stopped - self.started
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            record = self._spans.get(name)
+            if record is None:
+                self._spans[name] = [1, seconds, seconds]
+            else:
+                record[0] += 1
+                record[1] += seconds
+                record[2] = max(record[2], seconds)
+
+    def as_dict(self):
+        """Return the profile as a dictionary which may be serialised as
+        JSON.
+
+        """
+        with self._lock:
+            spans = dict([(name, { 'calls': calls, 'total': total,
+                                   'longest': longest })
+                for (name, (calls, total, longest)) in self._spans.items()])
+            counters = dict(self._counters)
+        return { 'wall_time': self.wall_time(), 'spans': spans,
+                 'counters': counters }
+
+    def dump_json(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.as_dict(), fp, indent=4, sort_keys=True)
+
+    def format(self):
+        """Return a table of the spans and counters as a string."""
+        profile = self.as_dict()
+
+        lines = [ '%-28s %8s %10s %10s %10s' % \
+                ('Phase', 'Calls', 'Total (s)', 'Mean (s)', 'Max (s)') ]
+        for name in sorted(profile['spans']):
+            record = profile['spans'][name]
+            lines.append('%-28s %8d %10.3f %10.3f %10.3f' % (name,
+                record['calls'], record['total'],
+                record['total'] / record['calls'], record['longest']))
+
+        if len(profile['counters']) > 0:
+            lines.append('')
+            lines.append('%-28s %8s' % ('Counter', 'Value'))
+            for name in sorted(profile['counters']):
+                lines.append('%-28s %8d' % (name, profile['counters'][name]))
+
+        lines.append('')
+        lines.append('Wall time: %.3f s' % (profile['wall_time'],))
+        return '\n'.join(lines) + '\n'
+
+class _Span(object):
+    __slots__ = ('_profile', '_name', '_start')
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self):
+        self._start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profile.add_span(self._name, _clock() - self._start)
+        return False
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
@@ -0,0 +1,242 @@
+"""Track the progress of several concurrent transfers and show it on a
+TerminalInterface at a fixed frame rate.
+
+"""
+
+import math
+import threading
+import time
+
+# Redraw the progress at most this many times a second however often it is
+# updated.
+FRAME_RATE = 10
+
+# The instantaneous rate of a transfer is an exponentially weighted moving
+# average with this time constant in seconds. Samples are taken at most every
+# SAMPLE_INTERVAL seconds.
+RATE_TIME_CONSTANT = 2.0
+SAMPLE_INTERVAL = 0.1
+
+# Use a clock which does not jump if we have one.
+_clock = getattr(time, 'monotonic', time.time)
+
+class Transfer(object):
+    """The progress of one transfer of total bytes, or of an unknown number
+    of bytes if total is 0. Transfers are created by ProgressDisplay.add() and
+    are pending until they are first updated.
+
+    """
+
+    def __init__(self, display, name, total=0):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.started = None
+        self.finished = False
+
+        # The instantaneous rate in bytes per second or None if it is not yet
+        # known.
+        self.rate = None
+
+        self._display = display
+        self._sample_time = None
+        self._sample_done = 0
+
+    def update(self, done, total=None):
+        """Record that done bytes of total have been transferred. This may be
+        used directly as the progress callback of minus.UploadItem.
+
+        """
+        self._display.update(self, done, total)
+
+    def finish(self):
+        """Record that the transfer is complete."""
+        self._display.finish(self)
+
+    def average_rate(self, now=None):
+        """Return the average rate in bytes per second since the transfer
+        started or None if it has not.
+
+        """
+        if self.started is None:
+            return None
+        if now is None:
+            now = _clock()
+        if now <= self.started:
+            return None
+        return self.done / (now - self.started)
+
+    def eta(self, now=None):
+        """Return the estimated number of seconds until the transfer is
+        complete or None if it cannot be estimated.
+
+        """
+        if self.finished:
+            return 0.0
+        rate = self.rate
+        if rate is None or rate <= 0:
+            rate = self.average_rate(now)
+        if self.total <= 0 or rate is None or rate <= 0:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def _record(self, done, total, now):
+        if total is not None and total > 0:
+            self.total = total
+
+        if self.started is None:
+            self.started = now
+            self._sample_time = now
+            self._sample_done = done
+        self.done = done
+
+        elapsed = now - self._sample_time
+        if elapsed < SAMPLE_INTERVAL:
+            return
+
+        sample = (done - self._sample_done) / elapsed
+        if self.rate is None:
+            self.rate = sample
+        else:
+            weight = 1.0 - math.exp(-elapsed / RATE_TIME_CONSTANT)
+            self.rate += weight * (sample - self.rate)
+        self._sample_time = now
+        self._sample_done = done
+
+class ProgressDisplay(object):
+    """Show the progress of a set of transfers, and of all of them together,
+    on backend, one of the TerminalInterface backends. The transfers may be
+    updated from several threads at once. However often they are updated, the
+    display is redrawn at most frame_rate times a second.
+
+    """
+
+    def __init__(self, backend, frame_rate=FRAME_RATE, clock=_clock):
+        self.transfers = [ ]
+        self.total = Transfer(self, 'Total')
+
+        self._backend = backend
+        self._interval = 1.0 / frame_rate
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_frame = None
+        self._closed = False
+
+        self._backend.start_transfers()
+
+    def add(self, name, total=0):
+        """Return a new Transfer of total bytes, or of an unknown number of
+        bytes if total is 0, which is shown as name.
+
+        """
+        with self._lock:
+            transfer = Transfer(self, name, total)
+            self.transfers.append(transfer)
+            self.total.total += total
+        return transfer
+
+    def update(self, transfer, done, total=None):
+        """Record that done bytes of total have been transferred by transfer
+        and redraw the display if a frame is due.
+
+        """
+        with self._lock:
+            now = self._clock()
+
+            if total is not None and total > 0:
+                self.total.total += total - transfer.total
+            self.total._record(self.total.done + done - transfer.done, None,
+                    now)
+            transfer._record(done, total, now)
+
+            self._draw_if_due(now)
+
+    def finish(self, transfer):
+        """Record that transfer is complete."""
+        with self._lock:
+            transfer.finished = True
+            self._draw_if_due(self._clock())
+
+    def close(self):
+        """Draw the final state of the transfers and stop showing them."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self.total.finished = True
+            self._draw(self._clock(), final=True)
+            self._backend.end_transfers()
+
+    def active(self):
+        """Return the transfers which have started but not finished."""
+        return [x for x in self.transfers
+                if x.started is not None and not x.finished]
+
+    def _draw_if_due(self, now):
+        if self._closed:
+            return
+        if self._last_frame is not None and \
+                now - self._last_frame < self._interval:
+            return
+        self._draw(now)
+
+    def _draw(self, now, final=False):
+        self._last_frame = now
+
+        # The total says all there is to say about a single transfer.
+        if len(self.transfers) > 1:
+            transfers = self.active()
+        else:
+            transfers = [ ]
+        self._backend.draw_transfers(self.total, transfers, now, final)
+
+def format_transfer(transfer, width, now=None, name_width=None):
+    """Return a line of at most width characters showing the progress,
+    instantaneous and average rate and estimated time to completion of
+    transfer. The name of the transfer is padded or truncated to name_width
+    characters, if given, so that the bars of several lines line up.
+
+    """
+    if transfer.total > 0:
+        fraction = min(1.0, float(transfer.done) / transfer.total)
+        position = '%3d%%' % (int(math.floor(100 * fraction)),)
+    else:
+        fraction = None
+        position = format_bytes(transfer.done)
+
+    stats = ' %s %9s avg %9s ETA %s' % (position,
+            format_rate(transfer.rate), format_rate(transfer.average_rate(now)),
+            format_duration(transfer.eta(now)))
+
+    # Give the name up to a quarter of the line and the bar the rest.
+    if name_width is None:
+        name_width = len(transfer.name)
+    name_width = min(name_width, max(0, width // 4))
+    name = transfer.name[:name_width].ljust(name_width)
+    bar_width = width - len(name) - len(stats) - 3
+
+    if fraction is None or bar_width < 5:
+        return (name + stats)[:width]
+
+    filled = int(math.floor(bar_width * fraction))
+    return '%s [%s%s]%s' % (name, '=' * filled, ' ' * (bar_width - filled),
+            stats)
+
+def format_bytes(count):
+    """Return a short human readable form of a number of bytes."""
+    for (unit, scale) in (('GB', 1e9), ('MB', 1e6), ('kB', 1e3)):
+        if count >= scale:
+            return '%.1f %s' % (count / scale, unit)
+    return '%d B' % (count,)
+
+def format_rate(rate):
+    if rate is None:
+        return '--'
+    return format_bytes(rate) + '/s'
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-:--:--'
+    seconds = int(math.ceil(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60,
+            seconds % 60)
@@ -0,0 +1,267 @@
+"""Limit the rate at which throw sends data so that large throws do not
+saturate the uplink.
+
+One RateLimiter, a token bucket, is shared by every transfer in the process.
+Uploads to min.us and messages sent over SMTP draw on the same allowance
+however many of them are in progress at once. The rate may change with the
+time of day according to a schedule such as:
+
+    09:00-18:00=2M,18:00-09:00=20M
+
+Senders call wait() with the size of each piece of data before sending it.
+The limiter is set up from the 'transfer.limit_rate' and
+'transfer.rate_schedule' configuration options the first time it is needed,
+or by install(). Without a limit wait() returns at once.
+
+"""
+
+import logging
+import re
+import threading
+import time
+
+import profiling
+
+# Data is sent in pieces of at most this many bytes so that a large chunk of
+# a message is spread out rather than sent in a burst after a long wait.
+PIECE_SIZE = 64 * 1024
+
+# The bucket holds enough tokens to send for this many seconds at the full
+# rate, or one piece if that is more, so that short pauses are made up.
+BURST_SECONDS = 0.25
+
+# Use a clock which does not jump if we have one.
+_clock = getattr(time, 'monotonic', time.time)
+
+_log = logging.getLogger(__name__)
+
+# Rates are in bytes per second with an optional suffix which, as for curl's
+# --limit-rate option, multiplies them by a power of 1024.
+_RATE_RE = re.compile(r'^\s*([0-9]+(?:\.[0-9]*)?)\s*([kKmMgG]?)\s*$')
+_MULTIPLIERS = { '': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+
+_WINDOW_RE = re.compile(
+        r'^\s*([0-9]{1,2}):([0-9]{2})\s*-\s*([0-9]{1,2}):([0-9]{2})\s*=(.*)$')
+
+_UNSET = object()
+_limiter = _UNSET
+_lock = threading.Lock()
+
+def parse_rate(rate):
+    """Return rate, a number of bytes per second or a string such as '20M',
+    as a number of bytes per second. 'unlimited', '0' and None mean no limit
+    and give None. A ValueError is raised if rate cannot be parsed.
+
+    """
+    if rate is None:
+        return None
+    if isinstance(rate, (int, float)):
+        value = float(rate)
+    else:
+        if rate.strip().lower() in ('', 'unlimited', 'none'):
+            return None
+        match = _RATE_RE.match(rate)
+        if match is None:
+            raise ValueError('Invalid rate: %r' % (rate,))
+        value = float(match.group(1)) * _MULTIPLIERS[match.group(2).lower()]
+
+    if value < 0:
+        raise ValueError('Invalid rate: %r' % (rate,))
+    if value == 0:
+        return None
+    return value
+
+def parse_schedule(schedule):
+    """Parse schedule, a comma separated list of START-END=RATE windows
+    where START and END are times of day as HH:MM and RATE is as for
+    parse_rate(). A window may run past midnight. Return a list of (start,
+    end, rate) tuples with the times in minutes since midnight. A
+    ValueError is raised if schedule cannot be parsed.
+
+    """
+    windows = [ ]
+    if schedule is None:
+        return windows
+
+    for window in schedule.split(','):
+        if window.strip() == '':
+            continue
+        match = _WINDOW_RE.match(window)
+        if match is None:
+            raise ValueError('Invalid schedule window: %r' % (window,))
+        (start_hour, start_minute, end_hour, end_minute) = \
+                [int(x) for x in match.groups()[:4]]
+        if start_hour > 23 or end_hour > 24 or start_minute > 59 or \
+                end_minute > 59:
+            raise ValueError('Invalid time in schedule window: %r' % (window,))
+        windows.append((start_hour * 60 + start_minute,
+            end_hour * 60 + end_minute, parse_rate(match.group(5))))
+    return windows
+
+class RateLimiter(object):
+    """A token bucket limiting the rate at which data is sent to rate bytes
+    per second or, at the times of day covered by a window of schedule, a
+    list of windows as returned by parse_schedule(), to the rate of that
+    window. A rate of None means no limit.
+
+    The limiter may be shared by any number of threads. The time sending
+    was held back is available from throttled().
+
+    """
+
+    def __init__(self, rate=None, schedule=None, clock=_clock,
+                 localtime=time.localtime):
+        self.base_rate = rate
+        self.schedule = schedule or [ ]
+        self._clock = clock
+        self._localtime = localtime
+
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._last = None
+        self._throttled = 0.0
+        self._throttled_until = None
+
+    def rate(self):
+        """Return the rate which applies now, in bytes per second, or None if
+        there is no limit.
+
+        """
+        if len(self.schedule) == 0:
+            return self.base_rate
+
+        now = self._localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for (start, end, rate) in self.schedule:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.base_rate
+
+    def reserve(self, size):
+        """Take size bytes worth of tokens from the bucket and return the
+        number of seconds to wait before sending them. The bucket may go into
+        debt so that concurrent senders queue up behind each other.
+
+        """
+        rate = self.rate()
+        with self._lock:
+            now = self._clock()
+            if rate is None:
+                self._tokens = None
+                return 0.0
+
+            capacity = max(rate * BURST_SECONDS, PIECE_SIZE)
+            if self._tokens is None:
+                self._tokens = capacity
+            else:
+                self._tokens = min(capacity,
+                        self._tokens + (now - self._last) * rate)
+            self._last = now
+
+            self._tokens -= size
+            if self._tokens >= 0:
+                return 0.0
+
+            # Count the wall time during which some sender is held back
+            # rather than adding up the waits of concurrent senders.
+            delay = -self._tokens / rate
+            until = now + delay
+            if self._throttled_until is None or self._throttled_until < now:
+                self._throttled += delay
+            elif until > self._throttled_until:
+                self._throttled += until - self._throttled_until
+            self._throttled_until = max(until, self._throttled_until or until)
+            return delay
+
+    def wait(self, size):
+        """Wait until size bytes may be sent."""
+        delay = self.reserve(size)
+        if delay > 0:
+            with profiling.span('throttle.wait'):
+                time.sleep(delay)
+
+    def throttled(self):
+        """Return the number of seconds for which sending has been held
+        back.
+
+        """
+        with self._lock:
+            return self._throttled
+
+def from_config(config, rate=None):
+    """Return the RateLimiter configured by config, a config.Config, or None
+    if no limit is set. If rate is not None, it is used in place of the
+    'transfer.limit_rate' option. A ValueError is raised if an option
+    cannot be parsed.
+
+    """
+    if rate is None:
+        rate = config.get('transfer', 'limit_rate')
+    rate = parse_rate(rate)
+    schedule = parse_schedule(config.get('transfer', 'rate_schedule'))
+
+    if rate is None and all([x[2] is None for x in schedule]):
+        return None
+    return RateLimiter(rate, schedule)
+
+def install(limiter):
+    """Make limiter, a RateLimiter or None for no limit, the limiter shared
+    by all transfers.
+
+    """
+    global _limiter
+    with _lock:
+        _limiter = limiter
+
+def current():
+    """Return the limiter shared by all transfers, setting it up from the
+    configuration if need be, or None if there is no limit.
+
+    """
+    global _limiter
+    if _limiter is _UNSET:
+        from config import Config
+        limiter = from_config(Config())
+        with _lock:
+            if _limiter is _UNSET:
+                _limiter = limiter
+    return _limiter
+
+def wait(size):
+    """Wait until size bytes may be sent under the shared limit."""
+    limiter = current()
+    if limiter is not None:
+        limiter.wait(size)
+
+def reserve(size):
+    """Return the number of seconds to wait before sending size bytes under
+    the shared limit. This is for senders which cannot block, such as
+    coroutines.
+
+    """
+    limiter = current()
+    if limiter is None:
+        return 0.0
+    return limiter.reserve(size)
+
+def pieces(data):
+    """Return data split into pieces of at most PIECE_SIZE bytes if there is
+    a limit or as a single piece if not.
+
+    """
+    if current() is None or len(data) <= PIECE_SIZE:
+        return [ data ]
+    return [data[x:x + PIECE_SIZE] for x in range(0, len(data), PIECE_SIZE)]
+
+def throttled():
+    """Return the number of seconds for which the shared limiter has held
+    back sending, or 0 if there is no limit.
+
+    """
+    limiter = current()
+    if limiter is None:
+        return 0.0
+    return limiter.throttled()
@@ -0,0 +1,631 @@
+"""Upload files to an S3-compatible object store, or to any HTTP server which
+accepts PUT, and send links to them.
+
+Each file is PUT as one object under a key unique to the throw. A file larger
+than the 's3.multipart_threshold' configuration option is instead split into
+parts of 's3.part_size' bytes which are uploaded in parallel, over as many
+connections as the upload concurrency allows, and then committed as a single
+object with the S3 multipart upload API. One large file is then not limited
+to the throughput of a single TCP stream.
+
+Requests are signed with AWS signature version 4 if the 's3.access_key' and
+'s3.secret_key' options are set. The payload is not hashed for the signature
+('UNSIGNED-PAYLOAD') so that each file is read only once.
+
+"""
+
+import collections
+import hashlib
+import hmac
+import io
+import logging
+import mimetypes
+import os
+import re
+import threading
+import time
+import uuid
+from email.mime.text import MIMEText
+
+# Under Python 2 this is provided by the 'futures' backport.
+from concurrent.futures import ThreadPoolExecutor
+
+# This magic is to support the module re-naming that happened with the Python
+# 2->3 transition.
+try:
+    from urllib import quote
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import quote, urlsplit
+
+import httpsession
+import profiling
+import transferlimit
+from config import Config
+
+# Files larger than MULTIPART_THRESHOLD bytes are uploaded in parts of
+# PART_SIZE bytes unless a Store is given other sizes.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+
+# S3 allows at most this many parts in a multipart upload, each but the last
+# at least MIN_PART_SIZE bytes.
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# At most this many parts of a stream, such as a packer.Archive, are held in
+# memory waiting to be uploaded.
+MAX_BUFFERED_PARTS = 4
+
+_log = logging.getLogger(__name__)
+
+def create_email(filepaths, collection_name, concurrency=None, session=None,
+                 journal=None):
+    """Create an email message object which implements the
+    email.message.Message interface and which has the files to be shared
+    uploaded to the store set by the 's3' configuration options and links
+    placed in the message body.
+
+    The arguments are as for minus_renderer.create_email(), except that there
+    is no upload cache. If journal records the prefix of an interrupted throw,
+    the files which were completely uploaded are skipped. A part of a
+    multipart upload is not resumed.
+
+    """
+    from terminalinterface import TerminalInterface
+
+    if session is None:
+        session = httpsession.default_session()
+
+    store = Store.from_config(Config(), session)
+    if journal is not None and journal.gallery is not None:
+        folder = Folder(journal.gallery['reader_id'])
+    else:
+        folder = Folder(_join_key(Config().get('s3', 'prefix'),
+            uuid.uuid4().hex[:12]))
+        if journal is not None:
+            journal.record_gallery(folder)
+
+    interface = TerminalInterface()
+    interface.new_section()
+    interface.message('Uploading %s file(s) to %s...' % \
+            (len(filepaths), store.link(folder.reader_id + '/')))
+
+    keys = upload_files(filepaths, store, folder.reader_id,
+            concurrency=concurrency, journal=journal)
+
+    return links_email([(store.link(key), _name(path))
+        for (key, path) in zip(keys, filepaths)])
+
+def upload_files(filepaths, store, prefix, concurrency=None, journal=None):
+    """Upload filepaths to store, a Store, under keys beginning with prefix,
+    showing the progress of each, and return the list of their keys in the
+    order of filepaths.
+
+    As many files, and parts of large files, are uploaded at once as the
+    throughput achieved allows, starting from concurrency or, if it is None,
+    the 'upload.concurrency' configuration option. As for
+    minus_renderer.create_email(), filepaths may contain streams such as a
+    packer.Archive. Files larger than the store's multipart_threshold are
+    uploaded in parts of its part_size. If a multipart upload fails, it is
+    aborted.
+
+    """
+    from terminalinterface import TerminalInterface
+
+    config = Config()
+
+    if concurrency is None:
+        concurrency = config.get('upload', 'concurrency')
+    concurrency = max(1, int(concurrency))
+    limit = transferlimit.AdaptiveLimit(concurrency,
+            maximum=max(concurrency, int(config.get('upload',
+                'max_concurrency'))),
+            errors=lambda: store.session.stats()['retries'])
+
+    session_stats = store.session.stats()
+    threshold = store.multipart_threshold
+    part_size = store.part_size
+
+    stats = [ ]
+    for path in filepaths:
+        if hasattr(path, 'open'):
+            stats.append(None)
+        else:
+            stats.append(os.stat(path))
+
+    keys = unique_keys(prefix, [_name(x) for x in filepaths])
+
+    display = TerminalInterface().start_transfers()
+    transfers = [display.add(_name(path), _size(st))
+            for (path, st) in zip(filepaths, stats)]
+
+    # The bytes sent by each part of each file, to report the file's progress.
+    progress_lock = threading.Lock()
+    progress = [ { } for x in filepaths ]
+
+    def progress_cb(task):
+        def update(sent, total):
+            with progress_lock:
+                progress[task.index][task.number] = sent
+                done = sum(progress[task.index].values())
+            transfers[task.index].update(done)
+        return update
+
+    def run(task):
+        """Upload task, a whole file or one part of a file, and return its
+        ETag.
+
+        """
+        with limit.slot() as done:
+            with profiling.span('http.upload'):
+                payload = task.open()
+                try:
+                    if task.upload_id is None:
+                        etag = store.put(keys[task.index], payload,
+                                task.size, progress_cb(task),
+                                _content_type(keys[task.index]))
+                    else:
+                        etag = store.upload_part(keys[task.index],
+                                task.upload_id, task.number, payload,
+                                task.size, progress_cb(task))
+                finally:
+                    payload.close()
+            done(task.size or 0)
+        profiling.count('http.upload_bytes', task.size or 0)
+        return etag
+
+    # Multipart uploads which have been started but not committed.
+    upload_ids = { }
+    etags = collections.defaultdict(list)
+
+    def finish(task, etag):
+        """Record the upload of task and commit its file if it was the last
+        part of it.
+
+        """
+        etags[task.index].append(etag)
+        if not task.last:
+            return
+
+        key = keys[task.index]
+        if task.upload_id is not None:
+            with profiling.span('http.complete_upload'):
+                store.complete(key, task.upload_id, etags[task.index])
+            del upload_ids[task.index]
+        transfers[task.index].finish()
+        if journal is not None and stats[task.index] is not None:
+            journal.record_item(filepaths[task.index],
+                    stats[task.index].st_size, stats[task.index].st_mtime,
+                    key, os.path.splitext(key)[1])
+
+    def tasks():
+        """Yield the tasks to upload each file which has not already been
+        uploaded, starting a multipart upload for each large one.
+
+        """
+        for (index, path) in enumerate(filepaths):
+            st = stats[index]
+            if journal is not None and st is not None:
+                completed = journal.completed(path, st.st_size, st.st_mtime)
+                if completed is not None:
+                    _log.info('Already uploaded %s.' % (path,))
+                    keys[index] = completed['id']
+                    transfers[index].update(st.st_size, st.st_size)
+                    transfers[index].finish()
+                    continue
+
+            size = _size(st) if st is not None else None
+            multipart = threshold and (size is None or size > threshold)
+            if not multipart:
+                yield _Task(index, path, 1, None, 0, size, True)
+                continue
+
+            with profiling.span('http.initiate_upload'):
+                upload_id = store.initiate(keys[index],
+                        _content_type(keys[index]))
+            upload_ids[index] = upload_id
+
+            if st is None:
+                for task in _stream_tasks(index, path, upload_id, part_size):
+                    yield task
+                continue
+
+            parts = plan_parts(size, part_size)
+            for (number, (offset, length)) in enumerate(parts):
+                yield _Task(index, path, number + 1, upload_id, offset,
+                        length, number == len(parts) - 1)
+
+    executor = ThreadPoolExecutor(max_workers=limit.maximum)
+    try:
+        # Keep enough tasks queued to use every thread the limit may allow
+        # while holding only a few parts of streams in memory. Tasks are
+        # finished in order so that each file is committed after its last
+        # part.
+        pending = collections.deque()
+        for task in tasks():
+            pending.append((task, executor.submit(run, task)))
+            while len(pending) >= 2 * limit.maximum or \
+                    len([x for x in pending if x[0].data is not None]) > \
+                        MAX_BUFFERED_PARTS:
+                (done_task, future) = pending.popleft()
+                finish(done_task, future.result())
+        while len(pending) > 0:
+            (done_task, future) = pending.popleft()
+            finish(done_task, future.result())
+    except:
+        for future in [x[1] for x in pending]:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for (index, upload_id) in upload_ids.items():
+            _log.info('Aborting the upload of %s.' % (keys[index],))
+            try:
+                store.abort(keys[index], upload_id)
+            except (IOError, httpsession.HTTPException) as e:
+                _log.warning('Could not abort the upload of %s: %s' % \
+                        (keys[index], e))
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        display.close()
+
+    _log.info('Finished allowing %s upload(s) at once.' % (limit.limit,))
+    for (name, value) in store.session.stats().items():
+        profiling.count('http.' + name, value - session_stats[name])
+
+    return keys
+
+def unique_keys(prefix, names):
+    """Return a key under prefix for each of names. Files of the same name
+    from different directories are given different keys by numbering all but
+    the first of them.
+
+    """
+    keys = [ ]
+    used = set()
+    for name in names:
+        key = _join_key(prefix, name)
+        number = 1
+        while key in used:
+            key = _join_key(prefix, '%d-%s' % (number, name))
+            number += 1
+        used.add(key)
+        keys.append(key)
+    return keys
+
+def plan_parts(size, part_size):
+    """Return a list of (offset, length) pairs splitting size bytes into
+    parts of part_size bytes, or larger if there would otherwise be more than
+    MAX_PARTS parts. There is always at least one part.
+
+    """
+    part_size = max(part_size, -(-size // MAX_PARTS), 1)
+    parts = [(x, min(part_size, size - x)) for x in range(0, size, part_size)]
+    return parts or [ (0, 0) ]
+
+def links_email(links):
+    """Return the email linking to each uploaded file. links is a list of
+    (url, file name) pairs.
+
+    """
+    msg_str = ''
+    msg_str += "I've shared some files with you. They can be downloaded from "
+    msg_str += "the following links:\n\n"
+
+    for url, name in links:
+        msg_str += ' - %s %s\n' % (url, name)
+
+    msg = MIMEText(msg_str)
+    msg.add_header('Format', 'Flowed')
+
+    return msg
+
+class Folder(object):
+    """The key prefix under which the files of one throw are stored. It has
+    the ids of a minus.Gallery so that it can be recorded in a
+    journal.Journal.
+
+    """
+
+    def __init__(self, prefix):
+        self.reader_id = prefix
+        self.editor_id = None
+
+class Store(object):
+    """A bucket of an S3-compatible object store or, if bucket is None, a
+    HTTP server which accepts PUT under the URL endpoint. If access_key and
+    secret_key are not None, requests are signed for region. Links to
+    objects are made under public_url or, if it is None, under the URL they
+    were uploaded to. All requests are made through session, a
+    httpsession.Session.
+
+    Objects larger than multipart_threshold bytes are uploaded in parts of
+    part_size bytes. A multipart_threshold of 0 or None means that objects
+    are always uploaded whole. S3 needs a part_size of at least
+    MIN_PART_SIZE but a smaller one is accepted here for other servers.
+
+    """
+
+    def __init__(self, endpoint, bucket=None, region='us-east-1',
+                 access_key=None, secret_key=None, public_url=None,
+                 session=None, multipart_threshold=MULTIPART_THRESHOLD,
+                 part_size=PART_SIZE):
+        if session is None:
+            session = httpsession.default_session()
+
+        self.base_url = endpoint.rstrip('/')
+        if bucket is not None:
+            self.base_url += '/' + quote(bucket)
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.public_url = (public_url or self.base_url).rstrip('/')
+        self.session = session
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+
+    @classmethod
+    def from_config(cls, config, session=None):
+        """Return the Store configured by the 's3' options of config. A
+        ValueError is raised if the options are not usable.
+
+        """
+        endpoint = config.get('s3', 'endpoint')
+        if endpoint is None:
+            raise ValueError('The s3.endpoint option must be set to upload '
+                    'with the s3 backend.')
+
+        threshold = int(config.get('s3', 'multipart_threshold') or 0)
+        part_size = int(config.get('s3', 'part_size'))
+        if threshold > 0 and part_size < MIN_PART_SIZE:
+            raise ValueError('The s3.part_size option must be at least %d '
+                    'bytes.' % (MIN_PART_SIZE,))
+
+        return cls(endpoint, config.get('s3', 'bucket'),
+                config.get('s3', 'region'), config.get('s3', 'access_key'),
+                config.get('s3', 'secret_key'), config.get('s3', 'public_url'),
+                session, threshold, part_size)
+
+    def link(self, key):
+        """Return the URL to give out for the object key."""
+        return self.public_url + '/' + _quote_key(key)
+
+    def put(self, key, payload, size, progress_cb=None, content_type=None):
+        """Upload the object key from the file-like object payload of size
+        bytes, or of unknown size if size is None, and return its ETag.
+
+        """
+        headers = { }
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        response = self._request('PUT', key, payload=payload, size=size,
+                headers=headers, progress_cb=progress_cb, idempotent=True)
+        return response.headers.get('etag')
+
+    def initiate(self, key, content_type=None):
+        """Start a multipart upload of the object key and return its upload
+        id.
+
+        """
+        headers = { }
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        response = self._request('POST', key, 'uploads', payload=b'',
+                headers=headers)
+        return _xml_value(response.body, 'UploadId')
+
+    def upload_part(self, key, upload_id, number, payload, size,
+                    progress_cb=None):
+        """Upload part number, counting from 1, of the multipart upload
+        upload_id of the object key from the file-like object payload of size
+        bytes and return its ETag.
+
+        """
+        response = self._request('PUT', key,
+                'partNumber=%d&uploadId=%s' % (number, quote(upload_id, '')),
+                payload=payload, size=size, progress_cb=progress_cb,
+                idempotent=True)
+        return response.headers.get('etag')
+
+    def complete(self, key, upload_id, etags):
+        """Commit the multipart upload upload_id of the object key made up of
+        parts with the ETags etags, in order. An IOError is raised if the
+        ETag of a part is missing.
+
+        """
+        body = ['<CompleteMultipartUpload>']
+        for (index, etag) in enumerate(etags):
+            if not etag:
+                raise IOError('The server gave no ETag for part %d of the '
+                        'upload of %s.' % (index + 1, key))
+            body.append('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>'
+                    '</Part>' % (index + 1, _xml_escape(etag)))
+        body.append('</CompleteMultipartUpload>')
+
+        response = self._request('POST', key,
+                'uploadId=%s' % (quote(upload_id, ''),),
+                payload=''.join(body), headers={
+                    'Content-Type': 'application/xml' })
+
+        # S3 may report a failure to commit in the body of a 200 response.
+        if b'<Error>' in response.body:
+            raise IOError('Could not complete the upload of %s: %s' % \
+                    (key, _xml_value(response.body, 'Message')))
+
+    def abort(self, key, upload_id):
+        """Abandon the multipart upload upload_id of the object key."""
+        self._request('DELETE', key, 'uploadId=%s' % (quote(upload_id, ''),),
+                idempotent=True)
+
+    def _request(self, method, key, query=None, payload=None, size=None,
+                 headers=None, progress_cb=None, idempotent=False):
+        url = self.base_url + '/' + _quote_key(key)
+        if query is not None:
+            url += '?' + query
+
+        headers = dict(headers or { })
+        if self.access_key is not None and self.secret_key is not None:
+            headers.update(sign(method, url, headers, self.region,
+                self.access_key, self.secret_key))
+
+        return self.session.request(method, url, payload, headers=headers,
+                progress_cb=progress_cb, payload_size=size,
+                idempotent=idempotent)
+
+def sign(method, url, headers, region, access_key, secret_key,
+         timestamp=None, payload_hash='UNSIGNED-PAYLOAD'):
+    """Return the headers to add to a request for url with the given method
+    and headers to sign it for S3 in region with AWS signature version 4.
+    timestamp is the time of the request in seconds since the epoch, or now
+    if it is None.
+
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timestamp))
+    scope = '%s/%s/s3/aws4_request' % (amz_date[:8], region)
+
+    parts = urlsplit(url)
+    host = parts.hostname
+    if parts.port is not None and \
+            parts.port != { 'http': 80, 'https': 443 }.get(parts.scheme):
+        host += ':%d' % (parts.port,)
+
+    signed = dict([(k.lower(), str(v).strip()) for (k, v) in headers.items()])
+    signed['host'] = host
+    signed['x-amz-content-sha256'] = payload_hash
+    signed['x-amz-date'] = amz_date
+    names = sorted(signed)
+
+    query = [ ]
+    for pair in parts.query.split('&'):
+        if pair != '':
+            (name, _, value) = pair.partition('=')
+            query.append((name, value))
+    query = '&'.join(['%s=%s' % x for x in sorted(query)])
+
+    canonical = '\n'.join([method, parts.path or '/', query] +
+            ['%s:%s' % (x, signed[x]) for x in names] +
+            ['', ';'.join(names), payload_hash])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'),
+            hashlib.sha256).hexdigest()
+
+    return {
+        'x-amz-content-sha256': payload_hash,
+        'x-amz-date': amz_date,
+        'Authorization': 'AWS4-HMAC-SHA256 Credential=%s/%s, '
+            'SignedHeaders=%s, Signature=%s' % (access_key, scope,
+                ';'.join(names), signature),
+    }
+
+class _Task(object):
+    """The upload of a whole file or of one part of it. data holds a part
+    of a stream read in advance or is None if the part is read from path.
+
+    """
+
+    def __init__(self, index, path, number, upload_id, offset, size, last,
+                 data=None):
+        self.index = index
+        self.path = path
+        self.number = number
+        self.upload_id = upload_id
+        self.offset = offset
+        self.size = size
+        self.last = last
+        self.data = data
+
+    def open(self):
+        """Return a file-like object from which to read the task's data."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if hasattr(self.path, 'open'):
+            return self.path.open()
+        return _FileSlice(self.path, self.offset, self.size)
+
+def _stream_tasks(index, stream, upload_id, part_size):
+    """Yield a task for each part of stream, an object with an open()
+    method, reading the parts as they are needed.
+
+    """
+    fp = stream.open()
+    try:
+        data = fp.read(part_size)
+        number = 1
+        while True:
+            following = fp.read(part_size) if len(data) == part_size else b''
+            yield _Task(index, stream, number, upload_id, 0, len(data),
+                    len(following) == 0, data)
+            if len(following) == 0:
+                break
+            (data, number) = (following, number + 1)
+    finally:
+        fp.close()
+
+class _FileSlice(object):
+    """A read-only file-like object for size bytes of the file at path from
+    offset on. It can seek so that a failed part can be sent again.
+
+    """
+
+    def __init__(self, path, offset, size):
+        self._fp = open(path, 'rb')
+        self._offset = offset
+        self._size = size
+        self._fp.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self._size - self.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        return self._fp.read(size)
+
+    def tell(self):
+        return self._fp.tell() - self._offset
+
+    def seek(self, position):
+        self._fp.seek(self._offset + position)
+
+    def close(self):
+        self._fp.close()
+
+def _join_key(*parts):
+    return '/'.join([x.strip('/') for x in parts if x])
+
+def _quote_key(key):
+    return quote(key.encode('utf-8') if not isinstance(key, bytes) else key,
+            '/~')
+
+def _content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+def _xml_value(body, name):
+    """Return the text of the first element called name in body, an XML
+    document as a byte string, or None if there is none.
+
+    """
+    match = re.search(('<%s>([^<]*)</%s>' % (name, name)).encode('ascii'),
+            body)
+    if match is None:
+        return None
+    return match.group(1).decode('utf-8')
+
+def _xml_escape(text):
+    return text.replace('&', '&amp;').replace('"', '&quot;').replace('<',
+            '&lt;')
+
+def _name(path):
+    if hasattr(path, 'open'):
+        return path.name
+    return os.path.basename(path)
+
+def _size(st):
+    if st is None:
+        return 0
+    return st.st_size
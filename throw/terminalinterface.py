@@ -1,13 +1,14 @@
 import sys
 import logging
 import formatter
-import math
+import signal
 
-# Don't require curses on platforms that don't have it.
-try:
-    import curses
-except:
-    pass
+import progress
+
+# curses is imported when a TerminalInterface is first created, and then only
+# if the output is a terminal, since it is not needed otherwise and it is not
+# available on all platforms.
+curses = None
 
 class TerminalInterface(object):
     _instance = None
@@ -46,58 +47,34 @@ class TerminalInterface(object):
                 except NameError:
                     return input(prompt)
 
-        def start_progress(self):
-            self._progress_ticker = 0
+        def start_transfers(self):
             self._progress_percent = 0
-            self.update_progress(0, 0)
-
-        __prog_chars = r'/-\|'
-
-        def update_progress(self, progress, out_of=100):
-            self._progress_ticker += 1
 
-            inner_width = self._width - 11
-
-            if out_of == 0:
-                percent = 0
-            else:
-                percent = int(math.ceil(100.0 * float(progress) / float(out_of)))
+        def draw_transfers(self, total, transfers, now, final):
+            """Show the progress of total, the sum of all the transfers, and
+            of each of transfers, the ones in progress, as drawn by a
+            progress.ProgressDisplay. Only the total is shown on a dumb
+            terminal.
 
-            # Only output a pretty progress bar if we are a TTY.
+            """
             if self._output.isatty():
-                self._writer.send_literal_data('% 4d%% [' % percent)
-                
-                if out_of == 0:
-                    progress_char_count = 0
-                else:
-                    progress_char_count = int(math.ceil(
-                            inner_width * float(progress) / float(out_of)))
-
-                if progress_char_count > 0:
-                    self._writer.send_literal_data('=' * progress_char_count)
-                if progress_char_count < inner_width:
-                    self._writer.send_literal_data(
-                            ' ' * (inner_width - progress_char_count))
-                self._writer.send_literal_data('] ')
-                self._writer.send_literal_data(
-                    self.__prog_chars[
-                        self._progress_ticker % len(self.__prog_chars)])
-
-                self._writer.send_literal_data('\r')
-
-                self._writer.flush()
-                self._output.flush()
-            elif percent / 2 > self._progress_percent / 2:
-                # Output one of the 50 dots until we're done...
-                self._writer.send_literal_data('.')
-                self._writer.flush()
+                line = progress.format_transfer(total, self._width - 1, now)
+                self._output.write('\r' + line.ljust(self._width - 1))
                 self._output.flush()
+                return
+
+            # Output one of the 50 dots for each 2% until we're done...
+            if total.total > 0:
+                percent = min(100, int(100 * total.done // total.total))
+                dots = percent // 2 - self._progress_percent // 2
+                if dots > 0:
+                    self._output.write('.' * dots)
+                    self._output.flush()
+                self._progress_percent = max(percent, self._progress_percent)
 
-            self._progress_percent = max(percent, self._progress_percent)
-         
-        def end_progress(self):
-            self._writer.send_literal_data('\n')
-             
+        def end_transfers(self):
+            self._output.write('\n')
+            self._output.flush()
 
     class CursesBackend(DumbBackend):
         # Some of this class is taken from 
@@ -106,16 +83,22 @@ class TerminalInterface(object):
         __COLORS = "BLACK BLUE GREEN CYAN RED MAGENTA YELLOW WHITE".split()
         __ANSICOLORS = "BLACK RED GREEN YELLOW BLUE MAGENTA CYAN WHITE".split()
 
+        # The most transfers to show at once below the total.
+        MAX_TRANSFER_ROWS = 8
+
         def __init__(self, output_stream):
             TerminalInterface.DumbBackend.__init__(self, output_stream)
 
             curses.setupterm(fd = output_stream.fileno())
         
             # Move to beginning of line
-            self.MOVE_TO_BOL = curses.tigetstr('cr')
+            self.MOVE_TO_BOL = _tigetstr('cr')
 
             # Clear to end of line
-            self.CLEAR_TO_EOL = curses.tigetstr('el')
+            self.CLEAR_TO_EOL = _tigetstr('el')
+
+            # Move up one line
+            self.MOVE_UP = _tigetstr('cuu1')
 
             # Colors
             self.RESET_FG_BG = curses.tigetstr('op').decode('ascii')
@@ -141,17 +124,43 @@ class TerminalInterface(object):
                     setattr(self, 'BG_'+color,
                             curses.tparm(set_bg_ansi, i).decode('ascii') or '')
 
-        def _refresh_width(self):
-            """Update the width of the terminal."""
-            self._width = curses.tigetnum('cols')
-            self._writer = formatter.DumbWriter(self._output, maxcol=self._width)
+            # Query the size of the terminal now and again only when it is
+            # resized.
+            self._height = 24
+            self._resized = True
+            self._check_geometry()
+            self._watching_resize = False
+            try:
+                previous_handler = signal.getsignal(signal.SIGWINCH)
+                def on_resize(signum, frame):
+                    self._resized = True
+                    if callable(previous_handler):
+                        previous_handler(signum, frame)
+                signal.signal(signal.SIGWINCH, on_resize)
+                self._watching_resize = True
+            except (AttributeError, ValueError):
+                # There is no SIGWINCH on some platforms and handlers may only
+                # be set from the main thread.
+                pass
+
+        def _check_geometry(self):
+            """Update the size of the terminal if it has been resized."""
+            if not self._resized:
+                return
+            self._resized = False
+
+            (width, self._height) = _terminal_size(self._output)
+            if width != self._width:
+                self._width = width
+                self._writer = formatter.DumbWriter(self._output,
+                        maxcol=self._width)
 
         def message(self, message_str):
-            self._refresh_width()
+            self._check_geometry()
             TerminalInterface.DumbBackend.message(self, message_str)
 
         def error(self, message_str):
-            self._refresh_width()
+            self._check_geometry()
             self._writer.send_literal_data(self.RED)
             TerminalInterface.DumbBackend.message(self, message_str)
             self._writer.send_literal_data(self.RESET_FG_BG)
@@ -160,9 +169,46 @@ class TerminalInterface(object):
             return TerminalInterface.DumbBackend.input(self,
                 self.GREEN + prompt + self.RESET_FG_BG, *args, **kwargs)
 
-        def update_progress(self, *args, **kwargs):
-            self._refresh_width()
-            TerminalInterface.DumbBackend.update_progress(self, *args, **kwargs)
+        def start_transfers(self):
+            TerminalInterface.DumbBackend.start_transfers(self)
+            self._progress_lines = 0
+
+            # Without SIGWINCH, make do with checking the size once per set of
+            # transfers.
+            if not self._watching_resize:
+                self._resized = True
+
+        def draw_transfers(self, total, transfers, now, final):
+            if not self.MOVE_UP:
+                TerminalInterface.DumbBackend.draw_transfers(self, total,
+                        transfers, now, final)
+                return
+
+            self._check_geometry()
+
+            # Leave the last column free so that lines never wrap and a row
+            # free for the cursor.
+            width = self._width - 1
+            rows = max(0, min(self.MAX_TRANSFER_ROWS, self._height - 2))
+
+            shown = [ total ] + transfers[:rows]
+            name_width = max([len(x.name) for x in shown])
+            lines = [progress.format_transfer(x, width, now, name_width)
+                    for x in shown]
+
+            # Redraw over the previous frame, blanking any of its lines which
+            # are not needed any more and then moving back up to our last line.
+            output = self.MOVE_TO_BOL
+            if self._progress_lines > 1:
+                output += self.MOVE_UP * (self._progress_lines - 1)
+            spare = max(0, self._progress_lines - len(lines))
+            output += '\n'.join([x + self.CLEAR_TO_EOL
+                for x in lines + [ '' ] * spare])
+            output += self.MOVE_UP * spare
+
+            self._output.write(output)
+            self._output.flush()
+            self._progress_lines = len(lines)
 
     # Implement the singleton pattern
     def __new__(cls, *args, **kwargs):
@@ -172,19 +218,25 @@ class TerminalInterface(object):
         return cls._instance
 
     def __init__(self, stream=sys.stdout):
+        # __init__ is run each time the singleton is asked for. Only set up
+        # the terminal the first time.
+        if getattr(self, '_backend', None) is not None:
+            return
+
         # The fall-back backend is a sumb terminal
         self._backend = TerminalInterface.DumbBackend(stream)
 
         # Try to import curses and setup a terminal if our output is a TTY.
-        try:
-            import curses
-            if stream.isatty():
+        global curses
+        if stream.isatty():
+            try:
+                import curses
                 try:
                     self._backend = TerminalInterface.CursesBackend(stream)
                 except curses.error:
                     pass
-        except ImportError:
-            pass
+            except ImportError:
+                pass
 
     def input_fields(self, preamble, *args):
         """Get a set of fields from the user. Optionally a preamble may be
@@ -293,11 +345,48 @@ class TerminalInterface(object):
             self.message("I'm afraid I didn't understand that: " +
                     "please type 'YES' or 'NO'.")
 
+    def start_transfers(self, frame_rate=progress.FRAME_RATE):
+        """Return a progress.ProgressDisplay showing the progress of several
+        concurrent transfers, redrawn at most frame_rate times a second. Call
+        its close() method when the transfers are complete.
+
+        """
+        return progress.ProgressDisplay(self._backend, frame_rate)
+
     def start_progress(self):
-        self._backend.start_progress()
+        self._progress = self.start_transfers()
+        self._progress_transfer = self._progress.add('')
 
     def update_progress(self, progress, out_of=100):
-        self._backend.update_progress(progress, out_of)
+        self._progress_transfer.update(progress, out_of)
 
     def end_progress(self):
-        self._backend.end_progress()
+        self._progress.close()
+
+def _tigetstr(capname):
+    """Return the terminfo string capability capname or an empty string if
+    the terminal does not have it.
+
+    """
+    value = curses.tigetstr(capname)
+    if value is None:
+        return ''
+    return value.decode('ascii')
+
+def _terminal_size(stream):
+    """Return the number of columns and lines of the terminal stream is
+    connected to.
+
+    """
+    try:
+        import fcntl
+        import struct
+        import termios
+        packed = fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, b'\0' * 8)
+        (lines, columns) = struct.unpack('hhhh', packed)[:2]
+        if columns > 0 and lines > 0:
+            return (columns, lines)
+    except (ImportError, AttributeError, IOError, OSError):
+        pass
+
+    return (curses.tigetnum('cols'), curses.tigetnum('lines'))
@@ -0,0 +1,109 @@
+"""Measure how encoding attachments scales with the number of worker
+processes. Run with:
+
+    python -m throw.tests.bench_encode [--profile PROFILE] [--scale SCALE]
+        [--workers N ...] [DIRECTORY]
+
+The files in DIRECTORY, or in a tree generated by treegen if none is given,
+are attached to a single email which is encoded by 1, 2, 4, ... processes up
+to the number of CPU cores. The output of each run is checked to be
+identical to the serial output.
+
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The directory containing the throw modules. They import each other as
+# top-level modules, as when run via throw/throw.py.
+THROW_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def encode(message, workers):
+    """Encode message with workers processes and return the time taken, the
+    number of bytes produced and their SHA-1 digest.
+
+    """
+    import attachment_renderer
+
+    # Always use the pool when asked to so that small trees show its cost.
+    min_parallel_size = attachment_renderer.MIN_PARALLEL_SIZE
+    attachment_renderer.MIN_PARALLEL_SIZE = 0
+    try:
+        message.workers = workers
+        digest = hashlib.sha1()
+        encoded = 0
+        start = time.time()
+        for chunk in message.iter_bytes():
+            digest.update(chunk)
+            encoded += len(chunk)
+        elapsed = time.time() - start
+    finally:
+        attachment_renderer.MIN_PARALLEL_SIZE = min_parallel_size
+
+    return (elapsed, encoded, digest.hexdigest())
+
+def default_workers():
+    import attachment_renderer
+
+    workers = [ 1 ]
+    while workers[-1] * 2 <= attachment_renderer._cpu_count():
+        workers.append(workers[-1] * 2)
+    if workers[-1] != attachment_renderer._cpu_count():
+        workers.append(attachment_renderer._cpu_count())
+    return workers
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Measure parallel attachment encoding.')
+    parser.add_argument('directory', metavar='DIRECTORY', nargs='?',
+            help='encode the files in DIRECTORY rather than a generated tree.')
+    parser.add_argument('--profile', default='large',
+            help='the treegen profile of the generated tree (default: large).')
+    parser.add_argument('--scale', type=float, default=0.5,
+            help='the scale of the generated tree (default: 0.5).')
+    parser.add_argument('--workers', type=int, action='append',
+            help='a number of processes to try (default: 1, 2, 4, ... up to '
+                 'the number of CPU cores).')
+    args = parser.parse_args()
+
+    sys.path.insert(0, THROW_DIR)
+    import attachment_renderer
+    import walker
+
+    tree = args.directory
+    if tree is None:
+        import treegen
+        tree = tempfile.mkdtemp(prefix='throw-bench-tree-')
+        (count, size) = treegen.make_tree(tree, args.profile, args.scale)
+        print('Generated %s files, %.1f MB, in %s' % (count, size / 1e6, tree))
+
+    try:
+        entries = walker.walk([tree])
+        size = sum([x.size for x in entries])
+        message = attachment_renderer.create_email([x.path for x in entries],
+                'Benchmark')
+
+        serial_digest = None
+        serial_elapsed = None
+        for workers in [ 1 ] + [x for x in (args.workers or default_workers())
+                                if x != 1]:
+            (elapsed, encoded, digest) = encode(message, workers)
+            if serial_digest is None:
+                (serial_digest, serial_elapsed) = (digest, elapsed)
+
+            print('%3d worker(s) %8.2f s %8.1f MB/s %6.2fx %s' % (workers,
+                elapsed, size / 1e6 / max(elapsed, 1e-9),
+                serial_elapsed / max(elapsed, 1e-9),
+                'identical' if digest == serial_digest else 'DIFFERENT'))
+    finally:
+        if args.directory is None:
+            shutil.rmtree(tree)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,106 @@
+"""Measure how long the command line interface takes to start and which
+modules it loads. Run with:
+
+    python -m throw.tests.bench_startup
+
+The time taken to import the command line interface and handle '--help' must
+stay within STARTUP_BUDGET. This is enforced by the test suite.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+# The most time, in seconds, which importing the command line interface and
+# handling '--help' may take. The start up of the interpreter itself is not
+# counted.
+STARTUP_BUDGET = 0.1
+
+# Modules which are only needed to actually throw files and so should not be
+# loaded by '--help'. Sub-modules of these are not allowed either.
+HEAVY_MODULES = (
+    'smtplib', 'email.mime', 'curses', 'pycurl', 'sqlite3',
+    'concurrent.futures', 'terminalinterface', 'identity', 'thrower',
+    'attachment_renderer', 'minus_renderer', 'minus',
+)
+
+# The directory containing the throw modules. They import each other as
+# top-level modules, as when run via throw/throw.py.
+THROW_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SCRIPT = '''
+import json
+import os
+import sys
+import time
+
+start = time.time()
+sys.path.insert(0, %r)
+import commandline
+
+stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+try:
+    commandline.CommandLine().main(%r)
+except SystemExit:
+    pass
+elapsed = time.time() - start
+sys.stdout = stdout
+
+# Python 2 records failed relative imports as None.
+modules = sorted([x for x in sys.modules if sys.modules[x] is not None])
+print(json.dumps({ 'elapsed': elapsed, 'modules': modules }))
+'''
+
+def measure_startup(argv=('--help',), repeats=3):
+    """Run the command line interface with argv in a fresh interpreter repeats
+    times. Return a pair giving the shortest time in seconds taken to import
+    it and handle argv, and the set of modules which were loaded.
+
+    """
+    best = None
+    modules = set()
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c',
+            _SCRIPT % (THROW_DIR, list(argv))])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if best is None or result['elapsed'] < best:
+            best = result['elapsed']
+        modules = set(result['modules'])
+    return (best, modules)
+
+def heavy_modules(modules):
+    """Return the sorted list of modules in modules which are in, or are
+    sub-modules of, HEAVY_MODULES.
+
+    """
+    return sorted([x for x in modules
+        if any([x == y or x.startswith(y + '.') for y in HEAVY_MODULES])])
+
+def _interpreter_time(repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    print('Interpreter start up:  %.1f ms' % (1000.0 * _interpreter_time(),))
+
+    (elapsed, modules) = measure_startup()
+    print('Import and --help:     %.1f ms (budget %.1f ms)' % \
+            (1000.0 * elapsed, 1000.0 * STARTUP_BUDGET))
+    print('Modules loaded:        %s' % (len(modules),))
+
+    heavy = heavy_modules(modules)
+    if len(heavy) > 0:
+        print('Heavy modules loaded:  %s' % (', '.join(heavy),))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Benchmark the renderers and Thrower.throw against the stand-in servers in
+fakeservers. Run with:
+
+    python -m throw.tests.bench_throw [options] [BENCHMARK ...]
+
+The benchmarks are:
+
+    - attachment: encode the tree as attachment emails, without sending them
+    - minus: upload the tree to the stand-in min.us server
+    - throw: throw the tree through the stand-in SMTP and min.us servers
+    - async: throw the tree as throw does but with asyncthrow, several times
+      at once on one event loop (needs Python 3.5 or later)
+    - s3: upload a single file of --s3-size MB to the stand-in S3 server in
+      parts of --part-size MB, or whole if it is 0, with each connection
+      limited to --stream-bandwidth
+
+By default all of them but s3 are run. The tree of files is generated by treegen in
+a temporary directory unless one is given with --tree. Each benchmark is run
+in its own process, with its own home directory so that no configuration,
+upload cache or journal is shared, and reports its throughput, peak RSS and
+the requests made of the servers. With --limit-rate, the time for which
+sending was held back by the rate limit is reported too. The stand-in SMTP
+server advertises the ESMTP extensions given by --smtp-extensions, such as
+PIPELINING,CHUNKING,BINARYMIME.
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# The directory containing the throw modules. They import each other as
+# top-level modules, as when run via throw/throw.py.
+THROW_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ('attachment', 'minus', 'throw', 'async', 's3')
+
+def bench_attachment(tree, args):
+    import attachment_renderer
+    import planner
+    import walker
+
+    entries = walker.walk([tree])
+
+    start = time.time()
+    (groups, oversized) = planner.plan_emails(entries, args.max_size)
+    encoded = 0
+    for group in groups + [ [x] for x in oversized ]:
+        message = attachment_renderer.create_email([x.path for x in group],
+                'Benchmark')
+        for chunk in message.iter_bytes():
+            encoded += len(chunk)
+    elapsed = time.time() - start
+
+    return { 'seconds': elapsed, 'bytes': sum([x.size for x in entries]),
+             'emails': len(groups) + len(oversized), 'encoded_bytes': encoded }
+
+def bench_minus(tree, args):
+    import httpsession
+    import minus.minus as minus
+    import minus_renderer
+    import walker
+    from fakeservers import FakeMinusServer
+
+    entries = walker.walk([tree])
+
+    with FakeMinusServer(args.latency, args.bandwidth) as minus_server:
+        minus.API_URL = minus_server.url
+
+        start = time.time()
+        minus_renderer.create_email([x.path for x in entries], 'Benchmark',
+                concurrency=args.concurrency, session=httpsession.Session())
+        elapsed = time.time() - start
+
+        return { 'seconds': elapsed, 'bytes': sum([x.size for x in entries]),
+                 'http': minus_server.stats() }
+
+def bench_throw(tree, args):
+    import identity
+    import minus.minus as minus
+    import thrower
+    from fakeservers import FakeMinusServer, FakeSMTPServer
+
+    with FakeSMTPServer(args.latency, args.bandwidth,
+            max_size=args.max_size,
+            extensions=args.smtp_extensions.split(',')) as smtp_server:
+        with FakeMinusServer(args.latency, args.bandwidth) as minus_server:
+            minus.API_URL = minus_server.url
+
+            sender = identity.Identity('Benchmark', 'benchmark@example.com',
+                    host=smtp_server.host, port=smtp_server.port)
+
+            start = time.time()
+            result = thrower.Thrower(sender).throw(['recipient@example.com'],
+                    [tree], 'Benchmark')
+            elapsed = time.time() - start
+
+            return { 'seconds': elapsed, 'bytes': result['bytes'],
+                     'smtp': smtp_server.stats(), 'http': minus_server.stats() }
+
+def bench_async(tree, args):
+    import asyncio
+    import asyncthrow
+    import identity
+    import minus.minus as minus
+    from fakeservers import FakeMinusServer, FakeSMTPServer
+
+    with FakeSMTPServer(args.latency, args.bandwidth,
+            max_size=args.max_size,
+            extensions=args.smtp_extensions.split(',')) as smtp_server:
+        with FakeMinusServer(args.latency, args.bandwidth) as minus_server:
+            minus.API_URL = minus_server.url
+
+            sender = identity.Identity('Benchmark', 'benchmark@example.com',
+                    host=smtp_server.host, port=smtp_server.port)
+
+            # This module is run by Pythons without async syntax as well.
+            loop = asyncio.get_event_loop()
+            session = asyncthrow.AsyncSession()
+
+            start = time.time()
+            try:
+                results = loop.run_until_complete(asyncio.gather(*[
+                    asyncthrow.throw_async(['recipient@example.com'], [tree],
+                        'Benchmark %d' % (x,), identity_=sender,
+                        concurrency=args.concurrency, http_session=session,
+                        backend='minus')
+                    for x in range(args.throws)]))
+            finally:
+                loop.run_until_complete(session.close())
+            elapsed = time.time() - start
+
+            return { 'seconds': elapsed,
+                     'bytes': sum([x['bytes'] for x in results]),
+                     'smtp': smtp_server.stats(), 'http': minus_server.stats() }
+
+def bench_s3(tree, args):
+    import httpsession
+    import s3_renderer
+    from fakeservers import FakeS3Server
+
+    directory = tempfile.mkdtemp(prefix='throw-bench-s3-')
+    try:
+        path = os.path.join(directory, 'large.bin')
+        size = int(args.s3_size * 1e6)
+        with open(path, 'wb') as fp:
+            for offset in range(0, size, 1024 * 1024):
+                fp.write(os.urandom(min(1024 * 1024, size - offset)))
+
+        with FakeS3Server(args.latency, args.bandwidth,
+                stream_bandwidth=args.stream_bandwidth) as s3_server:
+            part_size = int(args.part_size * 1e6)
+            store = s3_renderer.Store(s3_server.url, 'bucket',
+                    session=httpsession.Session(),
+                    multipart_threshold=part_size, part_size=part_size)
+
+            start = time.time()
+            s3_renderer.upload_files([path], store, 'benchmark',
+                    concurrency=args.concurrency)
+            elapsed = time.time() - start
+
+            return { 'seconds': elapsed, 'bytes': size,
+                     'http': s3_server.stats() }
+    finally:
+        shutil.rmtree(directory)
+
+def run_benchmark(name, tree, args):
+    """Run the named benchmark on the files under tree in this process and
+    return a dictionary of its results.
+
+    """
+    import resource
+
+    sys.path.insert(0, THROW_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ratelimit
+
+    limiter = None
+    if args.limit_rate is not None:
+        limiter = ratelimit.RateLimiter(ratelimit.parse_rate(args.limit_rate))
+    ratelimit.install(limiter)
+
+    result = globals()['bench_' + name](tree, args)
+    if limiter is not None:
+        result['throttled_seconds'] = limiter.throttled()
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on Mac OS X.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    result['peak_rss_mb'] = peak_rss / 1024.0
+
+    result['name'] = name
+    result['mb_per_s'] = result['bytes'] / 1e6 / max(result['seconds'], 1e-9)
+    return result
+
+def format_result(result):
+    line = '%-11s %8.1f MB %8.2f s %8.1f MB/s %8.1f MB peak RSS' % \
+            (result['name'], result['bytes'] / 1e6, result['seconds'],
+             result['mb_per_s'], result['peak_rss_mb'])
+    if 'throttled_seconds' in result:
+        line += ' %8.2f s throttled' % (result['throttled_seconds'],)
+
+    requests = [ ]
+    for server in ('smtp', 'http'):
+        if server in result:
+            requests.append('%s: %s' % (server, ', '.join(['%s=%s' % x
+                for x in sorted(result[server].items())])))
+    if len(requests) > 0:
+        line += '\n' + '\n'.join(['            ' + x for x in requests])
+    return line
+
+def _spawn(name, tree, args):
+    """Run the named benchmark in a new process, with its own home directory,
+    and return its results.
+
+    """
+    home = tempfile.mkdtemp(prefix='throw-bench-home-')
+    result_path = os.path.join(home, 'result.json')
+    env = dict(os.environ)
+    env['HOME'] = home
+
+    command = [ sys.executable, '-m', 'throw.tests.bench_throw',
+        '--run', name, '--result', result_path, '--tree', tree,
+        '--latency', str(args.latency), '--max-size', str(args.max_size),
+        '--concurrency', str(args.concurrency),
+        '--throws', str(args.throws), '--s3-size', str(args.s3_size),
+        '--part-size', str(args.part_size),
+        '--smtp-extensions', args.smtp_extensions ]
+    if args.bandwidth is not None:
+        command += [ '--bandwidth', str(args.bandwidth / 1e6) ]
+    if args.stream_bandwidth is not None:
+        command += [ '--stream-bandwidth', str(args.stream_bandwidth / 1e6) ]
+    if args.limit_rate is not None:
+        command += [ '--limit-rate', args.limit_rate ]
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, env=env, stdout=devnull,
+                    cwd=os.path.dirname(THROW_DIR))
+        with open(result_path) as fp:
+            return json.load(fp)
+    finally:
+        shutil.rmtree(home)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark throw against stand-in servers.')
+    parser.add_argument('benchmarks', metavar='BENCHMARK', nargs='*',
+            help='a benchmark to run: %s.' % (', '.join(BENCHMARKS),))
+    parser.add_argument('--tree', metavar='DIRECTORY',
+            help='throw the files in DIRECTORY rather than a generated tree.')
+    parser.add_argument('--profile', default='mixed',
+            help='the treegen profile of the generated tree (default: mixed).')
+    parser.add_argument('--scale', type=float, default=0.1,
+            help='the scale of the generated tree (default: 0.1).')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='the latency of the servers in seconds (default: 0).')
+    parser.add_argument('--bandwidth', type=float, default=None,
+            help='the bandwidth of the servers in MB/s (default: unlimited).')
+    parser.add_argument('--max-size', type=int, default=1000000,
+            help='the largest email the SMTP server accepts (default: 1MB).')
+    parser.add_argument('--concurrency', type=int, default=4,
+            help='the number of uploads at once (default: 4).')
+    parser.add_argument('--throws', type=int, default=4,
+            help='the number of throws at once in the async benchmark '
+                 '(default: 4).')
+    parser.add_argument('--s3-size', type=float, default=64,
+            help='the size of the file in the s3 benchmark in MB '
+                 '(default: 64).')
+    parser.add_argument('--part-size', type=float, default=8,
+            help='the part size in the s3 benchmark in MB, or 0 to upload '
+                 'the file whole (default: 8).')
+    parser.add_argument('--stream-bandwidth', type=float, default=None,
+            help='the bandwidth of each connection to the stand-in S3 server '
+                 'in MB/s (default: unlimited).')
+    parser.add_argument('--smtp-extensions', default='8BITMIME',
+            help='the comma separated ESMTP extensions advertised by the '
+                 'stand-in SMTP server (default: 8BITMIME).')
+    parser.add_argument('--limit-rate', metavar='RATE',
+            help='limit the rate of sending as throw --limit-rate does '
+                 '(default: no limit).')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % (name,))
+
+    # The async benchmark is not run by default on Pythons without asyncio.
+    benchmarks = args.benchmarks
+    if len(benchmarks) == 0:
+        benchmarks = [x for x in BENCHMARKS if x != 's3' and
+                (x != 'async' or sys.version_info >= (3, 5))]
+
+    if args.bandwidth is not None:
+        args.bandwidth *= 1e6
+    if args.stream_bandwidth is not None:
+        args.stream_bandwidth *= 1e6
+
+    # Run a single benchmark as a child process of the one below.
+    if args.run is not None:
+        result = run_benchmark(args.run, args.tree, args)
+        with open(args.result, 'w') as fp:
+            json.dump(result, fp)
+        return
+
+    tree = args.tree
+    if tree is None:
+        import treegen
+        tree = tempfile.mkdtemp(prefix='throw-bench-tree-')
+        (count, size) = treegen.make_tree(tree, args.profile, args.scale)
+        print('Generated %s files, %.1f MB, in %s' % (count, size / 1e6, tree))
+
+    try:
+        for name in benchmarks:
+            print(format_result(_spawn(name, tree, args)))
+    finally:
+        if args.tree is None:
+            shutil.rmtree(tree)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
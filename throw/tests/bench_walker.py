@@ -0,0 +1,98 @@
+"""Compare the walker module with the directory walk which Thrower.throw used
+to do. Run with:
+
+    python -m throw.tests.bench_walker [DIRECTORY]
+
+If no directory is given, a synthetic tree is created in a temporary
+directory.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from throw import walker
+
+def legacy_walk(paths):
+    """The walk previously done by Thrower.throw: os.listdir() followed by
+    os.path.isfile()/isdir() on each entry and then os.path.getsize() on each
+    file.
+
+    """
+    def append_dir(paths, dirpath):
+        contents = [os.path.join(dirpath, x) for x in os.listdir(dirpath)]
+        paths += [x for x in contents if os.path.isfile(x)]
+        for subdirpath in [x for x in contents if os.path.isdir(x)]:
+            append_dir(paths, subdirpath)
+
+    filepaths = []
+    filepaths += [x for x in paths if os.path.isfile(x)]
+    for dirpath in [x for x in paths if os.path.isdir(x)]:
+        append_dir(filepaths, dirpath)
+
+    total_size = 0
+    for path in filepaths:
+        total_size += os.path.getsize(path)
+
+    return (len(filepaths), total_size)
+
+def new_walk(paths, workers=1):
+    entries = walker.walk(paths, workers=workers)
+    return (len(entries), sum([x.size for x in entries]))
+
+def make_tree(root, depth=3, fanout=6, files_per_dir=40):
+    """Create a tree of directories under root with fanout sub-directories
+    per level and files_per_dir small files in each directory.
+
+    """
+    for index in range(files_per_dir):
+        with open(os.path.join(root, 'file%03d.txt' % (index,)), 'w') as fp:
+            fp.write('x' * index)
+
+    if depth == 0:
+        return
+
+    for index in range(fanout):
+        subdir = os.path.join(root, 'dir%02d' % (index,))
+        os.mkdir(subdir)
+        make_tree(subdir, depth - 1, fanout, files_per_dir)
+
+def best_of(fn, repeats=5):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def main(argv):
+    tmpdir = None
+    if len(argv) > 0:
+        root = argv[0]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        root = tmpdir
+        make_tree(root)
+
+    try:
+        candidates = [
+            ('legacy listdir/isfile/getsize', lambda: legacy_walk([root])),
+            ('walker', lambda: new_walk([root])),
+            ('walker, 4 workers', lambda: new_walk([root], workers=4)),
+        ]
+
+        for (name, fn) in candidates:
+            (elapsed, (count, size)) = best_of(fn)
+            print('%-32s %8d files %12d bytes %9.2f ms' % \
+                    (name, count, size, 1000.0 * elapsed))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,878 @@
+"""Stand-in SMTP, min.us and S3 servers which run on threads of the current
+process so that throws can be measured without sending anything over the
+internet. The servers can be made to respond after a fixed latency and to
+receive data no faster than a given bandwidth.
+
+    with FakeSMTPServer(latency=0.05) as smtp_server:
+        with FakeMinusServer(bandwidth=10e6) as minus_server:
+            minus.API_URL = minus_server.url
+            ...
+
+"""
+
+import hashlib
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+
+# This magic is to support the module re-naming that happened with the Python
+# 2->3 transition.
+try:
+    import queue
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, unquote
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs
+    from urllib import unquote
+
+# Received data is read, and charged against the bandwidth, this many bytes
+# at a time.
+READ_CHUNK_SIZE = 64 * 1024
+
+# The bytes which are 7 bit ASCII.
+_ASCII = bytes(bytearray(range(128)))
+
+class Link(object):
+    """The latency and bandwidth of the network between the clients and a
+    server. The bandwidth, in bytes per second, is shared by all of the
+    connections to the server. If it is None, it is unlimited.
+
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self._lock = threading.Lock()
+        self._next_free = 0.0
+
+    def wait(self):
+        """Wait for the latency of the link."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def transfer(self, size):
+        """Wait until size bytes could have been received over the link."""
+        if self.bandwidth is None or size == 0:
+            return
+
+        with self._lock:
+            now = time.time()
+            self._next_free = max(now, self._next_free) + \
+                    float(size) / self.bandwidth
+            delay = self._next_free - now
+        time.sleep(delay)
+
+class _Server(object):
+    """The common parts of the fake servers: a threaded socketserver which
+    runs on a background thread between start() and stop(), or within a with
+    statement, and counts requests.
+
+    """
+
+    def __init__(self, latency, bandwidth):
+        self.link = Link(latency, bandwidth)
+
+        self._lock = threading.Lock()
+        self._counts = { }
+        self._server = None
+        self._thread = None
+
+        # The sockets of the open connections.
+        self._connections = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._server = self._make_server()
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+        # Close any connections the clients have kept open so that their
+        # handler threads finish.
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Close every open connection, as a server does to idle clients."""
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def opened(self, connection):
+        self.count('connections')
+        with self._lock:
+            self._connections.add(connection)
+
+    def closed(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def stats(self):
+        """Return a dictionary of the counts of connections, requests and
+        bytes received by the server.
+
+        """
+        with self._lock:
+            return dict(self._counts)
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class FakeSMTPServer(_Server):
+    """An ESMTP server which accepts and discards every message. If
+    max_size is not None, it is advertised with the SIZE extension and larger
+    messages are refused. If keep_messages is True, the sender, recipients
+    and data of each message are appended to messages.
+
+    Messages are refused, as a strict server would, if they have a line
+    longer than 1000 bytes or 8 bit data which was not declared with
+    BODY=8BITMIME, unless they are sent with BDAT and BODY=BINARYMIME.
+
+    The extensions advertised in reply to EHLO, other than SIZE, are listed
+    in extensions. CHUNKING, BINARYMIME and PIPELINING may be added to them.
+    The server may be made to close the connection on receiving a command
+    with drop().
+    Each reply is sent the latency after its command was received, whether
+    or not the replies to earlier commands have been sent, so that commands
+    sent together are answered together. The number of commands received
+    before the reply to the one before them had been sent is counted as
+    'pipelined'.
+
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, max_size=None,
+                 extensions=('8BITMIME',), keep_messages=False):
+        _Server.__init__(self, latency, bandwidth)
+        self.max_size = max_size
+        self.extensions = list(extensions)
+        self.keep_messages = keep_messages
+        self.messages = [ ]
+
+        # The number of times to close the connection on receiving each verb.
+        self._drops = { }
+
+    def _make_server(self):
+        return _ThreadingTCPServer(('127.0.0.1', 0), _SMTPHandler)
+
+    def drop(self, verb, count=1):
+        """Close the connection, without replying, the next count times a
+        command with verb is received. Replies to earlier commands are still
+        sent.
+
+        """
+        with self._lock:
+            self._drops[verb.upper()] = count
+
+    def dropping(self, verb):
+        """Return whether the connection should be closed on receiving a
+        command with verb.
+
+        """
+        with self._lock:
+            if self._drops.get(verb, 0) <= 0:
+                return False
+            self._drops[verb] -= 1
+        self.count('dropped')
+        return True
+
+    def ehlo_lines(self):
+        lines = [ 'fake.example' ]
+        if self.max_size is None:
+            lines.append('SIZE')
+        else:
+            lines.append('SIZE %d' % (self.max_size,))
+        return lines + self.extensions
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    # Send each reply at once rather than waiting to fill a packet.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.server.fake.opened(self.connection)
+
+        # Replies are written by another thread, each once the latency has
+        # passed, so that reading commands is not held up by them.
+        self._replies = queue.Queue()
+        self._unsent = 0
+        self._unsent_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_replies)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def finish(self):
+        self._replies.put(None)
+        self._writer.join()
+        self.server.fake.closed(self.connection)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        fake = self.server.fake
+
+        self._reset()
+        self._reply(220, 'fake.example ESMTP')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            fake.count('commands')
+            fake.link.transfer(len(line))
+            with self._unsent_lock:
+                if self._unsent > 0:
+                    fake.count('pipelined')
+
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            argument = command[len(verb):].strip()
+
+            if fake.dropping(verb):
+                return
+            if verb == 'EHLO':
+                lines = fake.ehlo_lines()
+                self._send(''.join(['250-%s\r\n' % (x,) for x in lines[:-1]])
+                        + '250 %s\r\n' % (lines[-1],))
+            elif verb == 'HELO':
+                self._reply(250, 'fake.example')
+            elif verb == 'MAIL':
+                self._mail(argument)
+            elif verb == 'RCPT':
+                self._recipients.append(argument[3:].strip())
+                self._reply(250, 'OK')
+            elif verb == 'DATA':
+                self._data()
+            elif verb == 'BDAT' and 'CHUNKING' in fake.extensions:
+                if not self._bdat(argument):
+                    return
+            elif verb == 'RSET':
+                self._reset()
+                self._reply(250, 'OK')
+            elif verb == 'NOOP':
+                self._reply(250, 'OK')
+            elif verb == 'QUIT':
+                self._reply(221, 'Bye')
+                return
+            else:
+                self._reply(502, 'Command not implemented')
+
+    def _mail(self, argument):
+        fake = self.server.fake
+        self._reset()
+        self._sender = argument[5:].split(' ', 1)[0]
+
+        for option in argument.split()[1:]:
+            if option.upper().startswith('SIZE='):
+                size = int(option[5:])
+                if fake.max_size is not None and size > fake.max_size:
+                    self._reply(552, 'Message too large')
+                    return
+            elif option.upper() == 'BODY=8BITMIME':
+                if '8BITMIME' not in fake.extensions:
+                    self._reply(555, 'BODY=8BITMIME not supported')
+                    return
+                self._8bit = True
+                fake.count('8bitmime')
+            elif option.upper() == 'BODY=BINARYMIME':
+                if 'BINARYMIME' not in fake.extensions:
+                    self._reply(555, 'BODY=BINARYMIME not supported')
+                    return
+                self._8bit = True
+                self._binary = True
+                fake.count('binarymime')
+        self._reply(250, 'OK')
+
+    def _data(self):
+        fake = self.server.fake
+        if len(self._recipients) == 0:
+            self._reply(503, 'No recipients')
+            return
+        if self._binary:
+            self._reply(503, 'BODY=BINARYMIME needs BDAT')
+            return
+        self._reply(354, 'End data with <CR><LF>.<CR><LF>')
+
+        size = 0
+        unaccounted = 0
+        lines = [ ]
+        error = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if line == b'.\r\n':
+                break
+
+            if len(line) > 1000:
+                error = 'Line too long'
+            elif not self._8bit and error is None and \
+                    len(line.translate(None, _ASCII)) > 0:
+                error = '8 bit data without BODY=8BITMIME'
+
+            size += len(line)
+            unaccounted += len(line)
+            if unaccounted >= READ_CHUNK_SIZE:
+                fake.link.transfer(unaccounted)
+                unaccounted = 0
+
+            if fake.keep_messages:
+                if line.startswith(b'.'):
+                    line = line[1:]
+                lines.append(line)
+        fake.link.transfer(unaccounted)
+
+        self._received(b''.join(lines), size, error)
+
+    def _bdat(self, argument):
+        """Receive a chunk of a message sent with BDAT and return False if
+        the connection has closed.
+
+        """
+        fake = self.server.fake
+        arguments = argument.split()
+        size = int(arguments[0])
+        last = len(arguments) > 1 and arguments[1].upper() == 'LAST'
+        fake.count('chunks')
+
+        data = _read_exactly(self.rfile, size, fake.link)
+        if data is None:
+            return False
+        if len(self._recipients) == 0:
+            self._reply(503, 'No recipients')
+            return True
+
+        # Lines may be cut between chunks so only those within the chunk
+        # are checked.
+        if self._error is None and not self._binary:
+            if max([len(x) for x in data.split(b'\r\n')]) > 998:
+                self._error = 'Line too long'
+            elif not self._8bit and len(data.translate(None, _ASCII)) > 0:
+                self._error = '8 bit data without BODY=8BITMIME'
+
+        self._size += size
+        if fake.keep_messages:
+            self._chunks.append(data)
+        if last:
+            self._received(b''.join(self._chunks), self._size, self._error)
+        else:
+            self._reply(250, 'OK')
+        return True
+
+    def _received(self, data, size, error):
+        fake = self.server.fake
+        fake.count('messages')
+        fake.count('bytes', size)
+        if fake.keep_messages:
+            with fake._lock:
+                fake.messages.append((self._sender, self._recipients, data))
+
+        if error is not None:
+            self._reply(554, error)
+        elif fake.max_size is not None and size > fake.max_size:
+            self._reply(552, 'Message too large')
+        else:
+            self._reply(250, 'OK')
+        self._reset()
+
+    def _reset(self):
+        self._sender = None
+        self._recipients = [ ]
+        self._8bit = False
+        self._binary = False
+
+        # The chunks received with BDAT so far.
+        self._chunks = [ ]
+        self._size = 0
+        self._error = None
+
+    def _reply(self, code, text):
+        self._send('%d %s\r\n' % (code, text))
+
+    def _send(self, reply):
+        due = time.time() + self.server.fake.link.latency
+        with self._unsent_lock:
+            self._unsent += 1
+        self._replies.put((due, reply.encode('ascii')))
+
+    def _write_replies(self):
+        while True:
+            item = self._replies.get()
+            if item is None:
+                return
+            (due, reply) = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            # The client may send its next command as soon as the reply is
+            # written so count it as sent first.
+            with self._unsent_lock:
+                self._unsent -= 1
+            try:
+                self.wfile.write(reply)
+            except socket.error:
+                pass
+
+def _read_exactly(rfile, size, link):
+    """Read size bytes from rfile, charging them against link READ_CHUNK_SIZE
+    bytes at a time, and return them or None if the connection closes first.
+
+    """
+    pieces = [ ]
+    remaining = size
+    while remaining > 0:
+        piece = rfile.read(min(remaining, READ_CHUNK_SIZE))
+        if not piece:
+            return None
+        link.transfer(len(piece))
+        pieces.append(piece)
+        remaining -= len(piece)
+    return b''.join(pieces)
+
+class FakeMinusServer(_Server):
+    """A server implementing the parts of the min.us API used by the minus
+    module: CreateGallery, UploadItem, GetItems and SaveGallery. Point the
+    minus module at it by setting minus.API_URL to url.
+
+    Uploaded items are discarded but their names and sizes are kept in
+    galleries, a dictionary mapping reader ids to dictionaries with the
+    keys 'editor_id', 'name' and 'items', a list of (id, filename, size)
+    tuples. Once SaveGallery has been given the order of the items, it is
+    kept under 'order'. If keep_data is True, the contents of each item are
+    kept in data, a dictionary mapping item ids to byte strings.
+
+    Faults can be injected with fail() to exercise a client's timeouts and
+    retries.
+
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, keep_data=False):
+        _Server.__init__(self, latency, bandwidth)
+        self.galleries = { }
+        self.keep_data = keep_data
+        self.data = { }
+        self._faults = { }
+
+    def fail(self, endpoint, count=1, status=503, stall=None):
+        """Answer the next count requests to endpoint with status instead of
+        handling them or, if stall is not None, wait stall seconds and then
+        close the connection without answering.
+
+        """
+        with self._lock:
+            self._faults[endpoint] = [ count, status, stall ]
+
+    def _fault(self, endpoint):
+        """Return the (status, stall) pair of the fault to inject into the
+        next request to endpoint or None if it should be handled.
+
+        """
+        with self._lock:
+            fault = self._faults.get(endpoint)
+            if fault is None or fault[0] <= 0:
+                return None
+            fault[0] -= 1
+            return (fault[1], fault[2])
+
+    @property
+    def url(self):
+        return 'http://%s:%d/api/' % (self.host, self.port)
+
+    def _make_server(self):
+        return _ThreadingHTTPServer(('127.0.0.1', 0), _MinusHandler)
+
+    def _gallery_for_editor(self, editor_id):
+        with self._lock:
+            for (reader_id, gallery) in self.galleries.items():
+                if gallery['editor_id'] == editor_id:
+                    return gallery
+        return None
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    """The common parts of the handlers of the fake HTTP servers."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response at once rather than waiting to fill a packet.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.fake.opened(self.connection)
+
+    def finish(self):
+        self.server.fake.closed(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self, chunks=None):
+        """Read the request body, charging it against the bandwidth of the
+        link, and return its size. The body is appended to the list chunks if
+        it is not None and is otherwise discarded.
+
+        """
+        fake = self.server.fake
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().strip(), 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                size += self._read_exactly(chunk_size, chunks)
+                self.rfile.readline()
+        else:
+            size = self._read_exactly(
+                    int(self.headers.get('Content-Length', 0)), chunks)
+
+        fake.count('bytes', size)
+        return size
+
+    def _read_exactly(self, size, chunks=None):
+        remaining = size
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, READ_CHUNK_SIZE))
+            if not data:
+                raise IOError('Connection closed mid-request')
+            remaining -= len(data)
+            self.server.fake.link.transfer(len(data))
+            if chunks is not None:
+                chunks.append(data)
+        return size
+
+class _MinusHandler(_HTTPHandler):
+    ENDPOINTS = ('CreateGallery', 'UploadItem', 'GetItems', 'SaveGallery')
+
+    def do_GET(self):
+        self._body = None
+        self._dispatch(None)
+
+    def do_POST(self):
+        chunks = [ ] if self.server.fake.keep_data else None
+        size = self._read_body(chunks)
+        self._body = None if chunks is None else b''.join(chunks)
+        self._dispatch(size)
+
+    def _dispatch(self, size):
+        fake = self.server.fake
+        fake.count('requests')
+
+        # The query string is not always separated from the path by '?' so
+        # match the start of the path against each endpoint.
+        path = self.path
+        if path.startswith('/api/'):
+            path = path[len('/api/'):]
+        for endpoint in _MinusHandler.ENDPOINTS:
+            if path.startswith(endpoint):
+                break
+        else:
+            self._respond(404, { 'error': 'No such endpoint' })
+            return
+
+        fake.count(endpoint)
+        fake.link.wait()
+
+        fault = fake._fault(endpoint)
+        if fault is not None:
+            (status, stall) = fault
+            fake.count('faults')
+            if stall is not None:
+                time.sleep(stall)
+                self.close_connection = True
+            else:
+                self._respond(status, { 'error': 'Injected fault' })
+            return
+
+        argument = path[len(endpoint):]
+        query = dict([(key, values[0]) for (key, values) in
+            parse_qs(argument.lstrip('?')).items()])
+        getattr(self, '_' + endpoint)(argument, query, size)
+
+    def _CreateGallery(self, argument, query, size):
+        fake = self.server.fake
+        reader_id = uuid.uuid4().hex[:6]
+        editor_id = uuid.uuid4().hex[:12]
+        with fake._lock:
+            fake.galleries[reader_id] = { 'editor_id': editor_id,
+                    'name': None, 'items': [ ] }
+        self._respond(200, { 'reader_id': reader_id, 'editor_id': editor_id })
+
+    def _UploadItem(self, argument, query, size):
+        fake = self.server.fake
+        gallery = fake._gallery_for_editor(query.get('editor_id'))
+        if gallery is None:
+            self._respond(400, { 'error': 'No such gallery' })
+            return
+
+        item_id = uuid.uuid4().hex[:8]
+        with fake._lock:
+            gallery['items'].append((item_id, query.get('filename'), size))
+            if self._body is not None:
+                fake.data[item_id] = self._body
+        self._respond(200, { 'id': item_id, 'height': 0, 'width': 0,
+                'filesize': size })
+
+    def _GetItems(self, argument, query, size):
+        fake = self.server.fake
+        with fake._lock:
+            gallery = fake.galleries.get(argument[len('/m'):])
+            if gallery is not None:
+                items = ['http://i.min.us/%s%s' % (x[0], _extension(x[1]))
+                        for x in gallery['items']]
+        if gallery is None:
+            self._respond(404, { 'error': 'No such gallery' })
+            return
+        self._respond(200, { 'GALLERY_TITLE': gallery['name'],
+                'ITEMS_GALLERY': items })
+
+    def _SaveGallery(self, argument, query, size):
+        fake = self.server.fake
+        gallery = fake._gallery_for_editor(query.get('id'))
+        if gallery is None:
+            self._respond(400, { 'error': 'No such gallery' })
+            return
+        with fake._lock:
+            gallery['name'] = query.get('name')
+            if 'items' in query:
+                # The items are sent as the repr() of a Python list.
+                gallery['order'] = re.findall(r"'([^']*)'", query['items'])
+        self._respond(200, { })
+
+    def _respond(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeS3Server(_Server):
+    """A server implementing the parts of the S3 API used by the s3_renderer
+    module: PUT of an object and multipart uploads, which are initiated, have
+    their parts uploaded and are then completed or aborted. Requests are not
+    authenticated. Point s3_renderer at it by setting the 's3.endpoint'
+    option to url.
+
+    objects maps the path of each object, '/bucket/key', to a dictionary
+    with the keys 'size', 'etag' and 'parts', the number of parts it was
+    uploaded in or 0 if it was PUT whole. If keep_data is True, the contents
+    are kept under 'data'. uploads maps the id of each multipart upload in
+    progress to a dictionary mapping part numbers to (etag, size, data)
+    tuples, where data is None unless keep_data is True.
+
+    The number of connections in use at once is tracked and the most there
+    were is counted as 'max_connections'. If stream_bandwidth is not None,
+    each connection receives data no faster than that many bytes per second,
+    as a single TCP stream is limited by its window and round trip time.
+
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, keep_data=False,
+                 stream_bandwidth=None):
+        _Server.__init__(self, latency, bandwidth)
+        self.keep_data = keep_data
+        self.stream_bandwidth = stream_bandwidth
+        self.objects = { }
+        self.uploads = { }
+        self._active = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def _make_server(self):
+        return _ThreadingHTTPServer(('127.0.0.1', 0), _S3Handler)
+
+    def active(self, change):
+        """Record a request starting, change 1, or finishing, change -1."""
+        with self._lock:
+            self._active += change
+            self._counts['max_connections'] = max(self._active,
+                    self._counts.get('max_connections', 0))
+
+class _S3Handler(_HTTPHandler):
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        fake.count('requests')
+        fake.active(1)
+        try:
+            (path, _, query) = self.path.partition('?')
+            path = unquote(path)
+            query = dict([(key, values[0]) for (key, values) in
+                parse_qs(query, keep_blank_values=True).items()])
+
+            chunks = [ ]
+            self._read_body(chunks)
+            data = b''.join(chunks)
+            fake.link.wait()
+
+            if method == 'PUT' and 'uploadId' in query:
+                self._upload_part(query['uploadId'],
+                        int(query['partNumber']), data)
+            elif method == 'PUT':
+                self._put(path, data)
+            elif method == 'POST' and 'uploads' in query:
+                self._initiate(path)
+            elif method == 'POST' and 'uploadId' in query:
+                self._complete(path, query['uploadId'], data)
+            elif method == 'DELETE' and 'uploadId' in query:
+                self._abort(query['uploadId'])
+            else:
+                self._respond(400, 'InvalidRequest')
+        finally:
+            fake.active(-1)
+
+    def _read_exactly(self, size, chunks=None):
+        start = time.time()
+        _HTTPHandler._read_exactly(self, size, chunks)
+        stream_bandwidth = self.server.fake.stream_bandwidth
+        if stream_bandwidth is not None:
+            delay = start + float(size) / stream_bandwidth - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return size
+
+    def _put(self, path, data):
+        fake = self.server.fake
+        fake.count('PutObject')
+        etag = '"%s"' % (hashlib.md5(data).hexdigest(),)
+        self._store(path, { 'size': len(data), 'etag': etag, 'parts': 0 },
+                data)
+        self._respond(200, headers={ 'ETag': etag })
+
+    def _initiate(self, path):
+        fake = self.server.fake
+        fake.count('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        with fake._lock:
+            fake.uploads[upload_id] = { }
+        self._respond(200, body='<InitiateMultipartUploadResult>'
+                '<Key>%s</Key><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % (path, upload_id))
+
+    def _upload_part(self, upload_id, number, data):
+        fake = self.server.fake
+        fake.count('UploadPart')
+        etag = '"%s"' % (hashlib.md5(data).hexdigest(),)
+        with fake._lock:
+            parts = fake.uploads.get(upload_id)
+            if parts is not None:
+                parts[number] = (etag, len(data),
+                        data if fake.keep_data else None)
+        if parts is None:
+            self._respond(404, 'NoSuchUpload')
+            return
+        self._respond(200, headers={ 'ETag': etag })
+
+    def _complete(self, path, upload_id, data):
+        fake = self.server.fake
+        fake.count('CompleteMultipartUpload')
+        requested = re.findall(
+                b'<PartNumber>([0-9]+)</PartNumber><ETag>([^<]*)</ETag>', data)
+        with fake._lock:
+            parts = fake.uploads.pop(upload_id, None)
+        if parts is None:
+            self._respond(404, 'NoSuchUpload')
+            return
+
+        numbers = [int(x[0]) for x in requested]
+        if numbers != sorted(numbers) or len(numbers) == 0 or \
+                [parts.get(x, (None,))[0] for x in numbers] != \
+                [x[1].decode('utf-8').replace('&quot;', '"')
+                    for x in requested]:
+            self._respond(400, 'InvalidPart')
+            return
+
+        # The ETag of a multipart object is the MD5 of the MD5s of its parts.
+        digests = b''.join([bytes(bytearray.fromhex(parts[x][0].strip('"')))
+            for x in numbers])
+        etag = '"%s-%d"' % (hashlib.md5(digests).hexdigest(), len(numbers))
+        data = None
+        if fake.keep_data:
+            data = b''.join([parts[x][2] for x in numbers])
+        self._store(path, { 'size': sum([parts[x][1] for x in numbers]),
+                            'etag': etag, 'parts': len(numbers) }, data)
+        self._respond(200, body='<CompleteMultipartUploadResult>'
+                '<Key>%s</Key><ETag>%s</ETag>'
+                '</CompleteMultipartUploadResult>' % (path, etag))
+
+    def _abort(self, upload_id):
+        fake = self.server.fake
+        fake.count('AbortMultipartUpload')
+        with fake._lock:
+            fake.uploads.pop(upload_id, None)
+        self._respond(204)
+
+    def _store(self, path, record, data):
+        fake = self.server.fake
+        if fake.keep_data:
+            record['data'] = data
+        with fake._lock:
+            fake.objects[path] = record
+
+    def _respond(self, status, error=None, body=None, headers=None):
+        if error is not None:
+            body = '<Error><Code>%s</Code></Error>' % (error,)
+        body = (body or '').encode('utf-8')
+        self.send_response(status)
+        for (name, value) in (headers or { }).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _extension(filename):
+    if filename is None or '.' not in filename:
+        return ''
+    return '.' + filename.rsplit('.', 1)[1]
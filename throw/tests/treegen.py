@@ -0,0 +1,108 @@
+"""Generate synthetic trees of files to throw in benchmarks.
+
+Each profile describes a tree as groups of files of one kind with sizes
+spread evenly between a minimum and a maximum:
+
+    - text: compressible ASCII text in '.txt' files
+    - binary: incompressible random data in '.bin' files
+    - image: incompressible random data in '.jpg' files
+
+"""
+
+import os
+import random
+
+# Each profile is a list of (kind, count, minimum size, maximum size).
+PROFILES = {
+    # Many small files, as in a source tree.
+    'small': [
+        ('text', 2000, 1000, 16000),
+        ('binary', 500, 1000, 16000),
+    ],
+    # A few huge files, as in a set of disk images or videos.
+    'large': [
+        ('binary', 3, 64000000, 64000000),
+    ],
+    # A mixture of the two, as in a photo collection with some notes.
+    'mixed': [
+        ('text', 500, 1000, 32000),
+        ('binary', 200, 1000, 64000),
+        ('image', 40, 1000000, 4000000),
+        ('binary', 2, 32000000, 32000000),
+    ],
+}
+
+EXTENSIONS = { 'text': '.txt', 'binary': '.bin', 'image': '.jpg' }
+
+# The files in a tree are spread between directories with this many files
+# in each.
+FILES_PER_DIRECTORY = 50
+
+_WORDS = ('throw', 'share', 'file', 'email', 'gallery', 'upload', 'message',
+          'attachment', 'the', 'a', 'of', 'and', 'to', 'with', 'from')
+
+def make_tree(root, profile='mixed', scale=1.0, seed=0):
+    """Create the files of the named profile under the directory root. The
+    number of files of each kind and the sizes of the files are multiplied by
+    scale. The same profile, scale and seed always give files with the same
+    names and sizes, and the same text, but the random data differs so that
+    no file is a duplicate of one thrown before. Return the number of files
+    and their total size in bytes.
+
+    """
+    rng = random.Random(seed)
+    text = _text_block(rng)
+
+    count = 0
+    total_size = 0
+    for (kind, kind_count, min_size, max_size) in PROFILES[profile]:
+        kind_count = max(1, int(kind_count * scale))
+        for _ in range(kind_count):
+            size = int(rng.randint(min_size, max_size) * scale)
+
+            directory = os.path.join(root,
+                    'dir%03d' % (count // FILES_PER_DIRECTORY,))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # A profile may have more than one group of a kind so files are
+            # numbered across the whole tree to keep their names unique.
+            path = os.path.join(directory,
+                    '%s%05d%s' % (kind, count, EXTENSIONS[kind]))
+
+            with open(path, 'wb') as fp:
+                if kind == 'text':
+                    _write_text(fp, size, text, rng)
+                else:
+                    _write_random(fp, size)
+
+            count += 1
+            total_size += size
+
+    return (count, total_size)
+
+def _text_block(rng, size=64 * 1024):
+    words = [ ]
+    length = 0
+    while length < size:
+        word = rng.choice(_WORDS)
+        if rng.random() < 0.1:
+            word += '\n'
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words).encode('ascii')[:size]
+
+def _write_text(fp, size, text, rng):
+    # Start each file at a different place in the block of text so that the
+    # files differ.
+    offset = rng.randint(0, len(text) - 1)
+    while size > 0:
+        data = text[offset:offset + size]
+        fp.write(data)
+        size -= len(data)
+        offset = 0
+
+def _write_random(fp, size):
+    while size > 0:
+        data = os.urandom(min(size, 1024 * 1024))
+        fp.write(data)
+        size -= len(data)
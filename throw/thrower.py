@@ -1,31 +1,105 @@
 import logging
-import smtplib
 import os
 
-from email import encoders
-from email.message import Message
-from email.mime.text import MIMEText
-
-from terminalinterface import *
 import identity
 
-import minus_renderer
 import attachment_renderer
+import walker
+import planner
+import profiling
+import ratelimit
+from config import Config
+
+# The upload backends and the packer, and the modules they use, are imported
+# only when a throw needs them so that the common case of sending small files
+# as attachments does not pay for them. The terminal interface is imported
+# only by Thrower so that asyncthrow, which uses the functions here, does not
+# need it.
+
+# The module implementing each upload backend. Each has a create_email()
+# function taking the files to upload, the collection name and a
+# journal.Journal, as minus_renderer does.
+UPLOAD_BACKENDS = {
+    'minus': 'minus_renderer',
+    's3': 's3_renderer',
+}
 
-def throw(to, paths, name=None):
+def throw(to, paths, name=None, resume=False, pack=False, sync=False,
+          backend=None):
     t = Thrower()
-    t.throw(to, paths, name=name)
+    t.throw(to, paths, name=name, resume=resume, pack=pack, sync=sync,
+            backend=backend)
 
 class Thrower(object):
+    # The size limit used if neither the SMTP server nor the 'email.max_size'
+    # configuration option give one.
     MAX_EMAIL_SIZE = 500000 # 0.5MB
 
     log = logging.getLogger('Thrower')
 
-    def __init__(self):
+    def __init__(self, identity_=None):
+        """Initialise the thrower to send email as identity_, an
+        identity.Identity, or as the default identity if it is None.
+
+        """
+        from terminalinterface import TerminalInterface
+
         self._interface = TerminalInterface()
-        self._identity = identity.get_default_identity()
+        if identity_ is None:
+            identity_ = identity.get_default_identity()
+        self._identity = identity_
+
+    def session(self):
+        """Return a context manager which keeps the connection to the SMTP
+        server open across calls to throw(). See Identity.session().
+
+        """
+        return self._identity.session()
+
+    def throw(self, to, paths, name=None, resume=False, pack=False,
+              sync=False, backend=None):
+        """Send the files in paths, and in any directories in paths, to the
+        recipients in to. If to is empty, the recipients are asked for
+        interactively. Return a dictionary with the number of files thrown,
+        their total size in bytes and the number of seconds for which sending
+        was held back by the rate limit. See the ratelimit module.
+
+        The files are shared between as few attachment emails as possible,
+        each smaller than the size limit advertised by the SMTP server and the
+        'email.max_size' configuration option. Files too
+        large for any email are uploaded and sent as links in one more email.
+        All of the emails are sent over a single SMTP connection.
+
+        Uploads are recorded in a journal until the message has been sent. If
+        resume is True and a previous throw of the same files under the same
+        name was interrupted, its uploads are picked up where they left off.
+
+        If pack is True, the files are sent as a single compressed archive
+        which is generated as it is sent. Since the compressed size is not
+        known in advance, the uncompressed size is used to choose how to send
+        it.
+
+        If sync is True, the files are all uploaded to the gallery of the
+        collection called name, which must be given, and sent as links. Only
+        the files which are new or have changed since the collection was last
+        synced are uploaded. See the gallerysync module.
+
+        Files which are not attached are uploaded with the named backend, one
+        of UPLOAD_BACKENDS, or the one set by the 'upload.backend'
+        configuration option if it is None.
+
+        """
+        if backend is None:
+            backend = Config().get('upload', 'backend')
+        if backend not in UPLOAD_BACKENDS:
+            raise ValueError('Unknown upload backend: %s' % (backend,))
+        if sync and name is None:
+            raise ValueError('A collection must have a name to be synced.')
+        if sync and pack:
+            raise ValueError('A packed archive cannot be synced.')
+        if sync and backend != 'minus':
+            raise ValueError('Only a min.us gallery can be synced.')
 
-    def throw(self, to, paths, name=None):
         if to is None or len(to) == 0:
             self._interface.new_section()
 
@@ -52,43 +126,207 @@ class Thrower(object):
                     self._interface.error(
                         'You need to give me at least one recipient.')
 
-        # Get a list of all the individual files to add.
-        def append_dir(paths, dirpath):
-            contents = [os.path.join(dirpath, x) for x in os.listdir(dirpath)]
-            paths += [x for x in contents if os.path.isfile(x)]
-            for subdirpath in [x for x in contents if os.path.isdir(x)]:
-                append_dir(paths, subdirpath)
+        # Get a list of all the individual files to add and their total size.
+        file_walker = walker.Walker(
+                workers=Config().get('walk', 'workers'))
+        with profiling.span('walk'):
+            entries = list(file_walker.walk(paths))
 
-        filepaths = []
-        filepaths += [x for x in paths if os.path.isfile(x)]
-        for dirpath in [x for x in paths if os.path.isdir(x)]:
-            append_dir(filepaths, dirpath)
+        filepaths = [x.path for x in entries]
+        total_size = sum([x.size for x in entries])
+        profiling.count('walk.files', len(entries))
+        profiling.count('walk.bytes', total_size)
 
-        # Compute the total size of the files
-        total_size = 0
-        for path in filepaths:
-            total_size += os.path.getsize(path)
+        for path in file_walker.duplicates:
+            Thrower.log.info('Skipping duplicate file %s.' % (path,))
 
         self._interface.new_section()
         self._interface.message("""
         You've asked me to throw %s file(s) with a total size of %s MB.""" % \
                 (len(filepaths), total_size / 1000000.0))
 
-        if(total_size < Thrower.MAX_EMAIL_SIZE):
-            # Less than the maximum email size, email directly
-            renderer = attachment_renderer
-        else:
-            # Use the min.us uploader
-            renderer = minus_renderer
+        subject = throw_subject(name)
+        config = Config()
+        throttled = ratelimit.throttled()
+
+        if sync:
+            result = self._sync(to, entries, name, subject)
+            return self._finish(result, throttled)
+
+        # Keep one connection to the SMTP server open from finding its size
+        # limit until all of the messages have been sent.
+        with self._identity.session():
+            with profiling.span('smtp.size_limit'):
+                limit = self._email_size_limit(config)
+
+            (groups, uploads) = plan_throw(entries, name, limit,
+                    self._identity.get_rfc2822_address(), to, subject,
+                    pack=pack, config=config)
+
+            if len(groups) > 0:
+                self._interface.message("""
+                I'll send %s email(s) with the files attached.""" % \
+                        (len(groups),))
+
+            messages = [ ]
+            for group in groups:
+                messages.append(attachment_renderer.create_email(group, name,
+                        workers=config.get('encode', 'workers')))
+
+            job_journal = None
+            if len(uploads) > 0:
+                # Upload the files, recording our progress in case we are
+                # interrupted. An archive is a single stream which cannot be
+                # resumed part way through.
+                from journal import Journal
+                renderer = __import__(UPLOAD_BACKENDS[backend])
+
+                if not pack:
+                    job_journal = Journal.for_job(uploads, name, backend)
+                    if not (resume and job_journal.load()):
+                        job_journal.discard()
+                with profiling.span(backend):
+                    messages.append(renderer.create_email(uploads, name,
+                            journal=job_journal))
+
+            # Pass the message objects themselves rather than flattening them
+            # so that streaming messages can be written to the server as they
+            # are generated.
+            address_messages(messages, self._identity.get_rfc2822_address(),
+                    to, subject)
+            for message in messages:
+                self._identity.sendmail(to, message)
+
+        # The throw is complete and so there is nothing to resume.
+        if job_journal is not None:
+            job_journal.discard()
+
+        return self._finish({ 'files': len(entries), 'bytes': total_size },
+                throttled)
+
+    def _finish(self, result, throttled):
+        """Add the time for which sending was held back by the rate limit
+        since it stood at throttled seconds to result and return it.
+
+        """
+        result['throttled_seconds'] = ratelimit.throttled() - throttled
+        if result['throttled_seconds'] > 0:
+            self._interface.message("""
+            I held back sending for %.1f s to keep to the rate limit.""" % \
+                    (result['throttled_seconds'],))
+        return result
+
+    def _sync(self, to, entries, name, subject):
+        """Sync entries to the gallery of the collection name and send the
+        links to the recipients in to.
+
+        """
+        import gallerysync
+
+        with profiling.span('minus'):
+            synced = gallerysync.sync(entries, name)
+
+        self._interface.message("""
+        I uploaded %s new or changed file(s) with a total size of %s MB.""" % \
+                (synced['uploaded'], synced['uploaded_bytes'] / 1000000.0))
+
+        message = synced['message']
+        address_message(message, self._identity.get_rfc2822_address(), to,
+                subject, 0, 1)
+        self._identity.sendmail(to, message)
+
+        return { 'files': len(entries),
+                 'bytes': sum([x.size for x in entries]),
+                 'uploaded': synced['uploaded'],
+                 'uploaded_bytes': synced['uploaded_bytes'] }
+
+    def _email_size_limit(self, config):
+        """Return the size in bytes of the largest attachment email to send.
+        This is the limit advertised by the SMTP server, if any, further
+        limited by the 'email.max_size' configuration option, if set.
+
+        """
+        return email_size_limit(config, self._identity.max_message_size())
+
+def throw_subject(name):
+    """Return the subject of the emails throwing files named name."""
+    if name is None:
+        return 'Files thrown at you'
+    return 'Files thrown at you: %s' % (name,)
+
+def email_size_limit(config, server_limit):
+    """Return the size in bytes of the largest attachment email to send given
+    server_limit, the limit advertised by the SMTP server or None, and the
+    'email.max_size' option of config.
+
+    """
+    limit = config.get('email', 'max_size')
+    Thrower.log.info('SMTP server message size limit: %s' % (server_limit,))
+
+    if server_limit is None:
+        if limit is None:
+            return Thrower.MAX_EMAIL_SIZE
+        return limit
+
+    if limit is None:
+        return server_limit
+    return min(limit, server_limit)
+
+def plan_throw(entries, name, limit, from_addr, to, subject, pack=False,
+               config=None):
+    """Decide how to throw entries, a list of walker.FileEntry records, under
+    the name name in emails of at most limit bytes from from_addr to the
+    recipients to with the given subject. Return a pair (groups, uploads)
+    where groups is a list of lists of files to attach to each email and
+    uploads is a list of the files to upload instead. If pack is True, the
+    files are packed into a single packer.Archive configured by config.
+
+    """
+    if config is None:
+        config = Config()
+
+    # Allow for the longest subject any of the messages may have once
+    # numbered.
+    headers = {
+        'From': from_addr,
+        'To': ', '.join(to),
+        'Subject': '%s (%s of %s)' % \
+                (subject, len(entries) + 1, len(entries) + 1),
+    }
+
+    if pack:
+        import packer
+        archive = packer.Archive([x.path for x in entries], name,
+            level=config.get('pack', 'level'),
+            workers=config.get('pack', 'workers'))
+        archive_size = attachment_renderer.message_size(headers) + \
+            attachment_renderer.part_size(archive.name,
+                    archive.size_bound())
+        if archive_size <= limit:
+            return ([ [ archive, ] ], [ ])
+        return ([ ], [ archive, ])
+
+    with profiling.span('plan'):
+        (groups, oversized) = planner.plan_emails(entries, limit, headers)
+    return ([[x.path for x in group] for group in groups],
+            [x.path for x in oversized])
 
-        message = renderer.create_email(filepaths, name)
-        message['From'] = self._identity.get_rfc2822_address()
-        message['To'] = ', '.join(to)
+def address_messages(messages, from_addr, to, subject):
+    """Set the From, To and Subject headers of each of messages. If there is
+    more than one message, the subjects are numbered.
 
-        if name is None:
-            message['Subject'] = 'Files thrown at you'
-        else:
-            message['Subject'] = 'Files thrown at you: %s' % (collection_name,)
+    """
+    for (index, message) in enumerate(messages):
+        address_message(message, from_addr, to, subject, index, len(messages))
 
-        self._identity.sendmail(to, message.as_string())
+def address_message(message, from_addr, to, subject, index, count):
+    """Set the From, To and Subject headers of message, the index-th of count
+    messages.
 
+    """
+    message['From'] = from_addr
+    message['To'] = ', '.join(to)
+    if count > 1:
+        message['Subject'] = '%s (%s of %s)' % (subject, index + 1, count)
+    else:
+        message['Subject'] = subject
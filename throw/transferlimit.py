@@ -0,0 +1,149 @@
+"""Adjust the number of uploads in progress at once to the throughput they
+achieve.
+
+Too few uploads at once leave a fast link idle while each waits on the round
+trips of its requests. Too many overload the far end, which answers with
+errors and timeouts. An AdaptiveLimit finds the point in between AIMD-style:
+it measures the throughput of each window of completed uploads and allows
+one more upload at once while the throughput holds up, one fewer when it
+falls and half as many when uploads fail or have to be retried.
+
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+class AdaptiveLimit(object):
+    """A limit on the number of transfers in progress at once which starts
+    at initial and moves between minimum and maximum.
+
+    Each transfer is made inside the slot() context manager, which waits
+    until fewer than limit transfers are in progress. Once as many transfers
+    as the limit have completed, the limit is adjusted from their throughput
+    and from the number which failed. If errors is not None, it is a callable
+    returning a running count of errors, such as the retries made by a
+    httpsession.Session, which are also counted as failures.
+
+    """
+
+    # The limit grows by INCREASE after a window in which the throughput did
+    # not fall by more than TOLERANCE and is multiplied by DECREASE after a
+    # window with errors.
+    INCREASE = 1
+    DECREASE = 0.5
+    TOLERANCE = 0.1
+
+    def __init__(self, initial, minimum=1, maximum=16, errors=None,
+                 clock=time.time):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = min(self.maximum, max(self.minimum, initial))
+        self._errors = errors
+        self._clock = clock
+
+        self._condition = threading.Condition()
+        self._in_progress = 0
+        self._last_rate = None
+        self._start_window()
+
+    @property
+    def limit(self):
+        """The number of transfers allowed at once."""
+        with self._condition:
+            return self._limit
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Wait until a transfer may start and yield a callable to be called
+        with the number of bytes transferred once it has succeeded. A
+        transfer which raises an exception counts as failed.
+
+        """
+        with self._condition:
+            while not self.try_start():
+                self._condition.wait()
+
+        transferred = [ 0 ]
+        def done(size):
+            transferred[0] = size
+
+        failed = True
+        try:
+            yield done
+            failed = False
+        finally:
+            self.finish(transferred[0], failed)
+
+    def try_start(self):
+        """Start a transfer and return True if fewer than limit transfers are
+        in progress, otherwise return False. This is for callers which must
+        not block in slot(), such as coroutines. The transfer must be ended
+        with finish().
+
+        """
+        with self._condition:
+            if self._in_progress >= self._limit:
+                return False
+            self._in_progress += 1
+            return True
+
+    def finish(self, size, failed):
+        """End a transfer started with try_start() which transferred size
+        bytes or, if failed is True, failed.
+
+        """
+        with self._condition:
+            self._in_progress -= 1
+            self._record(size, failed)
+            self._condition.notify_all()
+
+    def _start_window(self):
+        self._window_start = self._clock()
+        self._window_bytes = 0
+        self._window_completed = 0
+        self._window_failed = 0
+        self._window_errors = self._error_count()
+
+    def _error_count(self):
+        if self._errors is None:
+            return 0
+        return self._errors()
+
+    def _record(self, size, failed):
+        """Record a completed transfer and adjust the limit at the end of a
+        window. Called with the condition held.
+
+        """
+        self._window_bytes += size
+        self._window_completed += 1
+        if failed:
+            self._window_failed += 1
+        if self._window_completed < self._limit:
+            return
+
+        elapsed = self._clock() - self._window_start
+        rate = self._window_bytes / max(elapsed, 1e-6)
+        errors = self._window_failed + \
+                self._error_count() - self._window_errors
+
+        limit = self._limit
+        if errors > 0:
+            limit = int(limit * self.DECREASE)
+        elif self._last_rate is not None and \
+                rate < self._last_rate * (1 - self.TOLERANCE):
+            limit -= self.INCREASE
+        else:
+            limit += self.INCREASE
+        limit = min(self.maximum, max(self.minimum, limit))
+
+        if limit != self._limit:
+            _log.info('%s transfer(s) at once at %.1f kB/s with %s error(s): '
+                    'now allowing %s.' % (self._limit, rate / 1e3, errors,
+                        limit))
+        self._limit = limit
+        self._last_rate = rate if errors == 0 else None
+        self._start_window()
@@ -0,0 +1,173 @@
+"""A persistent index of the files which have already been uploaded to min.us
+so that identical content is not uploaded again.
+
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from collections import namedtuple
+
+# SQLite is optional: Python may have been built without it. UploadCache
+# cannot be used if it is missing.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import httpsession
+import minus.minus as minus
+from config import make_directory
+
+DEFAULT_PATH = os.path.expanduser('~/.config/throw/uploads.sqlite')
+
+# Files are hashed this many bytes at a time.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_log = logging.getLogger(__name__)
+
+# A previously uploaded file. The extension is the one the item was uploaded
+# with which min.us requires in the direct link to the item.
+CachedItem = namedtuple('CachedItem',
+        'digest size item_id reader_id extension uploaded')
+
+def hash_file(path):
+    """Return the hex SHA-256 digest of the contents of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class UploadCache(object):
+    """Map the content hash and size of uploaded files to the min.us items
+    holding them. The index is an SQLite database which may be shared between
+    threads.
+
+    Entries older than ttl seconds are ignored and evicted. If ttl is None,
+    entries never expire. If max_entries is not None, only that many of the
+    most recently used entries are kept.
+
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=None, max_entries=None):
+        if sqlite3 is None:
+            raise RuntimeError('The sqlite3 module is not available.')
+
+        make_directory(os.path.dirname(path))
+
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+        # The reader ids of galleries which have been fetched by verify() and
+        # the items they contain.
+        self._gallery_items = { }
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS items (
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                item_id TEXT NOT NULL,
+                reader_id TEXT NOT NULL,
+                extension TEXT NOT NULL,
+                uploaded REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (digest, size))''')
+            self._db.commit()
+
+        self.evict(max_entries=max_entries)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def lookup(self, digest, size):
+        """Return the CachedItem for content with the given digest and size or
+        None if it has not been uploaded before or its entry has expired.
+
+        """
+        with self._lock:
+            row = self._db.execute('''SELECT digest, size, item_id, reader_id,
+                extension, uploaded FROM items WHERE digest = ? AND size = ?''',
+                (digest, size)).fetchone()
+            if row is None:
+                return None
+
+            item = CachedItem(*row)
+            if self._ttl is not None and item.uploaded < time.time() - self._ttl:
+                return None
+
+            self._db.execute('''UPDATE items SET last_used = ?
+                WHERE digest = ? AND size = ?''', (time.time(), digest, size))
+            self._db.commit()
+
+        return item
+
+    def store(self, digest, size, item_id, reader_id, extension):
+        """Record that content with the given digest and size was uploaded as
+        item_id to the gallery reader_id with the file extension extension.
+
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('''INSERT OR REPLACE INTO items VALUES
+                (?, ?, ?, ?, ?, ?, ?)''',
+                (digest, size, item_id, reader_id, extension, now, now))
+            self._db.commit()
+
+    def forget(self, digest, size):
+        """Remove the entry for content with the given digest and size."""
+        with self._lock:
+            self._db.execute('DELETE FROM items WHERE digest = ? AND size = ?',
+                    (digest, size))
+            self._db.commit()
+
+    def evict(self, max_entries=None):
+        """Remove expired entries and, if max_entries is not None, all but
+        the max_entries most recently used entries.
+
+        """
+        with self._lock:
+            if self._ttl is not None:
+                self._db.execute('DELETE FROM items WHERE uploaded < ?',
+                        (time.time() - self._ttl,))
+            if max_entries is not None:
+                self._db.execute('''DELETE FROM items WHERE rowid NOT IN
+                    (SELECT rowid FROM items ORDER BY last_used DESC
+                     LIMIT ?)''', (max_entries,))
+            self._db.commit()
+
+    def verify(self, item, session=None):
+        """Return True if item, a CachedItem, is still present in its min.us
+        gallery. Entries for items which are not present are forgotten. Each
+        gallery is only fetched once per UploadCache. If the gallery cannot be
+        fetched, False is returned but the entry is kept since the item may
+        still be there.
+
+        """
+        with self._lock:
+            items = self._gallery_items.get(item.reader_id)
+
+        if items is None:
+            gallery = minus.Gallery(item.reader_id, session=session)
+            try:
+                items = set(gallery.GetItems()[1])
+            except (httpsession.HTTPException, IOError, KeyError,
+                    ValueError) as e:
+                _log.info('Could not fetch gallery %s: %s' % (item.reader_id, e))
+                return False
+            with self._lock:
+                self._gallery_items[item.reader_id] = items
+
+        if item.item_id in items:
+            return True
+
+        self.forget(item.digest, item.size)
+        return False
@@ -0,0 +1,183 @@
+"""Find the files to be thrown, stat'ing each one only once."""
+
+import logging
+import os
+import stat
+
+from collections import namedtuple
+
+# Use os.scandir() if we have it (Python 3.5 onwards), then the scandir
+# backport and finally fall back to os.listdir() and os.stat().
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_log = logging.getLogger(__name__)
+
+# A file found by the walker. The inode is the (device, inode) pair which
+# uniquely identifies the file on this machine.
+FileEntry = namedtuple('FileEntry', 'path size mtime inode')
+
+def walk(paths, **kwargs):
+    """Return a list of FileEntry records for the files in paths and,
+    recursively, in any directories in paths. The keyword arguments are
+    passed to Walker.
+
+    """
+    return list(Walker(**kwargs).walk(paths))
+
+class Walker(object):
+    """Walk a set of files and directory trees yielding a FileEntry for each
+    regular file. Each directory entry is stat'ed exactly once.
+
+    Each directory is visited at most once, so symlink loops and directories
+    reachable by more than one path do not cause the walk to recurse forever.
+    Each file is yielded at most once, so hard links and files named more than
+    once are only thrown once. The paths skipped for these reasons are
+    recorded in the cycles and duplicates attributes.
+
+    If workers is greater than one, the listings of sibling directories are
+    fetched in parallel by a pool of that many threads. This helps for trees
+    on network file systems where each listing has a high latency. The order
+    of the results is the same either way: the files of a directory, sorted by
+    name, followed by the contents of each of its sub-directories.
+
+    """
+
+    def __init__(self, follow_symlinks=True, workers=1):
+        self.follow_symlinks = follow_symlinks
+        self.workers = workers
+
+        self.cycles = [ ]
+        self.duplicates = [ ]
+
+    def walk(self, paths):
+        """Yield a FileEntry for each file in paths and for each file below
+        any directories in paths. Files given directly in paths come first.
+
+        """
+        self._seen_dirs = set()
+        self._seen_files = set()
+
+        self._executor = None
+        if self.workers > 1:
+            # Under Python 2 this is provided by the 'futures' backport. It is
+            # only imported when needed since it is slow to import.
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        try:
+            files = [ ]
+            dirs = [ ]
+            for path in paths:
+                st = self._stat(path)
+                if st is not None:
+                    _classify(path, st, files, dirs)
+
+            for entry in self._walk_listing((files, dirs)):
+                yield entry
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _walk_listing(self, listing):
+        (files, dirs) = listing
+
+        for (path, st) in files:
+            inode = (st.st_dev, st.st_ino)
+            # Some platforms do not have inode numbers and report zero.
+            if st.st_ino != 0:
+                if inode in self._seen_files:
+                    self.duplicates.append(path)
+                    continue
+                self._seen_files.add(inode)
+            yield FileEntry(path, st.st_size, st.st_mtime, inode)
+
+        # Start listing all of the sub-directories before descending into the
+        # first so that, with a pool of workers, the listings overlap.
+        pending = [ ]
+        for (path, st) in dirs:
+            inode = (st.st_dev, st.st_ino)
+            if st.st_ino != 0:
+                if inode in self._seen_dirs:
+                    _log.info('Skipping already visited directory %s.' % (path,))
+                    self.cycles.append(path)
+                    continue
+                self._seen_dirs.add(inode)
+
+            if self._executor is not None:
+                pending.append(self._executor.submit(self._list, path))
+            else:
+                pending.append(path)
+
+        for item in pending:
+            if self._executor is not None:
+                sub_listing = item.result()
+            else:
+                sub_listing = self._list(item)
+
+            for entry in self._walk_listing(sub_listing):
+                yield entry
+
+    def _list(self, dirpath):
+        """Return a pair of lists of (path, stat) pairs for the files and the
+        directories in dirpath, each sorted by path.
+
+        """
+        files = [ ]
+        dirs = [ ]
+
+        if scandir is not None:
+            listing = scandir(dirpath)
+            try:
+                for dir_entry in listing:
+                    try:
+                        if not self.follow_symlinks and \
+                                dir_entry.is_symlink():
+                            continue
+                        st = dir_entry.stat(
+                                follow_symlinks=self.follow_symlinks)
+                    except OSError:
+                        # Broken symlinks and files which have vanished since
+                        # the listing are skipped.
+                        continue
+                    _classify(dir_entry.path, st, files, dirs)
+            finally:
+                # Release the directory handle now rather than whenever the
+                # iterator is collected. Before Python 3.6 it cannot be
+                # closed early.
+                if hasattr(listing, 'close'):
+                    listing.close()
+        else:
+            for name in os.listdir(dirpath):
+                path = os.path.join(dirpath, name)
+                st = self._stat(path)
+                if st is not None:
+                    _classify(path, st, files, dirs)
+
+        files.sort(key=lambda x: x[0])
+        dirs.sort(key=lambda x: x[0])
+        return (files, dirs)
+
+    def _stat(self, path):
+        try:
+            if self.follow_symlinks:
+                return os.stat(path)
+            st = os.lstat(path)
+        except OSError:
+            return None
+
+        if stat.S_ISLNK(st.st_mode):
+            return None
+        return st
+
+def _classify(path, st, files, dirs):
+    if stat.S_ISREG(st.st_mode):
+        files.append((path, st))
+    elif stat.S_ISDIR(st.st_mode):
+        dirs.append((path, st))